@@ -0,0 +1,55 @@
+""" query times for the spatial index with 50,000 nodes
+
+Run with `python -m benchmarks.bench_geo`
+"""
+
+import random
+import timeit
+from typing import Any, Callable
+
+from meshtastic_tools.geo import SpatialIndex
+
+NODES = 50000
+NUMBER = 200
+
+# most nodes are in a few cities, the rest are scattered about
+CITIES = [(-27.47, 153.02), (51.5, -0.12), (40.7, -74.0), (52.5, 13.4), (35.7, 139.7)]
+
+
+def build() -> SpatialIndex:
+    rand = random.Random(0)
+    index = SpatialIndex()
+    for num in range(NODES):
+        if rand.random() < 0.8:
+            latitude, longitude = rand.choice(CITIES)
+            latitude += rand.gauss(0, 0.5)
+            longitude += rand.gauss(0, 0.5)
+        else:
+            latitude = rand.uniform(-60, 70)
+            longitude = rand.uniform(-180, 180)
+        index.update(num, latitude, longitude, rand.choice((0, 13, 16, 32)))
+        if rand.random() < 0.02:
+            index.mark_gateway(num)
+    return index
+
+
+def main() -> None:
+    index = build()
+    queries: list[tuple[str, Callable[[], Any]]] = [
+        ("within 5km, in a city", lambda: index.within(-27.47, 153.02, 5000)),
+        ("within 20km, in a city", lambda: index.within(-27.47, 153.02, 20000)),
+        ("within 5km, uncertain", lambda: index.within(-27.47, 153.02, 5000, True)),
+        ("within 50km, nowhere", lambda: index.within(10, 10, 50000)),
+        ("bbox, in a city", lambda: index.in_bbox(51.4, -0.3, 51.6, 0.1)),
+        ("bbox, antimeridian", lambda: index.in_bbox(-10, 170, 10, -170)),
+        ("nearest gateway, city", lambda: index.nearest_gateways(-27.47, 153.02)),
+        ("nearest gateway, ocean", lambda: index.nearest_gateways(0, -140)),
+    ]
+    for name, func in queries:
+        results = len(func())
+        elapsed = min(timeit.repeat(func, number=NUMBER, repeat=5))
+        print(f"{name:>24}: {elapsed / NUMBER * 1e3:7.3f} ms/query {results:5} results")
+
+
+if __name__ == "__main__":
+    main()
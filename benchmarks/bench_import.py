@@ -0,0 +1,135 @@
+""" how long the entry points take to start, for scripts that run them a lot
+
+Run with `python -m benchmarks.bench_import`. Each import is timed in a fresh
+interpreter with `-X importtime`, so it doesn't include starting python itself.
+It also times a one-shot `--decode` against decoding the same envelopes
+through one `--decode -` process.
+
+Like bench_mqtt_parser it compares against a baseline,
+`benchmarks/import_baseline.json`, and exits non-zero if something's got
+slower than the tolerance. `--save` records a new one.
+"""
+
+import base64
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+from meshtastic_tools.traffic import TrafficGenerator
+
+BASELINE = Path(__file__).parent / "import_baseline.json"
+ROOT = Path(__file__).parent.parent
+MODULES = ["meshtastic_tools.mqtt_parser", "configure", "meshtastic_tools.layer_configs"]
+
+
+def import_times(module: str) -> dict[str, int]:
+    """ microseconds spent importing each module, when importing `module` """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) if name.strip() == module else int(self_us)
+    return times
+
+
+def bench_import(module: str, runs: int) -> tuple[dict[str, float], list[tuple[str, int]]]:
+    """ the median import time, and the slowest modules it pulls in """
+    totals = []
+    slowest: dict[str, int] = {}
+    for _ in range(runs):
+        times = import_times(module)
+        totals.append(times.pop(module))
+        for name, self_us in times.items():
+            slowest[name] = min(self_us, slowest.get(name, self_us))
+    top = sorted(slowest.items(), key=lambda item: -item[1])[:5]
+    return {"import_ms": round(statistics.median(totals) / 1000, 1)}, top
+
+
+def bench_decode(count: int, runs: int) -> dict[str, float]:
+    """ a process per envelope, against one process for all of them """
+    lines = [base64.b64encode(payload).decode("ascii") for _, payload in TrafficGenerator(0).stream(count)]
+    command = [sys.executable, "-m", "meshtastic_tools.mqtt_parser"]
+    once = []
+    for line in lines[:runs]:
+        start = time.perf_counter()
+        subprocess.run(command + ["--decode", line], cwd=ROOT, capture_output=True, check=True)
+        once.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    result = subprocess.run(
+        command + ["--decode", "-"],
+        cwd=ROOT,
+        input="\n".join(lines) + "\n",
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    warm = time.perf_counter() - start
+    assert len(result.stdout.splitlines()) == count
+    return {
+        "once_ms": round(statistics.median(once) * 1000, 1),
+        "stdin_per_envelope_ms": round(warm / count * 1000, 3),
+    }
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    """ the times that are worse than the baseline by more than the tolerance """
+    regressions = []
+    for name, numbers in results.items():
+        for metric, value in numbers.items():
+            expected = baseline.get(name, {}).get(metric)
+            if expected and value > expected * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {value} (baseline {expected})")
+    return regressions
+
+
+@click.command()
+@click.option("--runs", type=int, default=7, help="Times to run each, the median's reported")
+@click.option("--count", type=int, default=1000, help="Envelopes to decode through --decode -")
+@click.option("--save", is_flag=True, help="Save the results as the new baseline")
+@click.option("--tolerance", type=float, default=0.25, help="How much worse than the baseline is a regression")
+@click.option("--baseline", "baseline_file", type=click.Path(dir_okay=False, path_type=Path), default=BASELINE)
+def main(runs: int, count: int, save: bool, tolerance: float, baseline_file: Path) -> None:
+    results = {}
+    for module in MODULES:
+        results[module], top = bench_import(module, runs)
+        print(f"{module:>30}: {results[module]['import_ms']} ms")
+        for name, self_us in top:
+            print(f"{'':>32}{name} {self_us / 1000:.1f} ms")
+    results["decode"] = bench_decode(count, runs)
+    print(f"{'decode':>30}: " + " ".join(f"{key}={value}" for key, value in results["decode"].items()))
+
+    if save:
+        baseline_file.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+        print(f"saved the baseline to {baseline_file}")
+        return
+    if not baseline_file.exists():
+        print(f"no baseline at {baseline_file}, run with --save to make one")
+        return
+    regressions = compare(results, json.loads(baseline_file.read_text()), tolerance)
+    if regressions:
+        print("regressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("no regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+""" compare the keyring decrypt path with building a cipher per packet
+
+Run with `python -m benchmarks.bench_keyring`
+"""
+
+import base64
+import timeit
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from meshtastic import mesh_pb2, portnums_pb2  # type: ignore
+
+from meshtastic_tools.keyring import DEFAULT_KEY, Keyring
+
+NUMBER = 20000
+
+
+def make_packet(keyring: Keyring) -> mesh_pb2.MeshPacket:
+    data = mesh_pb2.Data(
+        portnum=portnums_pb2.PortNum.TEXT_MESSAGE_APP, payload=b"x" * 64
+    )
+    mp = mesh_pb2.MeshPacket(id=0x12345678, to=0xFFFFFFFF, channel=8)
+    setattr(mp, "from", 0x050C2E68)
+    mp.encrypted = keyring.candidates(8)[0].decrypt(
+        mp.id, 0x050C2E68, data.SerializeToString()
+    )
+    return mp
+
+
+def per_packet_cipher(mp: mesh_pb2.MeshPacket) -> mesh_pb2.Data:
+    """ what try_decode used to do """
+    key_bytes = base64.b64decode(DEFAULT_KEY.encode("ascii"))
+    nonce = getattr(mp, "id").to_bytes(8, "little") + getattr(mp, "from").to_bytes(
+        8, "little"
+    )
+    decryptor = Cipher(algorithms.AES(key_bytes), modes.CTR(nonce)).decryptor()
+    data = mesh_pb2.Data()
+    data.ParseFromString(decryptor.update(mp.encrypted) + decryptor.finalize())
+    return data
+
+
+def main() -> None:
+    keyring = Keyring.default()
+    mp = make_packet(keyring)
+    assert per_packet_cipher(mp) == keyring.decrypt(mp)
+
+    for name, func in (
+        ("per-packet cipher", lambda: per_packet_cipher(mp)),
+        ("keyring", lambda: keyring.decrypt(mp)),
+    ):
+        elapsed = min(timeit.repeat(func, number=NUMBER, repeat=5))
+        print(
+            f"{name:>20}: {elapsed / NUMBER * 1e6:7.2f} us/packet "
+            f"{NUMBER / elapsed:10.0f} packets/sec"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+""" time composing a config from lots of layers, with and without the cache,
+and building a whole fleet's configs at once
+
+Run with `python -m benchmarks.bench_layer_configs`
+"""
+
+from pathlib import Path
+import random
+import tempfile
+import time
+from typing import Callable
+
+import click
+from loguru import logger
+import yaml
+
+from meshtastic_tools.layer_configs import LayerCache, build_all, compose
+
+
+def make_layers(directory: Path, count: int, seed: int) -> list[Path]:
+    """ layers that each set a handful of settings, some of them overlapping """
+    rand = random.Random(seed)
+    sections = ["bluetooth", "device", "display", "lora", "position", "power", "network"]
+    paths = []
+    for index in range(count):
+        layer: dict[str, dict[str, object]] = {}
+        for _ in range(20):
+            section = layer.setdefault(rand.choice(sections), {})
+            section[f"setting_{rand.randrange(200)}"] = rand.choice(
+                [True, False, rand.randrange(1000), f"value-{index}", [1, 2, 3]]
+            )
+        path = directory / f"layer-{index:04d}.yml"
+        path.write_text(yaml.dump({"config": layer, "module_config": {"layer": index}}))
+        paths.append(path)
+    return paths
+
+
+def make_fleet(directory: Path, layers: list[Path], nodes: int, seed: int) -> None:
+    """ nodes sharing most of their layers, with a layer of their own on top """
+    rand = random.Random(seed)
+    for node in range(nodes):
+        shared = layers[: rand.randrange(len(layers) // 2, len(layers))]
+        own = directory / f"layer-{node}.yml"
+        own.write_text(yaml.dump({"config": {"owner": {"long_name": f"node {node}"}}}))
+        names = [path.name for path in shared] + [own.name]
+        (directory / f"layers-{node}.yml").write_text(yaml.dump({"layers": names}))
+
+
+def timed(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+
+@click.command()
+@click.option("--layers", type=int, default=300)
+@click.option("--seed", type=int, default=0)
+@click.option("--nodes", type=int, default=100, help="Nodes in the fleet")
+def main(layers: int, seed: int, nodes: int) -> None:
+    logger.remove()
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        paths = make_layers(directory, layers, seed)
+        cache = LayerCache(directory / "cache")
+        results = {
+            "no cache": timed(lambda: compose(paths)),
+            "cold cache": timed(lambda: compose(paths, cache)),
+            "nothing changed": timed(lambda: compose(paths, cache)),
+        }
+        paths[-1].write_text(yaml.dump({"config": {"lora": {"hop_limit": 3}}}))
+        results["top layer changed"] = timed(lambda: compose(paths, cache))
+        paths[len(paths) // 2].write_text(yaml.dump({"config": {"lora": {"hop_limit": 4}}}))
+        results["middle layer changed"] = timed(lambda: compose(paths, cache))
+
+        # a fleet sharing a smaller set of layers
+        fleet = directory / "fleet"
+        fleet.mkdir()
+        make_fleet(fleet, make_layers(fleet, layers // 10, seed), nodes, seed)
+        lists = [
+            [fleet / name for name in yaml.safe_load(path.read_text())["layers"]]
+            for path in sorted(fleet.glob("layers-*.yml"))
+        ]
+        results[f"{nodes} nodes one by one"] = timed(
+            lambda: [yaml.dump(compose(layer_files)) for layer_files in lists]
+        )
+        results[f"{nodes} nodes, build_all"] = timed(lambda: build_all(str(fleet), write=False))
+    for name, elapsed in results.items():
+        print(f"{name:>22}: {elapsed:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
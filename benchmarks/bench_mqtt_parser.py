@@ -0,0 +1,248 @@
+""" end to end benchmark of mqtt_parser against synthetic traffic
+
+Run with `python -m benchmarks.bench_mqtt_parser`, it compares against
+`benchmarks/baseline.json` and exits non-zero if something's got slower than
+the tolerance. `--save` records new baseline numbers, do that on the same
+machine you'll compare on.
+
+`--broker localhost:1883` also times the round trip through a local broker
+(eg mosquitto), publishing the traffic and decoding it in on_message.
+"""
+
+import gc
+import json
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import click
+from meshtastic import mqtt_pb2  # type: ignore
+
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.dedup import DedupIndex
+from meshtastic_tools.filters import PacketFilter
+from meshtastic_tools.nodedb import NodeDirectory
+from meshtastic_tools.sinks import Sink
+from meshtastic_tools.traffic import TrafficGenerator
+
+BASELINE = Path(__file__).parent / "baseline.json"
+# p99 and peak memory are too noisy between runs to fail on, they're just reported
+CHECKED = ("packets_per_sec", "p50_us", "retained_bytes_per_packet")
+
+
+class NullSink(Sink):
+    """ throws the output away, so the benchmark doesn't time stdout """
+
+    def __init__(self) -> None:
+        super().__init__(batch_size=1, flush_interval=0)
+
+    def write_batch(
+        self, lines: list[str], messages: list[Optional[dict[str, Any]]]
+    ) -> None:
+        pass
+
+
+def measure(
+    func: Callable[[Any], Any],
+    items: list[Any],
+    setup: Optional[Callable[[], None]] = None,
+) -> dict[str, float]:
+    """ packets/sec, p50/p99 latency in microseconds and memory per packet
+
+    `setup` is run before each pass over the items, so they're not all
+    duplicates after the first one.
+    """
+    setup = setup or (lambda: None)
+    # a warm up pass, so the serializer tables and caches are built
+    setup()
+    for item in items[:100]:
+        func(item)
+    setup()
+    gc.collect()
+    timings = []
+    perf_counter = time.perf_counter
+    start = perf_counter()
+    for item in items:
+        before = perf_counter()
+        func(item)
+        timings.append(perf_counter() - before)
+    elapsed = perf_counter() - start
+
+    # separately, because tracing allocations slows everything down
+    setup()
+    tracemalloc.start()
+    for item in items:
+        func(item)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "packets_per_sec": round(len(items) / elapsed),
+        "p50_us": round(statistics.median(timings) * 1e6, 2),
+        "p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 2),
+        "peak_bytes_per_packet": round(peak / len(items), 1),
+        "retained_bytes_per_packet": round(current / len(items), 1),
+    }
+
+
+def reset_parser(dedup: bool, packet_filter: Optional[PacketFilter] = None) -> None:
+    mqtt_parser.NODES = NodeDirectory()
+    mqtt_parser.DEDUP = DedupIndex(300, 65536) if dedup else None
+    mqtt_parser.FILTER = packet_filter
+    mqtt_parser.SINK = NullSink()
+
+
+def bench_try_decode(generator: TrafficGenerator, count: int) -> dict[str, float]:
+    packets = []
+    for _, payload in generator.stream(count):
+        se = mqtt_pb2.ServiceEnvelope()
+        se.ParseFromString(payload)
+        packets.append(se.packet)
+
+    def decode(mp: Any) -> None:
+        mp.ClearField("decoded")
+        mqtt_parser.try_decode(mp)
+
+    return measure(decode, packets)
+
+
+def bench_parse_message(
+    generator: TrafficGenerator,
+    count: int,
+    dedup: bool,
+    packet_filter: Optional[PacketFilter] = None,
+) -> dict[str, float]:
+    payloads = [payload for _, payload in generator.stream(count)]
+    return measure(
+        lambda payload: mqtt_parser.parse_message(payload, None),
+        payloads,
+        lambda: reset_parser(dedup, packet_filter),
+    )
+
+
+def bench_broker(generator: TrafficGenerator, count: int, broker: str) -> dict[str, float]:
+    """ publish everything and time until the subscriber's decoded it all """
+    import paho.mqtt.client as mqtt
+
+    host, _, port = broker.partition(":")
+    messages = list(generator.stream(count))
+    reset_parser(False)
+    received = 0
+    done = threading.Event()
+    subscribed = threading.Event()
+
+    def on_message(_client: Any, _userdata: Any, msg: Any) -> None:
+        nonlocal received
+        mqtt_parser.parse_message(msg.payload, msg)
+        received += 1
+        if received >= count:
+            done.set()
+
+    subscriber = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)  # type: ignore[attr-defined]
+    subscriber.on_message = on_message
+    subscriber.on_subscribe = lambda *_args: subscribed.set()
+    subscriber.connect(host, int(port or 1883))
+    subscriber.subscribe("msh/2/e/#")
+    subscriber.loop_start()
+    publisher = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)  # type: ignore[attr-defined]
+    publisher.connect(host, int(port or 1883))
+    publisher.loop_start()
+    try:
+        if not subscribed.wait(10):
+            raise TimeoutError(f"Couldn't subscribe on {broker}")
+        start = time.perf_counter()
+        for topic, payload in messages:
+            publisher.publish(topic, payload)
+        finished = done.wait(60)
+        elapsed = time.perf_counter() - start
+    finally:
+        publisher.loop_stop()
+        publisher.disconnect()
+        subscriber.loop_stop()
+        subscriber.disconnect()
+    if not finished:
+        raise TimeoutError(f"Only got {received} of {count} messages back from {broker}")
+    return {"packets_per_sec": round(count / elapsed)}
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    """ the numbers that are worse than the baseline by more than the tolerance """
+    regressions = []
+    for name, numbers in results.items():
+        for metric, value in numbers.items():
+            expected = baseline.get(name, {}).get(metric)
+            if not expected or metric not in CHECKED:
+                continue
+            if metric == "packets_per_sec":
+                worse = value < expected * (1 - tolerance)
+            else:
+                worse = value > expected * (1 + tolerance)
+            if worse:
+                regressions.append(f"{name} {metric}: {value} (baseline {expected})")
+    return regressions
+
+
+@click.command()
+@click.option("--count", type=int, default=20000, help="Messages per benchmark")
+@click.option("--seed", type=int, default=0)
+@click.option("--duplicate-rate", type=float, default=0.3)
+@click.option("--broker", help="Also benchmark through the broker at host[:port]")
+@click.option("--save", is_flag=True, help="Save the results as the new baseline")
+@click.option("--tolerance", type=float, default=0.25, help="How much worse than the baseline is a regression")
+@click.option("--baseline", "baseline_file", type=click.Path(dir_okay=False, path_type=Path), default=BASELINE)
+def main(
+    count: int,
+    seed: int,
+    duplicate_rate: float,
+    broker: Optional[str],
+    save: bool,
+    tolerance: float,
+    baseline_file: Path,
+) -> None:
+    def generator() -> TrafficGenerator:
+        return TrafficGenerator(seed, duplicate_rate=duplicate_rate)
+
+    results = {
+        "try_decode": bench_try_decode(generator(), count),
+        "parse_message": bench_parse_message(generator(), count, dedup=False),
+        "parse_message_dedup": bench_parse_message(generator(), count, dedup=True),
+        "parse_message_filtered": bench_parse_message(
+            generator(),
+            count,
+            dedup=False,
+            packet_filter=PacketFilter.parse(["POSITION_APP", "TELEMETRY_APP"]),
+        ),
+    }
+    if broker is not None:
+        results["broker"] = bench_broker(generator(), count, broker)
+
+    for name, numbers in results.items():
+        print(f"{name:>22}: " + " ".join(f"{key}={value}" for key, value in numbers.items()))
+
+    if save:
+        baseline_file.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+        print(f"saved the baseline to {baseline_file}")
+        return
+    if not baseline_file.exists():
+        print(f"no baseline at {baseline_file}, run with --save to make one")
+        return
+    regressions = compare(results, json.loads(baseline_file.read_text()), tolerance)
+    if regressions:
+        print("regressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("no regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
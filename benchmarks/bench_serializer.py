@@ -0,0 +1,91 @@
+""" throughput of MessageToDict + json.dumps against the fast-path serializer
+
+Run with `python -m benchmarks.bench_serializer`
+"""
+
+import json
+import timeit
+from typing import Any, Callable
+
+from google.protobuf.json_format import MessageToDict  # type: ignore
+from meshtastic import mesh_pb2, telemetry_pb2  # type: ignore
+
+from meshtastic_tools.serializer import dumps, message_to_dict
+
+NUMBER = 20000
+
+
+def payloads() -> dict[str, tuple[Any, bytes]]:
+    """ a typical payload for each portnum, and its factory """
+    position = mesh_pb2.Position(
+        latitude_i=-274664344,
+        longitude_i=1531438018,
+        altitude=7,
+        time=1716678942,
+        precision_bits=32,
+        sats_in_view=4,
+    )
+    telemetry = telemetry_pb2.Telemetry(time=1716678942)
+    telemetry.device_metrics.battery_level = 87
+    telemetry.device_metrics.voltage = 4.05
+    telemetry.device_metrics.channel_utilization = 12.5
+    telemetry.device_metrics.air_util_tx = 1.25
+    telemetry.device_metrics.uptime_seconds = 86400
+    nodeinfo = mesh_pb2.User(
+        id="!050c2e68",
+        long_name="Gateway 2e68",
+        short_name="2e68",
+        macaddr=b"\x01\x02\x03\x04\x05\x06",
+        hw_model=mesh_pb2.HardwareModel.TBEAM,
+    )
+    return {
+        "POSITION_APP": (mesh_pb2.Position, position.SerializeToString()),
+        "TELEMETRY_APP": (telemetry_pb2.Telemetry, telemetry.SerializeToString()),
+        "NODEINFO_APP": (mesh_pb2.User, nodeinfo.SerializeToString()),
+    }
+
+
+def message_to_dict_path(factory: Any, payload: bytes) -> str:
+    pb = factory()
+    pb.ParseFromString(payload)
+    return json.dumps(MessageToDict(pb))
+
+
+def fast_path(factory: Any, payload: bytes) -> str:
+    pb = factory()
+    pb.ParseFromString(payload)
+    return json.dumps(message_to_dict(pb))
+
+
+def orjson_path(factory: Any, payload: bytes) -> bytes:
+    pb = factory()
+    pb.ParseFromString(payload)
+    return dumps(message_to_dict(pb), "orjson")
+
+
+def main() -> None:
+    paths: list[tuple[str, Callable[[Any, bytes], Any]]] = [
+        ("MessageToDict", message_to_dict_path),
+        ("message_to_dict", fast_path),
+    ]
+    try:
+        dumps({}, "orjson")
+        paths.append(("message_to_dict+orjson", orjson_path))
+    except ImportError:
+        print("orjson isn't installed, skipping it")
+
+    for portnum, (factory, payload) in payloads().items():
+        assert message_to_dict_path(factory, payload) == fast_path(factory, payload)
+        print(portnum)
+        for name, func in paths:
+            elapsed = min(
+                timeit.repeat(lambda: func(factory, payload), number=NUMBER, repeat=5)
+            )
+            print(
+                f"{name:>24}: {elapsed / NUMBER * 1e6:7.2f} us/packet "
+                f"{NUMBER / elapsed:10.0f} packets/sec"
+            )
+
+
+if __name__ == "__main__":
+    main()
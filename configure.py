@@ -1,17 +1,53 @@
 from enum import IntEnum
+import functools
+import hashlib
 from io import BytesIO
-import json
+import os
+from pathlib import Path
+import re
 import sys
+import tempfile
+import threading
 import time
-from typing import Optional, TextIO
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, NamedTuple, Optional, TextIO, Tuple, TypeAlias
 
 import click
+from google.protobuf import json_format  # type: ignore
 from loguru import logger
-from meshtastic.tcp_interface import TCPInterface  # type: ignore
-from meshtastic.serial_interface import SerialInterface  # type: ignore
 from meshtastic.util import camel_to_snake  # type: ignore
 from meshtastic.node import Node  # type: ignore
-from pydantic import BaseModel, field_validator, model_validator
+from meshtastic.protobuf import localonly_pb2  # type: ignore
+from pubsub import pub
+from pydantic import BaseModel, ConfigDict, field_validator, model_validator
+
+if TYPE_CHECKING:
+    # only the one that's connected with is imported, see connect_device
+    from meshtastic.tcp_interface import TCPInterface  # type: ignore
+    from meshtastic.serial_interface import SerialInterface  # type: ignore
+
+
+# the device's config sections, by the name writeConfig() takes
+LOCAL_SECTIONS = {
+    field.name: field.message_type
+    for field in localonly_pb2.LocalConfig.DESCRIPTOR.fields
+    if field.message_type is not None
+}
+MODULE_SECTIONS = {
+    field.name: field.message_type
+    for field in localonly_pb2.LocalModuleConfig.DESCRIPTOR.fields
+    if field.message_type is not None
+}
+
+
+def section_descriptor(section: str) -> Any:
+    if section in MODULE_SECTIONS:
+        return MODULE_SECTIONS[section]
+    return LOCAL_SECTIONS[section]
+
+
+def enum_names(section: str, key: str) -> List[str]:
+    """the values a protobuf enum setting can have, as the firmware names them"""
+    return list(section_descriptor(section).fields_by_name[key].enum_type.values_by_name)
 
 
 class MqttConfig(BaseModel):
@@ -55,26 +91,7 @@ class LoraConfig(BaseModel):
 
     @field_validator("region")
     def _validate_region(cls, value: str) -> str:
-        valid_regions = [
-            "US",
-            "EU_433",
-            "EU_868",
-            "CN",
-            "JP",
-            "ANZ",
-            "KR",
-            "TW",
-            "RU",
-            "IN",
-            "NZ_865",
-            "TH",
-            "LORA_24",
-            "UA_433",
-            "UA_868",
-            "MY_433",
-            "MY_919",
-            "SG_923",
-        ]
+        valid_regions = [name for name in enum_names("lora", "region") if name != "UNSET"]
         if value.upper() not in valid_regions:
             raise ValueError(
                 f"Invalid region: {value}, should be one of {','.join(valid_regions)}"
@@ -83,17 +100,7 @@ class LoraConfig(BaseModel):
 
     @field_validator("modem_preset")
     def _validate_modem_preset(cls, value: str) -> str:
-
-        valid_modes = [
-            "LONG_FAST",
-            "LONG_SLOW",
-            "VERY_LONG_SLOW",
-            "MEDIUM_SLOW",
-            "MEDIUM_FAST",
-            "SHORT_SLOW",
-            "SHORT_FAST",
-            "LONG_MODERATE",
-        ]
+        valid_modes = enum_names("lora", "modem_preset")
         if value.upper() not in valid_modes:
             raise ValueError(
                 f"Invalid modem preset: {value}, should be one of {','.join(valid_modes)}"
@@ -146,285 +153,817 @@ class Config(BaseModel):
         return self
 
 
-def do_network_config(node: Node, config: Config) -> None:
+Interface: TypeAlias = "SerialInterface | TCPInterface"
 
-    if config.network is None:
-        logger.debug("No network config...")
-        return
-    logger.debug("Doing network config")
-    need_to_write_network = False
-    for key, value in config.network.model_dump().items():
-        key = camel_to_snake(key)
-        if value is None:
-            continue
-        logger.debug("key: {}, value: {}", key, value)
-        node.localConfig.network.wifi_enabled
-        if not hasattr(node.localConfig.network, key):
-            logger.debug(f"network has no attribute {key}")
-            continue
-        oldvalue = getattr(node.localConfig.network, key)
-        if oldvalue != value:
-            setattr(node.localConfig.network, key, value)
-            logger.info(f"updating network/{key} from {oldvalue} to {value}")
-            need_to_write_network = True
-    if need_to_write_network:
-        logger.info("writing newtork config")
-        node.writeConfig("network")
-        logger.debug("Waiting for reboot...")
-        time.sleep(2)
-        node.waitForConfig()
 
+class Change(NamedTuple):
+    """one setting that's going to change"""
 
-def do_lora_config(node: Node, config: Config) -> None:
+    section: str
+    key: str
+    old: Any
+    new: Any
 
-    logger.debug("Doing lora config")
-    need_to_write_lora = False
-    # check and set the lorawan region
-    if not hasattr(node.localConfig.lora, config.lora.region):
-        logger.error("Invalid region from config: {}", config.lora.region)
-        return
-    # logger.info("Current LORA region: {}", node.localConfig.lora.region)
-    wanted_region = getattr(node.localConfig.lora, config.lora.region)
-    if node.localConfig.lora.region != wanted_region:
-        need_to_write_lora = True
-        logger.info("updating lora region to {}", wanted_region)
-        node.localConfig.lora.region = wanted_region
-
-    if config.lora.modem_preset is not None:
-        if not hasattr(node.localConfig.lora, config.lora.modem_preset):
-            logger.error(
-                "Invalid modem_preset from config: {}", config.lora.modem_preset
-            )
-            sys.exit(1)
 
-        wanted_mode = getattr(node.localConfig.lora, config.lora.modem_preset)
-        if node.localConfig.lora.modem_preset != wanted_mode:
-            need_to_write_lora = True
-            logger.info("updating lora modem_preset to {}", wanted_mode)
-            node.localConfig.lora.modem_preset = wanted_mode
-
-    if need_to_write_lora:
-        logger.info("Writing lora config")
-        node.writeConfig("lora")
-        logger.debug("Waiting for reboot...")
-        time.sleep(2)
-        node.waitForConfig()
+class Plan:
+    """everything that needs changing on a device, so it can be written in one go"""
 
+    def __init__(self) -> None:
+        self.changes: List[Change] = []
+        # setOwner arguments
+        self.owner: Dict[str, str] = {}
+        # (latitude, longitude, altitude) for setFixedPosition
+        self.fixed_position: Optional[Tuple[float, float, int]] = None
 
-def do_bluetooth_config(node: Node, config: Config) -> None:
+    def __bool__(self) -> bool:
+        return bool(self.changes)
 
-    need_to_write_bluetooth = False
-    if config.bluetooth is None:
-        logger.debug("No bluetooth config")
-        return
-    logger.debug("Doing bluetooth config")
-    for key, value in config.bluetooth.model_dump().items():
-        key = camel_to_snake(key)
-        if not hasattr(node.localConfig.bluetooth, key):
-            logger.debug(f"bluetooth has no attribute {key}")
-            continue
-        oldvalue = getattr(node.localConfig.bluetooth, key)
-        if oldvalue != value:
-            setattr(node.localConfig.bluetooth, key, value)
-            logger.info(f"updating bluetooth {key} from {oldvalue} to {value}")
-            need_to_write_bluetooth = True
-    if need_to_write_bluetooth:
-        logger.info("writing bluetooth config")
-        node.writeConfig("bluetooth")
-        logger.debug("Waiting for reboot...")
-        time.sleep(2)
-        node.waitForConfig()
+    @property
+    def sections(self) -> List[str]:
+        """the config sections to write, in the order they were planned"""
+        sections = []
+        for change in self.changes:
+            if change.section != "owner" and change.section not in sections:
+                sections.append(change.section)
+        return sections
 
+    @property
+    def needs_reboot(self) -> bool:
+        """writing a config section reboots the device, the owner and fixed position don't"""
+        return bool(self.sections)
 
-def do_mqtt_config(node: Node, config: Config, short_name: str) -> None:
+    def describe(self) -> List[str]:
+        return [
+            f"{change.section}/{change.key}: {change.old!r} -> {change.new!r}"
+            for change in self.changes
+        ]
 
-    if config.mqtt is None:
-        logger.debug("No MQTT config")
-        return
-    need_to_write_mqtt = False
-    logger.debug("Doing MQTT config")
 
-    if config.mqtt.root is not None:
-        if "{id}" in config.mqtt.root:
-            config.mqtt.root = config.mqtt.root.replace("{id}", short_name)
+def config_target(node: Node, section: str) -> Any:
+    """the protobuf a section's settings live in"""
+    if section in MODULE_SECTIONS:
+        return getattr(node.moduleConfig, section)
+    return getattr(node.localConfig, section)
 
-    for key, value in config.mqtt.model_dump().items():
-        key = camel_to_snake(key)
-        if not hasattr(node.moduleConfig.mqtt, key):
-            logger.debug(f"mqtt has no attribute {key}")
-            continue
-        oldvalue = getattr(node.moduleConfig.mqtt, key)
 
-        if oldvalue != value:
-            setattr(node.moduleConfig.mqtt, key, value)
-            logger.info(f"updating mqtt {key} from {oldvalue} to {value}")
-            need_to_write_mqtt = True
+def _unchanged(value: Any) -> Any:
+    return value
 
-    if need_to_write_mqtt:
-        logger.info("writing mqtt config")
-        logger.debug(json.dumps(node.moduleConfig.mqtt, default=str, indent=4))
-        node.writeConfig("mqtt")
 
-        logger.debug("Waiting for reboot...")
-        time.sleep(2)
-        node.waitForConfig()
+def _enum_value(enum_type: Any, value: Any) -> int:
+    """an enum setting's number, from its name or a number"""
+    if isinstance(value, IntEnum):
+        value = value.name
+    if isinstance(value, str):
+        number = enum_type.values_by_name.get(value.upper())
+        if number is not None:
+            return int(number.number)
+    elif isinstance(value, int) and not isinstance(value, bool) and value in enum_type.values_by_number:
+        return value
+    raise ValueError(f"Invalid {enum_type.name}: {value}, should be one of {','.join(enum_type.values_by_name)}")
 
 
-def do_owner_config(
-    node: Node, config: Config, client: SerialInterface | TCPInterface
-) -> None:
+class FieldSpec(NamedTuple):
+    """a setting in a config model, and the protobuf field it's written to"""
+
+    attribute: str
+    key: str
+    convert: Callable[[Any], Any]
+    # "{id}" is replaced with the device's short name
+    templated: bool
+
+
+class SectionSpec(NamedTuple):
+    """a config model that maps straight on to one of the device's config sections"""
 
+    attribute: str
+    section: str
+    fields: Tuple[FieldSpec, ...]
+
+
+def section_spec(
+    attribute: str,
+    section: str,
+    model: type[BaseModel],
+    templated: Tuple[str, ...] = (),
+    exclude: Tuple[str, ...] = (),
+) -> SectionSpec:
+    """match up a model's fields with the section's protobuf fields, once
+
+    Model fields can be camelCase, like `meshtastic --export-config` writes them.
+    Ones the protobuf doesn't have are left out.
+    """
+    descriptor = section_descriptor(section)
+    fields = []
+    for name in model.model_fields:
+        key = camel_to_snake(name)
+        if key in exclude:
+            continue
+        field = descriptor.fields_by_name.get(key)
+        if field is None:
+            logger.debug("{} has no attribute {}", section, key)
+            continue
+        convert: Callable[[Any], Any] = _unchanged
+        if field.enum_type is not None:
+            convert = functools.partial(_enum_value, field.enum_type)
+        fields.append(FieldSpec(name, key, convert, key in templated))
+    return SectionSpec(attribute, section, tuple(fields))
+
+
+# the Config attributes that are planned generically, in the order they're written
+SECTIONS = (
+    section_spec("lora", "lora", LoraConfig),
+    section_spec("mqtt", "mqtt", MqttConfig, templated=("root",)),
+    section_spec("network", "network", NetworkConfig),
+    section_spec("bluetooth", "bluetooth", BluetoothConfig),
+    # the fixed position is set with setFixedPosition, see plan_gps
+    section_spec(
+        "gps", "position", GpsConfig, exclude=("fixed_position", "latitude", "longitude", "altitude")
+    ),
+)
+
+
+def plan_sections(
+    plan: Plan,
+    node: Node,
+    config: Config,
+    short_name: str,
+    sections: Tuple[SectionSpec, ...] = SECTIONS,
+) -> None:
+    """add every setting which differs from what's on the device to the plan"""
+    for spec in sections:
+        values = getattr(config, spec.attribute)
+        if values is None:
+            logger.debug("No {} config", spec.attribute)
+            continue
+        target = config_target(node, spec.section)
+        for field in spec.fields:
+            value = getattr(values, field.attribute)
+            if value is None:
+                continue
+            if field.templated:
+                value = value.replace("{id}", short_name)
+            value = field.convert(value)
+            oldvalue = getattr(target, field.key)
+            if oldvalue != value:
+                plan.changes.append(Change(spec.section, field.key, oldvalue, value))
+
+
+def plan_owner(plan: Plan, config: Config, client: Interface) -> None:
     if config.owner is None:
         logger.debug("No owner config specified!")
         return
 
-    logger.debug("Doing owner config")
-    need_to_write_owner = False
-
-    params = {}
-
     short_name = client.getShortName()
+    long_name = config.owner.long_name.replace("{id}", short_name)
+    wanted_short_name = config.owner.short_name.replace("{id}", short_name)
 
-    if "{id}" in config.owner.long_name:
-        config.owner.long_name = config.owner.long_name.replace("{id}", short_name)
-    if "{id}" in config.owner.short_name:
-        config.owner.short_name = config.owner.short_name.replace("{id}", short_name)
-
-    if client.getLongName() != config.owner.long_name:
-        logger.info("Setting long name to {}", config.owner.long_name)
-        params["long_name"] = config.owner.long_name
-        params["short_name"] = config.owner.short_name
-        need_to_write_owner = True
-    if client.getShortName() != config.owner.short_name:
-        logger.info("Setting short name to {}", config.owner.short_name)
-        params["short_name"] = config.owner.short_name
-        need_to_write_owner = True
-
-    if need_to_write_owner:
-        node.setOwner(**params)
-        logger.debug("Waiting for reboot...")
-        time.sleep(2)
-        node.waitForConfig()
+    if client.getLongName() != long_name:
+        plan.changes.append(Change("owner", "long_name", client.getLongName(), long_name))
+        plan.owner["long_name"] = long_name
+        plan.owner["short_name"] = wanted_short_name
+    if short_name != wanted_short_name:
+        plan.changes.append(Change("owner", "short_name", short_name, wanted_short_name))
+        plan.owner["short_name"] = wanted_short_name
 
 
-def do_gps_config(
-    node: Node, config: Config, client: SerialInterface | TCPInterface
-) -> None:
+def plan_gps(plan: Plan, node: Node, config: Config) -> None:
+    """the fixed position, the rest of the GPS settings are in SECTIONS"""
     if config.gps is None:
-        logger.debug("no GPS config")
         return
 
-    logger.debug("Doing GPS config")
-    need_to_write_gps = False
-
-    if config.gps.fixed_position is not None:
-        if node.localConfig.position.fixed_position != config.gps.fixed_position:
+    position = node.localConfig.position
+    if (
+        config.gps.fixed_position is not None
+        and position.fixed_position != config.gps.fixed_position
+    ):
+        if config.gps.fixed_position:
             if config.gps.latitude is None or config.gps.longitude is None:
                 logger.error("Specify the lat/long in config for fixed position!")
                 sys.exit(1)
+            alt = config.gps.altitude if config.gps.altitude is not None else 0
+            plan.fixed_position = (config.gps.latitude, config.gps.longitude, int(alt))
+        plan.changes.append(
+            Change("position", "fixed_position", position.fixed_position, config.gps.fixed_position)
+        )
 
-            if config.gps.fixed_position:
-                # need to disable it, set position then re-enable it!
-                node.localConfig.position.fixed_position = False
-
-                logger.info("writing gps config")
-                node.writeConfig("position")
-                logger.debug("Waiting for reboot...")
-                time.sleep(2)
-                node.waitForConfig()
-                alt = config.gps.altitude if config.gps.altitude is not None else 0
-                logger.debug(
-                    "Setting position to lat: {}, long: {}, alt: {}",
-                    config.gps.latitude,
-                    config.gps.longitude,
-                    alt,
-                )
-                client.sendPosition(
-                    latitude=config.gps.latitude,
-                    longitude=config.gps.longitude,
-                    altitude=alt,
-                )
-
-            logger.debug("Setting fixed position to {}", config.gps.fixed_position)
-            node.localConfig.position.fixed_position = config.gps.fixed_position
-            need_to_write_gps = True
-
-        if config.gps.position_broadcast_smart_enabled is not None:
-            if (
-                node.localConfig.position.position_broadcast_smart_enabled
-                != config.gps.position_broadcast_smart_enabled
-            ):
-                logger.debug(
-                    "Setting position_broadcast_smart_enabled to {}",
-                    config.gps.position_broadcast_smart_enabled,
-                )
-                node.localConfig.position.position_broadcast_smart_enabled = (
-                    config.gps.position_broadcast_smart_enabled
-                )
-                need_to_write_gps = True
-
-        if need_to_write_gps:
-            logger.info("writing gps config")
-            node.writeConfig("position")
-            logger.debug("Waiting for reboot...")
-            time.sleep(2)
-            node.waitForConfig()
 
+def make_plan(node: Node, config: Config, client: Interface) -> Plan:
+    """diff the whole config against what's on the device"""
+    plan = Plan()
+    plan_owner(plan, config, client)
+    plan_sections(plan, node, config, client.getShortName())
+    plan_gps(plan, node, config)
+    return plan
+
+
+def get_field(message: Any, key: str) -> Any:
+    """a setting's value, copied so it can be kept in a Change"""
+    value = getattr(message, key)
+    field = message.DESCRIPTOR.fields_by_name[key]
+    if field.is_repeated:
+        return list(value)
+    if field.message_type is not None:
+        copy = type(value)()
+        copy.CopyFrom(value)
+        return copy
+    return value
+
+
+def set_field(message: Any, key: str, value: Any) -> None:
+    field = message.DESCRIPTOR.fields_by_name[key]
+    if field.is_repeated:
+        del getattr(message, key)[:]
+        getattr(message, key).extend(value)
+    elif field.message_type is not None:
+        getattr(message, key).CopyFrom(value)
+    else:
+        setattr(message, key, value)
 
-@click.command()
-@click.option("config_file", "--config", "-c", type=click.File("r"), required=False)
-@click.option("--host", "-h", type=str, required=False)
-@click.option("--serial", "-s", type=str, required=False)
-def main(
-    config_file: Optional[TextIO | BytesIO] = None,
-    host: Optional[str] = None,
-    serial: Optional[str] = None,
-) -> None:
 
-    if config_file is None:
-        config = Config.model_validate_json(
-            open("config.json", "r", encoding="utf-8").read()
+def apply_plan(node: Node, plan: Plan) -> None:
+    """write every change in one settings transaction, so the device only reboots once
+
+    Waiting for the reboot is up to the caller, see `wait_for_reboot`.
+    """
+    if not plan:
+        logger.info("Nothing to change")
+        return
+    node.beginSettingsTransaction()
+    if plan.owner:
+        node.setOwner(**plan.owner)
+    for change in plan.changes:
+        if change.section != "owner":
+            set_field(config_target(node, change.section), change.key, change.new)
+    if plan.fixed_position is not None:
+        latitude, longitude, altitude = plan.fixed_position
+        logger.debug(
+            "Setting position to lat: {}, long: {}, alt: {}", latitude, longitude, altitude
         )
-    else:
-        config = Config.model_validate_json(config_file.read())
-    logger.debug("Read config OK")
+        node.setFixedPosition(latitude, longitude, altitude)
+    for section in plan.sections:
+        logger.info("writing {} config", section)
+        node.writeConfig(section)
+    node.commitSettingsTransaction()
+
+
+def _strip_base64(value: Any) -> Any:
+    """export-config marks keys as "base64:...", protobuf's JSON has them as plain base64"""
+    if isinstance(value, dict):
+        return {key: _strip_base64(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_strip_base64(item) for item in value]
+    if isinstance(value, str) and value.startswith("base64:"):
+        return value[len("base64:") :]
+    return value
+
+
+class Compiled(BaseModel):
+    """a device's layered config, checked and turned into the protobufs that get written to it"""
+
+    model_config = ConfigDict(ser_json_bytes="base64", val_json_bytes="base64")
+
+    id: str
+    # the owner and fixed position, which aren't in the protobufs, and what
+    # configure.py has its own checks for
+    config: Config
+    local_config: bytes
+    module_config: bytes
+    # the settings the layers set in each section, by protobuf field name
+    fields: Dict[str, List[str]]
+    hash: str = ""
+
+    def digest(self) -> str:
+        return hashlib.sha256(self.model_dump_json(exclude={"hash"}).encode("utf-8")).hexdigest()
+
+    def protobufs(self) -> Tuple[Any, Any]:
+        """the LocalConfig and LocalModuleConfig"""
+        local = localonly_pb2.LocalConfig()
+        local.ParseFromString(self.local_config)
+        module = localonly_pb2.LocalModuleConfig()
+        module.ParseFromString(self.module_config)
+        return local, module
+
+
+def compile_layered(id: str, data: Dict[str, Any]) -> Compiled:
+    """validate a layered config (in `meshtastic --export-config` format) and compile it
+
+    Raises ValueError if it's not valid, for the protobuf schema or the Config model.
+    """
+    protobufs = {"config": localonly_pb2.LocalConfig(), "module_config": localonly_pb2.LocalModuleConfig()}
+    fields: Dict[str, List[str]] = {}
+    for key, message in protobufs.items():
+        sections = data.get(key) or {}
+        if not isinstance(sections, dict):
+            raise ValueError(f"{key} should be a mapping, not {type(sections).__name__}")
+        try:
+            json_format.ParseDict(_strip_base64(sections), message)
+        except json_format.ParseError as error:
+            raise ValueError(f"{key}: {error}") from error
+        # in the protobuf's order, so the hash doesn't depend on the YAML's
+        for section in message.DESCRIPTOR.fields:
+            values = sections.get(section.name, sections.get(section.json_name))
+            if section.message_type is not None and values is not None:
+                fields[section.name] = [
+                    field.name
+                    for field in section.message_type.fields
+                    if field.name in values or field.json_name in values
+                ]
+
+    local = protobufs["config"]
+    lora = local.lora
+    config: Dict[str, Any] = {"lora": {"region": lora.RegionCode.Name(lora.region)}}
+    if "modem_preset" in fields.get("lora", []):
+        config["lora"]["modem_preset"] = lora.ModemPreset.Name(lora.modem_preset)
+    if "owner" in data or "owner_short" in data:
+        config["owner"] = {"long_name": data.get("owner"), "short_name": data.get("owner_short")}
+    if "bluetooth" in fields:
+        config["bluetooth"] = {"enabled": local.bluetooth.enabled}
+    if "network" in fields:
+        config["network"] = {"wifi_enabled": local.network.wifi_enabled}
+    if local.position.fixed_position:
+        location = data.get("location") or {}
+        if "lat" not in location or "lon" not in location:
+            raise ValueError("position.fixedPosition is set, but there's no location lat/lon")
+        config["gps"] = {
+            "fixed_position": True,
+            "latitude": location["lat"],
+            "longitude": location["lon"],
+            "altitude": location.get("alt", 0),
+        }
+    elif "fixed_position" in fields.get("position", []):
+        config["gps"] = {"fixed_position": False}
+
+    compiled = Compiled(
+        id=id,
+        config=Config.model_validate(config),
+        local_config=local.SerializeToString(deterministic=True),
+        module_config=protobufs["module_config"].SerializeToString(deterministic=True),
+        fields=fields,
+    )
+    compiled.hash = compiled.digest()
+    return compiled
 
-    if host is not None:
-        logger.debug("Using TCPInterface({})", host)
-        client = TCPInterface(hostname=host)
-    else:
-        serial_port = serial if serial is not None else config.serial_port
-        logger.debug("Using Serial({})", serial_port)
-        client = SerialInterface(serial_port)
 
-    try:
-        client.getShortName()
-    except Exception:
-        logger.error("Failed to get shortname, probably not connected!")
-        return
+def load_compiled(path: Path) -> Compiled:
+    compiled = Compiled.model_validate_json(path.read_bytes())
+    if compiled.hash != compiled.digest():
+        raise ValueError(f"{path} has been changed since it was compiled")
+    return compiled
+
+
+def compile_fleet(config_dir: Path, write: bool = True) -> Dict[str, Optional[str]]:
+    """compile every layered-*.yml in a directory to a compiled-*.json
+
+    Returns the error for each id, or None if it compiled. Only the compiled
+    files that have changed are written.
+    """
+    import yaml
+
+    from meshtastic_tools.layer_configs import write_if_changed
+
+    errors: Dict[str, Optional[str]] = {}
+    for path in sorted(config_dir.glob("layered-*.yml")):
+        match = re.fullmatch(r"layered-(.+)\.yml", path.name)
+        if match is None:
+            continue
+        id = match.group(1)
+        try:
+            data = yaml.safe_load(path.read_bytes()) or {}
+            if not isinstance(data, dict):
+                raise ValueError("should be a mapping")
+            compiled = compile_layered(id, data)
+        except (OSError, ValueError, yaml.YAMLError) as error:
+            logger.error("{}: {}", path, error)
+            errors[id] = str(error)
+            continue
+        errors[id] = None
+        if write and write_if_changed(config_dir / f"compiled-{id}.json", compiled.model_dump_json()):
+            logger.info("Wrote compiled-{}.json ({})", id, compiled.hash[:12])
+    return errors
+
+
+def plan_compiled(node: Node, compiled: Compiled, client: Interface) -> Plan:
+    """diff a compiled config against what's on the device"""
+    plan = Plan()
+    plan_owner(plan, compiled.config, client)
+    local, module = compiled.protobufs()
+    for section, keys in compiled.fields.items():
+        source = getattr(module if section in MODULE_SECTIONS else local, section)
+        target = config_target(node, section)
+        for key in keys:
+            # see plan_gps
+            if section == "position" and key == "fixed_position":
+                continue
+            value = get_field(source, key)
+            oldvalue = get_field(target, key)
+            if oldvalue != value:
+                plan.changes.append(Change(section, key, oldvalue, value))
+    plan_gps(plan, node, compiled.config)
+    return plan
+
+
+def plan_device(node: Node, config: Config | Compiled, client: Interface) -> Plan:
+    if isinstance(config, Compiled):
+        return plan_compiled(node, config, client)
+    return make_plan(node, config, client)
+
+
+class Device(BaseModel):
+    """a device to provision, over TCP or serial
+
+    With neither a host nor a serial port, the serial port's auto-detected.
+    """
+
+    host: Optional[str] = None
+    serial: Optional[str] = None
+    # a compiled-*.json to use instead of the config
+    compiled: Optional[Path] = None
+
+    @model_validator(mode="after")
+    def one_connection(self) -> "Device":
+        if self.host is not None and self.serial is not None:
+            raise ValueError("A device needs a host or a serial port, but not both")
+        return self
+
+    @property
+    def name(self) -> str:
+        return self.host or self.serial or "auto-detected serial port"
 
-    device_name = client.getLongName()
-    short_name = client.getShortName()
-    logger.info("Device long name: {}", device_name)
-    # logger.info("Device short name: {}", short_name)
-    logger.info("Device info:\n{}", client.myInfo)
 
+class Inventory(BaseModel):
+    devices: List[Device]
+
+
+class Result(NamedTuple):
+    """how provisioning a device went"""
+
+    device: str
+    # planned, unchanged, applied, skipped or failed
+    status: str
+    changes: int
+    seconds: float
+    error: Optional[str] = None
+    # config sections that changed on the device since the last run
+    drifted: Tuple[str, ...] = ()
+
+
+def connect_device(device: Device) -> Interface:
+    """connecting blocks until the device has sent its config
+
+    The rest of the mesh's node database isn't needed to configure a device, and
+    on a busy mesh it's most of what gets downloaded, so it's not asked for.
+    """
+    if device.host is not None:
+        from meshtastic.tcp_interface import TCPInterface
+
+        logger.debug("Using TCPInterface({})", device.host)
+        return TCPInterface(hostname=device.host, noNodes=True)
+    from meshtastic.serial_interface import SerialInterface
+
+    # a devPath of None auto-detects the port
+    logger.debug("Using Serial({})", device.serial)
+    return SerialInterface(device.serial, noNodes=True)
+
+
+def config_hash(config: Config) -> str:
+    return hashlib.sha256(config.model_dump_json().encode("utf-8")).hexdigest()
+
+
+def section_hashes(client: Interface) -> Dict[str, str]:
+    """a hash of each config section on the device, and of its owner names"""
     node = client.localNode
+    sections = {}
+    for message in (node.localConfig, node.moduleConfig):
+        for field in message.DESCRIPTOR.fields:
+            # version is the protobuf schema's, not a setting
+            if field.message_type is None:
+                continue
+            data = getattr(message, field.name).SerializeToString(deterministic=True)
+            sections[field.name] = hashlib.sha256(data).hexdigest()
+    owner = f"{client.getLongName()}\0{client.getShortName()}".encode("utf-8")
+    sections["owner"] = hashlib.sha256(owner).hexdigest()
+    return sections
+
+
+class Snapshot(BaseModel):
+    """what a device looked like after the last successful run, and what it was asked for"""
+
+    node_num: int
+    # config_hash of the Config that was applied, or the Compiled hash
+    desired: str
+    sections: Dict[str, str]
+    saved: float
+
+    def drifted(self, current: "Snapshot") -> Tuple[str, ...]:
+        """the sections that are different on the device now"""
+        names = sorted(self.sections.keys() | current.sections.keys())
+        return tuple(name for name in names if self.sections.get(name) != current.sections.get(name))
+
+
+def take_snapshot(client: Interface, desired: str) -> Snapshot:
+    return Snapshot(
+        node_num=client.localNode.nodeNum,
+        desired=desired,
+        sections=section_hashes(client),
+        saved=time.time(),
+    )
+
 
-    logger.debug("Waiting for config...")
-    node.waitForConfig()
+class SnapshotStore:
+    """a JSON file per node number, with the last snapshot of that device"""
 
-    do_owner_config(node, config, client)
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
 
-    do_lora_config(node, config)
+    def path(self, node_num: int) -> Path:
+        return self.directory / f"{node_num:08x}.json"
 
-    do_mqtt_config(node, config, short_name)
+    def load(self, node_num: int) -> Optional[Snapshot]:
+        try:
+            return Snapshot.model_validate_json(self.path(node_num).read_bytes())
+        except (OSError, ValueError) as error:
+            if not isinstance(error, FileNotFoundError):
+                logger.warning("Ignoring snapshot for {:08x}: {}", node_num, error)
+            return None
+
+    def save(self, snapshot: Snapshot) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as handle:
+                handle.write(snapshot.model_dump_json())
+            os.replace(temp, self.path(snapshot.node_num))
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+
+class ConnectionEvents:
+    """meshtastic's connection lost/established events for one interface"""
+
+    def __init__(self, interface: Interface) -> None:
+        self.interface = interface
+        self.lost = threading.Event()
+        pub.subscribe(self._on_lost, "meshtastic.connection.lost")
+
+    def _on_lost(self, interface: Any) -> None:
+        if interface is self.interface:
+            self.lost.set()
+
+    def close(self) -> None:
+        pub.unsubscribe(self._on_lost, "meshtastic.connection.lost")
+
+
+def reconnect(
+    client: Interface,
+    device: Device,
+    connect: Callable[[Device], Interface],
+    timeout: float,
+) -> Interface:
+    """close the connection and open a new one, retrying for up to `timeout` seconds
+
+    A new connection downloads the device's config again, rather than trusting
+    the copy that was changed in memory before it was written.
+    """
+    client.close()
+    deadline = time.monotonic() + timeout
+    backoff = 0.5
+    while True:
+        try:
+            return connect(device)
+        except Exception as error:
+            if time.monotonic() + backoff > deadline:
+                raise TimeoutError(f"{device.name} didn't come back: {error}") from error
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10.0)
+
+
+def wait_for_reboot(
+    client: Interface,
+    events: ConnectionEvents,
+    device: Device,
+    connect: Callable[[Device], Interface],
+    timeout: float,
+) -> Interface:
+    """wait for the device to drop the connection, then reconnect once it's back
+
+    Returns the new connection. If the device doesn't drop the connection within
+    the timeout it's assumed it didn't need to reboot, and it's reconnected to
+    anyway so what it saved can be checked.
+    """
+    if events.lost.wait(timeout):
+        logger.debug("{} is rebooting", device.name)
+    else:
+        logger.debug("{} didn't reboot", device.name)
+    return reconnect(client, device, connect, timeout)
+
+
+def provision(
+    device: Device,
+    config: Optional[Config],
+    plan_only: bool = False,
+    connect: Callable[[Device], Interface] = connect_device,
+    reboot_timeout: float = 60.0,
+    snapshots: Optional[SnapshotStore] = None,
+) -> Result:
+    """plan and apply the config on one device, any failure ends up in the Result
+
+    With `snapshots`, a device that hasn't changed since it was last given this
+    config is skipped without planning anything.
+    """
+    start = time.monotonic()
+    client: Optional[Interface] = None
+    changes = 0
+    drifted: Tuple[str, ...] = ()
+    try:
+        target: Config | Compiled
+        if device.compiled is not None:
+            target = load_compiled(device.compiled)
+            desired = target.hash
+        elif config is not None:
+            target = config
+            desired = config_hash(config)
+        else:
+            raise ValueError("No config for this device")
+        client = connect(device)
+        logger.info("{}: {}", device.name, client.getLongName())
+        node = client.localNode
+        node.waitForConfig()
+
+        current = take_snapshot(client, desired)
+        previous = snapshots.load(current.node_num) if snapshots is not None else None
+        if previous is not None:
+            drifted = previous.drifted(current)
+            if drifted:
+                logger.warning("{}: changed since the last run: {}", device.name, ", ".join(drifted))
+            elif previous.desired == desired:
+                return Result(device.name, "skipped", 0, time.monotonic() - start)
+
+        plan = plan_device(node, target, client)
+        changes = len(plan.changes)
+        for line in plan.describe():
+            logger.info("{}: plan: {}", device.name, line)
+        if plan_only or not plan:
+            if snapshots is not None and not plan:
+                snapshots.save(current)
+            status = "planned" if plan else "unchanged"
+            return Result(device.name, status, changes, time.monotonic() - start, drifted=drifted)
+
+        events = ConnectionEvents(client)
+        try:
+            apply_plan(node, plan)
+            if plan.needs_reboot:
+                client = wait_for_reboot(client, events, device, connect, reboot_timeout)
+            else:
+                client = reconnect(client, device, connect, reboot_timeout)
+        finally:
+            events.close()
+        if plan_device(client.localNode, target, client).sections:
+            raise RuntimeError("Some settings didn't stick after the reboot")
+        if snapshots is not None:
+            snapshots.save(take_snapshot(client, desired))
+        return Result(device.name, "applied", changes, time.monotonic() - start, drifted=drifted)
+    except (Exception, SystemExit) as error:
+        logger.error("{}: {}", device.name, error)
+        return Result(
+            device.name,
+            "failed",
+            changes,
+            time.monotonic() - start,
+            str(error) or type(error).__name__,
+            drifted,
+        )
+    finally:
+        if client is not None:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+
+def provision_fleet(
+    devices: List[Device],
+    config: Optional[Config],
+    jobs: int = 8,
+    plan_only: bool = False,
+    connect: Callable[[Device], Interface] = connect_device,
+    reboot_timeout: float = 60.0,
+    snapshots: Optional[SnapshotStore] = None,
+) -> List[Result]:
+    """provision devices concurrently, `jobs` at a time, with the results in inventory order"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        return list(
+            pool.map(
+                lambda device: provision(device, config, plan_only, connect, reboot_timeout, snapshots),
+                devices,
+            )
+        )
 
-    do_network_config(node, config)
 
-    do_bluetooth_config(node, config)
+def summarise(results: List[Result]) -> List[str]:
+    """a line per device and the totals, for the end of a run"""
+    lines = [
+        f"{result.device}: {result.status}, {result.changes} changes in {result.seconds:.1f}s"
+        + (f" - {result.error}" if result.error else "")
+        + (f" (changed since the last run: {', '.join(result.drifted)})" if result.drifted else "")
+        for result in results
+    ]
+    counts: Dict[str, int] = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    lines.append(", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return lines
 
-    do_gps_config(node, config, client)
+
+@click.command()
+@click.option("config_file", "--config", "-c", type=click.File("r"), required=False)
+@click.option("--host", "-h", type=str, required=False)
+@click.option("--serial", "-s", type=str, required=False)
+@click.option("--plan", "plan_only", is_flag=True, help="Show what would change, without changing it")
+@click.option(
+    "--inventory",
+    "-i",
+    type=click.File("r"),
+    help='JSON list of devices to provision, eg {"devices": [{"host": "10.0.0.5"}, {"serial": "/dev/ttyUSB0"}]}',
+)
+@click.option("--jobs", "-j", type=int, default=8, help="Devices to provision at once with --inventory")
+@click.option("--reboot-timeout", type=float, default=60.0, help="Seconds to wait for a device to reboot")
+@click.option(
+    "--snapshot-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=Path(".device-snapshots"),
+    help="Where to keep each device's config from the last run",
+)
+@click.option("--no-snapshots", is_flag=True, help="Plan every device, even if it hasn't changed")
+@click.option(
+    "compile_dir",
+    "--compile",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="Validate and compile every layered-*.yml in this directory, without connecting to anything",
+)
+@click.option("--check", is_flag=True, help="With --compile, only validate, don't write compiled-*.json")
+@click.option(
+    "--compiled",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Apply a compiled-*.json to --host or --serial instead of the config",
+)
+def main(
+    config_file: Optional[TextIO | BytesIO] = None,
+    host: Optional[str] = None,
+    serial: Optional[str] = None,
+    plan_only: bool = False,
+    inventory: Optional[TextIO] = None,
+    jobs: int = 8,
+    reboot_timeout: float = 60.0,
+    snapshot_dir: Path = Path(".device-snapshots"),
+    no_snapshots: bool = False,
+    compile_dir: Optional[Path] = None,
+    check: bool = False,
+    compiled: Optional[Path] = None,
+) -> None:
+
+    if compile_dir is not None:
+        errors = compile_fleet(compile_dir, write=not check)
+        failed = sorted(id for id, error in errors.items() if error is not None)
+        logger.info("{} compiled, {} failed", len(errors) - len(failed), len(failed))
+        if failed or not errors:
+            sys.exit(1)
+        return
+
+    def read_config() -> Config:
+        if config_file is None:
+            config = Config.model_validate_json(
+                open("config.json", "r", encoding="utf-8").read()
+            )
+        else:
+            config = Config.model_validate_json(config_file.read())
+        logger.debug("Read config OK")
+        return config
+
+    config = None
+    if inventory is not None:
+        devices = Inventory.model_validate_json(inventory.read()).devices
+    elif host is not None:
+        devices = [Device(host=host, compiled=compiled)]
+    elif compiled is not None:
+        devices = [Device(serial=serial, compiled=compiled)]
+    else:
+        config = read_config()
+        devices = [Device(serial=serial if serial is not None else config.serial_port)]
+    if config is None and any(device.compiled is None for device in devices):
+        config = read_config()
+
+    snapshots = None if no_snapshots else SnapshotStore(snapshot_dir)
+    results = provision_fleet(
+        devices, config, jobs, plan_only, reboot_timeout=reboot_timeout, snapshots=snapshots
+    )
+    for line in summarise(results):
+        logger.info(line)
+    if any(result.status == "failed" for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
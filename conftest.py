@@ -0,0 +1,79 @@
+""" fixtures and builders shared between the tests """
+
+import base64
+from typing import Optional
+
+import pytest
+from meshtastic import mesh_pb2, mqtt_pb2, portnums_pb2  # type: ignore
+
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.keyring import Keyring
+from meshtastic_tools.nodedb import NodeDirectory
+from meshtastic_tools.sinks import StdoutSink
+from meshtastic_tools.traffic import TrafficGenerator
+
+
+class FakeClock:
+    """ a clock that only moves when the test sets `now` """
+
+    def __init__(self, now: float = 1000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def envelope(
+    from_id: int = 0x12345678,
+    packet_id: int = 0,
+    gateway_id: str = "!050c2e68",
+    rssi: int = 0,
+    portnum: int = portnums_pb2.PortNum.TEXT_MESSAGE_APP,
+    payload: bytes = b"hello",
+    keyring: Optional[Keyring] = None,
+) -> bytes:
+    """ a broadcast ServiceEnvelope on LongFast, encrypted if there's a `keyring` """
+    se = mqtt_pb2.ServiceEnvelope(channel_id="LongFast", gateway_id=gateway_id)
+    setattr(se.packet, "from", from_id)
+    se.packet.id = packet_id
+    se.packet.to = 0xFFFFFFFF
+    se.packet.rx_rssi = rssi
+    data = mesh_pb2.Data(portnum=portnum, payload=payload)
+    if keyring is None:
+        se.packet.decoded.CopyFrom(data)
+    else:
+        se.packet.channel = 8
+        se.packet.encrypted = keyring.candidates(8)[0].decrypt(
+            packet_id, from_id, data.SerializeToString()
+        )
+    result: bytes = se.SerializeToString()
+    return result
+
+
+def envelope_lines(count: int) -> list[bytes]:
+    """ base64'd envelopes a line each, some of them undecryptable """
+    generator = TrafficGenerator(
+        seed=5,
+        mix={"POSITION_APP": 1, "TEXT_MESSAGE_APP": 1},
+        duplicate_rate=0,
+        undecryptable_rate=0.2,
+    )
+    return [base64.b64encode(payload) + b"\n" for _, payload in generator.stream(count)]
+
+
+@pytest.fixture(autouse=True)
+def decoder_globals(monkeypatch: pytest.MonkeyPatch) -> None:
+    """ every test starts with the decoder's module globals as they are on import
+
+    Decoding a NODEINFO updates NODES, and the tests swap in their own dedup
+    index, filters and so on, none of which should leak into the next test.
+    """
+    monkeypatch.setattr(mqtt_parser, "NODES", NodeDirectory())
+    monkeypatch.setattr(mqtt_parser, "KEYRING", Keyring.default())
+    monkeypatch.setattr(mqtt_parser, "DEDUP", None)
+    monkeypatch.setattr(mqtt_parser, "FILTER", None)
+    monkeypatch.setattr(mqtt_parser, "AGGREGATES", None)
+    monkeypatch.setattr(mqtt_parser, "OUTPUT_FORMAT", "json")
+    monkeypatch.setattr(mqtt_parser, "ROUTE", False)
+    monkeypatch.setattr(mqtt_parser, "SINK", StdoutSink())
+    monkeypatch.setattr(mqtt_parser, "DEFAULT_TOPICS", list(mqtt_parser.DEFAULT_TOPICS))
@@ -0,0 +1,470 @@
+""" running aggregates over the decoded packets - rates, positions, telemetry and links
+
+Everything is kept in preallocated arrays indexed by a slot number, so memory
+doesn't grow with the number of nodes heard. Once the slots are full a new
+node takes over the least recently heard slot out of a small sample, like
+Redis' approximate LRU, rather than keeping an exact LRU order.
+
+Packet counts go into fixed-size time buckets, `buckets` of `bucket_seconds`
+each, which are reused as time moves on.
+"""
+
+import json
+import math
+import os
+from array import array
+from pathlib import Path
+import time
+from typing import Any, Callable, Iterator, Optional
+
+from meshtastic import portnums_pb2  # type: ignore
+
+from meshtastic_tools.dedup import packet_key
+from meshtastic_tools.geo import SpatialIndex
+
+# how many slots to look at when picking one to evict
+EVICTION_SAMPLE = 8
+
+_NAN = float("nan")
+
+# looking these up on the enum wrapper every packet is surprisingly slow
+_POSITION_APP = portnums_pb2.PortNum.POSITION_APP
+_TELEMETRY_APP = portnums_pb2.PortNum.TELEMETRY_APP
+_NEIGHBORINFO_APP = portnums_pb2.PortNum.NEIGHBORINFO_APP
+_TRACEROUTE_APP = portnums_pb2.PortNum.TRACEROUTE_APP
+
+
+def gateway_num(gateway_id: str) -> Optional[int]:
+    """ gateway ids look like !050c2e68 """
+    try:
+        return int(gateway_id.removeprefix("!"), 16)
+    except ValueError:
+        return None
+
+
+def _mean(total: float, count: int) -> Optional[float]:
+    return round(total / count, 2) if count else None
+
+
+def _value(value: float) -> Optional[float]:
+    """ NaN means we haven't had one """
+    return None if math.isnan(value) else value
+
+
+def _reported(metrics: Any, name: str) -> float:
+    """ the metric, or NaN if the node left it out rather than it being 0 """
+    return float(getattr(metrics, name)) if metrics.HasField(name) else _NAN
+
+
+class _Slots:
+    """ maps keys to a fixed number of slots, evicting the least recently seen """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.keys = array("Q", bytes(8 * capacity))
+        self.last_seen = array("d", bytes(8 * capacity))
+        self.index: dict[int, int] = {}
+        # the key the last call to slot() pushed out, if any
+        self.evicted: Optional[int] = None
+        self._hand = 0
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, key: int) -> Optional[int]:
+        return self.index.get(key)
+
+    def slot(self, key: int, now: float) -> tuple[int, bool]:
+        """ the key's slot, and whether it's a new (or reused) one """
+        self.evicted = None
+        slot = self.index.get(key)
+        if slot is not None:
+            if now > self.last_seen[slot]:
+                self.last_seen[slot] = now
+            return slot, False
+        if len(self.index) < self.capacity:
+            slot = len(self.index)
+        else:
+            slot = self._hand
+            for offset in range(1, EVICTION_SAMPLE):
+                candidate = (self._hand + offset) % self.capacity
+                if self.last_seen[candidate] < self.last_seen[slot]:
+                    slot = candidate
+            self._hand = (self._hand + EVICTION_SAMPLE) % self.capacity
+            self.evicted = self.keys[slot]
+            del self.index[self.evicted]
+        self.keys[slot] = key
+        self.last_seen[slot] = now
+        self.index[key] = slot
+        return slot, True
+
+
+class _Links:
+    """ running signal stats for pairs of nodes, eg gateway -> node """
+
+    def __init__(self, capacity: int) -> None:
+        self.slots = _Slots(capacity)
+        self.count = array("I", bytes(4 * capacity))
+        self.snr_sum = array("d", bytes(8 * capacity))
+        self.rssi_sum = array("d", bytes(8 * capacity))
+
+    def add(self, first: int, second: int, now: float, snr: float, rssi: float = 0.0) -> None:
+        slot, new = self.slots.slot(packet_key(first, second), now)
+        if new:
+            self.count[slot] = 0
+            self.snr_sum[slot] = 0.0
+            self.rssi_sum[slot] = 0.0
+        self.count[slot] += 1
+        self.snr_sum[slot] += snr
+        self.rssi_sum[slot] += rssi
+
+    def __iter__(self) -> Iterator[tuple[int, int, int]]:
+        """ (first, second, slot) """
+        for key, slot in self.slots.index.items():
+            yield key >> 32, key & 0xFFFFFFFF, slot
+
+
+class Aggregator:
+    """ incremental per-node and per-link aggregates
+
+    - `reception` is called for every copy of a packet, including duplicates,
+      and records the gateway -> node signal for packets heard directly
+    - `packet` is called once per decoded packet, with its payload, and updates
+      packet rates, positions, telemetry and the NEIGHBORINFO/TRACEROUTE edges
+    - `snapshot` and the other query methods read it all back, and `spatial`
+      answers questions about where nodes are
+    """
+
+    def __init__(
+        self,
+        capacity: int = 65536,
+        link_capacity: int = 131072,
+        bucket_seconds: float = 60.0,
+        buckets: int = 60,
+        path: Optional[Path] = None,
+        save_interval: float = 60.0,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.capacity = capacity
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.path = path
+        self.save_interval = save_interval
+        self.clock = clock
+        self._last_save = clock()
+
+        self.nodes = _Slots(capacity)
+        self.packets = array("Q", bytes(8 * capacity))
+        self.latitude = array("d", [_NAN]) * capacity
+        self.longitude = array("d", [_NAN]) * capacity
+        self.altitude = array("i", bytes(4 * capacity))
+        self.precision_bits = array("B", bytes(capacity))
+        self.position_time = array("d", bytes(8 * capacity))
+        self.battery_level = array("d", [_NAN]) * capacity
+        self.voltage = array("d", [_NAN]) * capacity
+        self.channel_utilization = array("d", [_NAN]) * capacity
+        self.air_util_tx = array("d", [_NAN]) * capacity
+        self.telemetry_time = array("d", bytes(8 * capacity))
+
+        # bucket major, so a bucket can be cleared with one slice assignment
+        self.counts = array("I", bytes(4 * capacity * buckets))
+        self.bucket_epochs = array("q", [-1]) * buckets
+        # per bucket, for the whole mesh
+        self.portnum_counts: dict[int, array[int]] = {}
+        self.utilization_sum = array("d", bytes(8 * buckets))
+        self.utilization_count = array("I", bytes(4 * buckets))
+
+        self.gateway_links = _Links(link_capacity)
+        self.edges = _Links(link_capacity)
+        self.spatial = SpatialIndex()
+
+    def _bucket(self, now: float) -> Optional[int]:
+        """ the bucket for a time, clearing it out if it's being reused """
+        epoch = int(now // self.bucket_seconds)
+        bucket = epoch % self.buckets
+        current = self.bucket_epochs[bucket]
+        if current == epoch:
+            return bucket
+        if current > epoch:
+            # older than anything we're keeping
+            return None
+        start = bucket * self.capacity
+        self.counts[start : start + self.capacity] = array("I", bytes(4 * self.capacity))
+        for counts in self.portnum_counts.values():
+            counts[bucket] = 0
+        self.utilization_sum[bucket] = 0.0
+        self.utilization_count[bucket] = 0
+        self.bucket_epochs[bucket] = epoch
+        return bucket
+
+    def _node(self, num: int, now: float) -> int:
+        slot, new = self.nodes.slot(num, now)
+        if new:
+            self._clear(slot)
+            if self.nodes.evicted is not None:
+                self.spatial.remove(self.nodes.evicted)
+        return slot
+
+    def _clear(self, slot: int) -> None:
+        self.packets[slot] = 0
+        self.latitude[slot] = _NAN
+        self.longitude[slot] = _NAN
+        self.altitude[slot] = 0
+        self.precision_bits[slot] = 0
+        self.position_time[slot] = 0.0
+        self.battery_level[slot] = _NAN
+        self.voltage[slot] = _NAN
+        self.channel_utilization[slot] = _NAN
+        self.air_util_tx[slot] = _NAN
+        self.telemetry_time[slot] = 0.0
+        for bucket in range(self.buckets):
+            self.counts[bucket * self.capacity + slot] = 0
+
+    def reception(self, se: Any, now: Optional[float] = None) -> None:
+        """ a gateway heard a packet, only direct receptions say anything about the link """
+        gateway = gateway_num(se.gateway_id)
+        if gateway is None:
+            return
+        self.spatial.mark_gateway(gateway)
+        mp = se.packet
+        if mp.hop_start == 0 or mp.hop_limit != mp.hop_start or mp.rx_rssi == 0:
+            return
+        now = self.clock() if now is None else now
+        self.gateway_links.add(gateway, getattr(mp, "from"), now, mp.rx_snr, mp.rx_rssi)
+
+    def packet(self, mp: Any, payload: Any, now: Optional[float] = None) -> None:
+        """ a decoded MeshPacket and its parsed payload (None if it hasn't got one) """
+        now = self.clock() if now is None else now
+        from_num = getattr(mp, "from")
+        slot = self._node(from_num, now)
+        self.packets[slot] += 1
+        portnum = mp.decoded.portnum
+        bucket = self._bucket(now)
+        if bucket is not None:
+            self.counts[bucket * self.capacity + slot] += 1
+            counts = self.portnum_counts.get(portnum)
+            if counts is None:
+                counts = self.portnum_counts[portnum] = array("I", bytes(4 * self.buckets))
+            counts[bucket] += 1
+        if payload is None:
+            return
+
+        if portnum == _POSITION_APP:
+            if payload.latitude_i or payload.longitude_i:
+                self.latitude[slot] = payload.latitude_i * 1e-7
+                self.longitude[slot] = payload.longitude_i * 1e-7
+                self.altitude[slot] = payload.altitude
+                self.precision_bits[slot] = payload.precision_bits
+                self.position_time[slot] = now
+                self.spatial.update(
+                    from_num,
+                    self.latitude[slot],
+                    self.longitude[slot],
+                    payload.precision_bits,
+                )
+        elif portnum == _TELEMETRY_APP:
+            if payload.HasField("device_metrics"):
+                metrics = payload.device_metrics
+                self.battery_level[slot] = _reported(metrics, "battery_level")
+                self.voltage[slot] = _reported(metrics, "voltage")
+                self.channel_utilization[slot] = _reported(metrics, "channel_utilization")
+                self.air_util_tx[slot] = _reported(metrics, "air_util_tx")
+                self.telemetry_time[slot] = now
+                if bucket is not None and metrics.HasField("channel_utilization"):
+                    self.utilization_sum[bucket] += metrics.channel_utilization
+                    self.utilization_count[bucket] += 1
+        elif portnum == _NEIGHBORINFO_APP:
+            node_id = payload.node_id or from_num
+            for neighbor in payload.neighbors:
+                self._edge(node_id, neighbor.node_id, now, neighbor.snr)
+        elif portnum == _TRACEROUTE_APP:
+            if mp.decoded.request_id:
+                # a reply, so the route's complete in both directions
+                towards = [mp.to, *payload.route, from_num]
+                back = [from_num, *payload.route_back, mp.to]
+                self._route(towards, payload.snr_towards, now)
+                self._route(back, payload.snr_back, now)
+            else:
+                self._route([from_num, *payload.route], payload.snr_towards, now)
+
+    def _route(self, path: list[int], snrs: Any, now: float) -> None:
+        # SNRs in traceroutes are in quarter dB, unknown is -128
+        for hop, (first, second) in enumerate(zip(path, path[1:])):
+            if hop >= len(snrs) or snrs[hop] == -128:
+                continue
+            self._edge(first, second, now, snrs[hop] / 4)
+
+    def _edge(self, first: int, second: int, now: float, snr: float) -> None:
+        # edges go both ways, so store them lowest node first
+        self.edges.add(min(first, second), max(first, second), now, snr)
+
+    def maybe_save(self) -> None:
+        """ save a snapshot if there's a path and it's been long enough """
+        if self.path is not None and self.clock() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self, path: Optional[Path] = None) -> None:
+        """ write the snapshot to a JSON file, replacing it atomically """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to save the aggregates to")
+        self._last_save = self.clock()
+        temp_path = path.with_name(f"{path.name}.tmp")
+        temp_path.write_text(json.dumps(self.snapshot()))
+        os.replace(temp_path, path)
+
+    # queries
+
+    def _buckets_in(self, window: float, now: float) -> list[int]:
+        """ the buckets covering the last `window` seconds """
+        current = int(now // self.bucket_seconds)
+        oldest = current - max(1, math.ceil(window / self.bucket_seconds)) + 1
+        return [
+            bucket
+            for bucket in range(self.buckets)
+            if oldest <= self.bucket_epochs[bucket] <= current
+        ]
+
+    def packet_count(self, num: int, window: float, now: Optional[float] = None) -> int:
+        """ packets from a node in the last `window` seconds, to the bucket """
+        slot = self.nodes.get(num)
+        if slot is None:
+            return 0
+        now = self.clock() if now is None else now
+        return sum(
+            self.counts[bucket * self.capacity + slot]
+            for bucket in self._buckets_in(window, now)
+        )
+
+    def top_talkers(
+        self, limit: int = 10, window: float = 300.0, now: Optional[float] = None
+    ) -> list[tuple[int, int]]:
+        """ the (node, packets) sending the most in the last `window` seconds """
+        now = self.clock() if now is None else now
+        used = len(self.nodes)
+        totals = array("Q", bytes(8 * used))
+        for bucket in self._buckets_in(window, now):
+            start = bucket * self.capacity
+            for slot, count in enumerate(self.counts[start : start + used]):
+                if count:
+                    totals[slot] += count
+        keys = self.nodes.keys
+        ranked = sorted(
+            (slot for slot in range(used) if totals[slot]),
+            key=totals.__getitem__,
+            reverse=True,
+        )
+        return [(keys[slot], totals[slot]) for slot in ranked[:limit]]
+
+    def portnum_rates(self, window: float = 300.0, now: Optional[float] = None) -> dict[str, float]:
+        """ packets per second for each portnum, across the mesh """
+        now = self.clock() if now is None else now
+        buckets = self._buckets_in(window, now)
+        seconds = max(len(buckets), 1) * self.bucket_seconds
+        return {
+            portnums_pb2.PortNum.Name(portnum): round(
+                sum(counts[bucket] for bucket in buckets) / seconds, 4
+            )
+            for portnum, counts in self.portnum_counts.items()
+        }
+
+    def channel_utilization_history(self, now: Optional[float] = None) -> list[tuple[float, float]]:
+        """ (bucket start, mean reported channel utilization), oldest first """
+        now = self.clock() if now is None else now
+        result = []
+        for bucket in self._buckets_in(self.buckets * self.bucket_seconds, now):
+            count = self.utilization_count[bucket]
+            if count:
+                result.append(
+                    (
+                        self.bucket_epochs[bucket] * self.bucket_seconds,
+                        round(self.utilization_sum[bucket] / count, 2),
+                    )
+                )
+        return sorted(result)
+
+    def node(self, num: int, window: float = 300.0, now: Optional[float] = None) -> Optional[dict[str, Any]]:
+        """ everything we know about one node """
+        slot = self.nodes.get(num)
+        if slot is None:
+            return None
+        result: dict[str, Any] = {
+            "num": num,
+            "last_heard": self.nodes.last_seen[slot],
+            "packets": self.packets[slot],
+            "recent_packets": self.packet_count(num, window, now),
+        }
+        if self.position_time[slot]:
+            result["position"] = {
+                "latitude": round(self.latitude[slot], 7),
+                "longitude": round(self.longitude[slot], 7),
+                "altitude": self.altitude[slot],
+                "precision_bits": self.precision_bits[slot],
+                "time": self.position_time[slot],
+            }
+        if self.telemetry_time[slot]:
+            result["telemetry"] = {
+                "battery_level": _value(self.battery_level[slot]),
+                "voltage": _value(round(self.voltage[slot], 3)),
+                "channel_utilization": _value(round(self.channel_utilization[slot], 2)),
+                "air_util_tx": _value(round(self.air_util_tx[slot], 2)),
+                "time": self.telemetry_time[slot],
+            }
+        return result
+
+    def gateways_for(self, num: int) -> list[dict[str, Any]]:
+        """ the gateways that have heard a node directly, best SNR first """
+        links = self.gateway_links
+        result = [
+            {
+                "gateway": gateway,
+                "count": links.count[slot],
+                "rssi": _mean(links.rssi_sum[slot], links.count[slot]),
+                "snr": _mean(links.snr_sum[slot], links.count[slot]),
+                "last_heard": links.slots.last_seen[slot],
+            }
+            for gateway, node, slot in links
+            if node == num
+        ]
+        return sorted(result, key=lambda link: link["snr"] or 0, reverse=True)
+
+    def snapshot(self, window: float = 300.0) -> dict[str, Any]:
+        """ all the aggregates, as something that can be turned into JSON """
+        now = self.clock()
+        nodes = {}
+        for num in list(self.nodes.index):
+            node = self.node(num, window, now)
+            if node is not None:
+                nodes[f"{num:08x}"] = node
+        links = self.gateway_links
+        edges = self.edges
+        return {
+            "time": now,
+            "window": window,
+            "nodes": nodes,
+            "top_talkers": [
+                {"num": f"{num:08x}", "packets": count}
+                for num, count in self.top_talkers(10, window, now)
+            ],
+            "portnum_rates": self.portnum_rates(window, now),
+            "channel_utilization": self.channel_utilization_history(now),
+            "gateway_links": [
+                {
+                    "gateway": f"{gateway:08x}",
+                    "node": f"{node:08x}",
+                    "count": links.count[slot],
+                    "rssi": _mean(links.rssi_sum[slot], links.count[slot]),
+                    "snr": _mean(links.snr_sum[slot], links.count[slot]),
+                }
+                for gateway, node, slot in links
+            ],
+            "edges": [
+                {
+                    "a": f"{first:08x}",
+                    "b": f"{second:08x}",
+                    "count": edges.count[slot],
+                    "snr": _mean(edges.snr_sum[slot], edges.count[slot]),
+                }
+                for first, second, slot in edges
+            ],
+        }
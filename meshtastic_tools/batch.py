@@ -0,0 +1,276 @@
+""" decode captured ServiceEnvelopes in bulk, returning columns rather than printing """
+
+import base64
+import binascii
+import struct
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional
+
+from meshtastic import BROADCAST_NUM, mqtt_pb2, portnums_pb2, protocols  # type: ignore
+
+from meshtastic_tools.filters import PacketFilter
+from meshtastic_tools.keyring import Keyring
+from meshtastic_tools.serializer import message_to_dict
+
+# captures are a big-endian u32 length followed by the ServiceEnvelope
+LENGTH_PREFIX = struct.Struct(">I")
+
+COLUMNS = (
+    "from",
+    "to",
+    "id",
+    "channel",
+    "channel_id",
+    "gateway_id",
+    "portnum",
+    "rx_time",
+    "rx_rssi",
+    "rx_snr",
+    "hop_limit",
+    "hop_start",
+    "payload",
+)
+
+
+def packet_message(
+    channel: int,
+    from_num: int,
+    to_num: int,
+    portnum: int,
+    payload: Any = None,
+    short_name: Optional[str] = None,
+) -> dict[str, Any]:
+    """ the dict a decoded packet's output as, live or from a capture
+
+    `payload` is the payload's protobuf through message_to_dict, or the raw
+    bytes for portnums without one. `short_name` is the sender's, if known.
+    """
+    if portnum == portnums_pb2.PortNum.NODEINFO_APP and isinstance(payload, dict):
+        # the node's telling us its name
+        from_id = f"{from_num:x}[{payload.get('shortName', '')}]"
+    elif short_name is not None:
+        from_id = f"{from_num:08x}[{short_name}]"
+    else:
+        from_id = f"{from_num:08x}"
+    message = {
+        "channel": channel,
+        "from_id": from_id,
+        "to_id": "all" if to_num == BROADCAST_NUM else f"{to_num:08x}",
+        "portnum": portnums_pb2.PortNum.Name(portnum),
+    }
+    if isinstance(payload, dict):
+        message.update(payload)
+    elif payload is not None:
+        message["payload"] = payload
+    return message
+
+
+class DecodedBatch:
+    """ a batch of decoded packets, stored as one list per column """
+
+    def __init__(self) -> None:
+        self.columns: dict[str, list[Any]] = {name: [] for name in COLUMNS}
+        self.parse_errors = 0
+        self.undecryptable = 0
+        self.unhandled = 0
+        self.filtered = 0
+
+    def __len__(self) -> int:
+        return len(self.columns["from"])
+
+    def portnum_names(self) -> list[str]:
+        """ the portnum column as names, eg POSITION_APP """
+        return [portnums_pb2.PortNum.Name(value) for value in self.columns["portnum"]]
+
+    def rows(self) -> Iterator[dict[str, Any]]:
+        """ iterate over the batch a row at a time """
+        names = list(self.columns)
+        for row in zip(*self.columns.values()):
+            yield dict(zip(names, row))
+
+    def messages(self) -> Iterator[dict[str, Any]]:
+        """ the packets as the live decoder outputs them, see `packet_message` """
+        columns = self.columns
+        for values in zip(
+            columns["channel"],
+            columns["from"],
+            columns["to"],
+            columns["portnum"],
+            columns["payload"],
+            strict=True,
+        ):
+            yield packet_message(*values)
+
+    def to_numpy(self) -> dict[str, Any]:
+        """ the numeric columns as NumPy arrays, needs numpy installed """
+        try:
+            import numpy as np  # type: ignore[import-not-found,unused-ignore]
+        except ImportError as error:
+            raise ImportError("to_numpy needs numpy, pip install numpy") from error
+
+        dtypes = {
+            "from": np.uint32,
+            "to": np.uint32,
+            "id": np.uint32,
+            "channel": np.uint32,
+            "portnum": np.uint16,
+            "rx_time": np.uint32,
+            "rx_rssi": np.int32,
+            "rx_snr": np.float32,
+            "hop_limit": np.uint8,
+            "hop_start": np.uint8,
+        }
+        result: dict[str, Any] = {
+            name: np.fromiter(self.columns[name], dtype=dtype, count=len(self))
+            for name, dtype in dtypes.items()
+        }
+        for name in ("channel_id", "gateway_id", "payload"):
+            result[name] = self.columns[name]
+        return result
+
+
+def read_length_prefixed(fh: BinaryIO) -> Iterator[bytes]:
+    """ read envelopes from a file of length-prefixed records """
+    header_size = LENGTH_PREFIX.size
+    while True:
+        header = fh.read(header_size)
+        if len(header) < header_size:
+            return
+        (length,) = LENGTH_PREFIX.unpack(header)
+        record = fh.read(length)
+        if len(record) < length:
+            raise ValueError(f"Truncated record, wanted {length} got {len(record)}")
+        yield record
+
+
+def read_base64_lines(
+    fh: BinaryIO, on_error: Optional[Callable[[int, Exception], None]] = None
+) -> Iterator[bytes]:
+    """ read envelopes from a file of base64 strings, one per line
+
+    Lines that aren't base64 are skipped, and passed to `on_error` with their
+    line number.
+    """
+    for number, line in enumerate(fh, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield base64.b64decode(line, validate=True)
+        except binascii.Error as error:
+            if on_error is not None:
+                on_error(number, error)
+
+
+def decode_batch(
+    envelopes: Iterable[bytes],
+    keyring: Optional[Keyring] = None,
+    decode_payloads: bool = True,
+    packet_filter: Optional[PacketFilter] = None,
+) -> DecodedBatch:
+    """ decode a pile of ServiceEnvelopes
+
+    Envelopes are all parsed first, then encrypted packets are decrypted in
+    groups by channel hash, each key decrypting the whole group at once (see
+    `Keyring.decrypt_group`), and payloads are parsed in groups by portnum, so
+    the key and handler lookups only happen once per group. Packets that
+    `packet_filter` doesn't want are dropped before they're decrypted if
+    possible, and otherwise before their payload's parsed.
+    """
+    if keyring is None:
+        keyring = Keyring.default()
+
+    packets: list[Any] = []
+    envelope_meta: list[tuple[str, str]] = []
+    parse_errors = 0
+    filtered = 0
+    for raw in envelopes:
+        se = mqtt_pb2.ServiceEnvelope()
+        try:
+            se.ParseFromString(raw)
+        except Exception:
+            parse_errors += 1
+            continue
+        if packet_filter is not None and not packet_filter.header_allowed(se):
+            filtered += 1
+            continue
+        packets.append(se.packet)
+        envelope_meta.append((se.channel_id, se.gateway_id))
+
+    by_channel: dict[int, list[int]] = {}
+    for index, mp in enumerate(packets):
+        if mp.HasField("encrypted") and not mp.HasField("decoded"):
+            by_channel.setdefault(mp.channel, []).append(index)
+
+    failed: set[int] = set()
+    for channel, indexes in by_channel.items():
+        candidates = keyring.candidates(channel)
+        if not candidates:
+            # no key for this channel, so none of them can be decrypted
+            failed.update(indexes)
+            continue
+        group = [packets[index] for index in indexes]
+        decrypted = keyring.decrypt_group(candidates, group)
+        for index, data in zip(indexes, decrypted, strict=True):
+            if data is None:
+                failed.add(index)
+            else:
+                packets[index].decoded.CopyFrom(data)
+
+    by_portnum: dict[int, list[int]] = {}
+    for index, mp in enumerate(packets):
+        if index not in failed:
+            by_portnum.setdefault(mp.decoded.portnum, []).append(index)
+
+    payloads: dict[int, Any] = {}
+    unhandled = 0
+    skipped: set[int] = set()
+    for portnum, indexes in by_portnum.items():
+        if packet_filter is not None and not packet_filter.portnum_allowed(portnum):
+            filtered += len(indexes)
+            skipped.update(indexes)
+            continue
+        handler = protocols.get(portnum)
+        if handler is None:
+            unhandled += len(indexes)
+            failed.update(indexes)
+            continue
+        if not decode_payloads:
+            continue
+        factory = handler.protobufFactory
+        for index in indexes:
+            payload = packets[index].decoded.payload
+            if factory is None:
+                payloads[index] = payload
+                continue
+            pb = factory()
+            try:
+                pb.ParseFromString(payload)
+            except Exception:
+                payloads[index] = payload
+                continue
+            payloads[index] = message_to_dict(pb)
+
+    batch = DecodedBatch()
+    batch.parse_errors = parse_errors
+    batch.unhandled = unhandled
+    batch.undecryptable = len(failed) - unhandled
+    batch.filtered = filtered
+    columns = batch.columns
+    for index, mp in enumerate(packets):
+        if index in failed or index in skipped:
+            continue
+        channel_id, gateway_id = envelope_meta[index]
+        columns["from"].append(getattr(mp, "from"))
+        columns["to"].append(mp.to)
+        columns["id"].append(mp.id)
+        columns["channel"].append(mp.channel)
+        columns["channel_id"].append(channel_id)
+        columns["gateway_id"].append(gateway_id)
+        columns["portnum"].append(mp.decoded.portnum)
+        columns["rx_time"].append(mp.rx_time)
+        columns["rx_rssi"].append(mp.rx_rssi)
+        columns["rx_snr"].append(mp.rx_snr)
+        columns["hop_limit"].append(mp.hop_limit)
+        columns["hop_start"].append(mp.hop_start)
+        columns["payload"].append(payloads.get(index))
+    return batch
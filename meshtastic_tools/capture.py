@@ -0,0 +1,266 @@
+""" record raw MQTT traffic to disk and replay it later
+
+A capture is a directory of segment files, each with an index alongside it.
+
+- `segment-000001.seg` starts with MAGIC, then records of a big-endian header
+  (receive time as a float64, topic length u16, payload length u32), the topic
+  and the payload.
+- `segment-000001.idx` has a (receive time, offset) pair for every
+  `index_every`th record, so a replay can seek to a time without scanning.
+
+Replay memory-maps the segments and hands out memoryview slices of the
+payloads, which protobuf can parse without them being copied.
+"""
+
+import bisect
+from datetime import datetime
+import itertools
+import mmap
+import os
+from pathlib import Path
+import struct
+import sys
+import time
+from typing import Any, BinaryIO, Callable, Iterator, Optional
+import weakref
+
+MAGIC = b"MSHCAP\x00\x01"
+RECORD = struct.Struct(">dHI")
+INDEX_ENTRY = struct.Struct(">dQ")
+
+# a record's (receive time, topic, payload)
+Record = tuple[float, str, memoryview]
+
+
+def parse_time(value: str) -> float:
+    """ a unix timestamp, or an ISO 8601 date/time in local time if there's no zone """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError as error:
+        raise ValueError(
+            f"Invalid time {value}, should be a unix timestamp or eg 2024-05-26T09:00:00"
+        ) from error
+
+
+class CaptureWriter:
+    """ appends messages to the segments in a capture directory
+
+    Each writer starts a new segment, so it's safe to record into a directory
+    that already has a capture in it. Segments are rotated at `segment_bytes`.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        segment_bytes: int = 64 * 1024 * 1024,
+        index_every: int = 256,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_every = index_every
+        self.clock = clock
+        self.written = 0
+        directory.mkdir(parents=True, exist_ok=True)
+        existing = sorted(directory.glob("segment-*.seg"))
+        self._sequence = int(existing[-1].stem.split("-")[1]) if existing else 0
+        self._fh: Optional[BinaryIO] = None
+        self._index: Optional[BinaryIO] = None
+        self._records = 0
+
+    def _open_segment(self) -> None:
+        self._close_segment()
+        self._sequence += 1
+        path = self.directory / f"segment-{self._sequence:06d}.seg"
+        self._fh = path.open("xb")
+        self._fh.write(MAGIC)
+        self._index = path.with_suffix(".idx").open("xb")
+        self._records = 0
+
+    def _close_segment(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def write(self, topic: str, payload: bytes, received: Optional[float] = None) -> None:
+        """ record a message, received defaults to now """
+        if received is None:
+            received = self.clock()
+        if self._fh is None or self._fh.tell() >= self.segment_bytes:
+            self._open_segment()
+        assert self._fh is not None and self._index is not None
+        topic_bytes = topic.encode("utf-8")
+        if self._records % self.index_every == 0:
+            self._index.write(INDEX_ENTRY.pack(received, self._fh.tell()))
+            self._index.flush()
+            self._fh.flush()
+        self._fh.write(RECORD.pack(received, len(topic_bytes), len(payload)))
+        self._fh.write(topic_bytes)
+        self._fh.write(payload)
+        self._records += 1
+        self.written += 1
+
+    def flush(self) -> None:
+        if self._fh is not None:
+            self._fh.flush()
+
+    def close(self) -> None:
+        self._close_segment()
+
+    def __enter__(self) -> "CaptureWriter":
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.close()
+
+
+class Segment:
+    """ one memory-mapped segment file and its index """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        index_path = path.with_suffix(".idx")
+        index_data = index_path.read_bytes() if index_path.exists() else b""
+        # a partly written entry at the end is ignored
+        usable = len(index_data) - len(index_data) % INDEX_ENTRY.size
+        entries = list(INDEX_ENTRY.iter_unpack(index_data[:usable]))
+        self.index_times = [entry[0] for entry in entries]
+        self.index_offsets = [entry[1] for entry in entries]
+        self._mmap: Optional[mmap.mmap] = None
+        # every view handed out that's still alive, so close can release them
+        self._views: weakref.WeakValueDictionary[int, memoryview] = weakref.WeakValueDictionary()
+        self._view_ids = itertools.count()
+        if os.path.getsize(path) > len(MAGIC):
+            with path.open("rb") as fh:
+                self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._mmap[: len(MAGIC)] != MAGIC:
+                self._mmap.close()
+                raise ValueError(f"{path} isn't a capture segment")
+
+    @property
+    def first_time(self) -> Optional[float]:
+        return self.index_times[0] if self.index_times else None
+
+    def records(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Record]:
+        """ the records between start and end, payloads are views into the file """
+        if self._mmap is None:
+            return
+        views = self._views
+        view_ids = self._view_ids
+        data = memoryview(self._mmap)
+        views[next(view_ids)] = data
+        offset = len(MAGIC)
+        if start is not None and self.index_times:
+            # the last indexed record at or before the start
+            position = bisect.bisect_right(self.index_times, start) - 1
+            if position >= 0:
+                offset = self.index_offsets[position]
+        size = len(data)
+        header_size = RECORD.size
+        unpack_from = RECORD.unpack_from
+        while offset + header_size <= size:
+            received, topic_length, payload_length = unpack_from(data, offset)
+            topic_start = offset + header_size
+            payload_start = topic_start + topic_length
+            offset = payload_start + payload_length
+            if offset > size:
+                # the recorder was stopped part way through writing this one
+                return
+            if end is not None and received > end:
+                return
+            if start is not None and received < start:
+                continue
+            topic = str(data[topic_start:payload_start], "utf-8")
+            payload = data[payload_start:offset]
+            views[next(view_ids)] = payload
+            yield received, topic, payload
+
+    def close(self) -> None:
+        """ release the payloads still held and unmap the file
+
+        If something's exported a buffer from a payload it can't be released, so
+        the file stays mapped until close is called again after that's gone.
+        """
+        if self._mmap is None:
+            return
+        for view in list(self._views.values()):
+            try:
+                view.release()
+            except BufferError:
+                pass
+        try:
+            self._mmap.close()
+        except BufferError:
+            print(f"WARNING: {self.path} is still in use, it'll be closed on the next try", file=sys.stderr)
+            return
+        self._views.clear()
+        self._mmap = None
+
+
+class CaptureReader:
+    """ reads every segment in a capture directory, in order """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        paths = sorted(directory.glob("segment-*.seg"))
+        if not paths:
+            raise ValueError(f"No capture segments in {directory}")
+        self.segments = [Segment(path) for path in paths]
+
+    def records(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Record]:
+        """ the records between start and end, payloads are only valid until close """
+        for position, segment in enumerate(self.segments):
+            if start is not None and position + 1 < len(self.segments):
+                next_start = self.segments[position + 1].first_time
+                if next_start is not None and next_start <= start:
+                    # it's all before the start
+                    continue
+            first_time = segment.first_time
+            if end is not None and first_time is not None and first_time > end:
+                return
+            yield from segment.records(start, end)
+
+    def close(self) -> None:
+        for segment in self.segments:
+            segment.close()
+
+    def __enter__(self) -> "CaptureReader":
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.close()
+
+
+def replay(
+    records: Iterator[Record],
+    handle: Callable[[float, str, memoryview], Any],
+    speed: float = 0.0,
+    clock: Callable[[], float] = time.monotonic,
+    sleep: Callable[[float], None] = time.sleep,
+) -> int:
+    """ call `handle(received, topic, payload)` for each record, returning how many there were
+
+    With a `speed` the gaps between messages are kept, 1.0 is real time and 2.0
+    twice as fast. 0 goes as fast as possible.
+    """
+    count = 0
+    first: Optional[float] = None
+    started = 0.0
+    for received, topic, payload in records:
+        if speed > 0:
+            if first is None:
+                first = received
+                started = clock()
+            delay = started + (received - first) / speed - clock()
+            if delay > 0:
+                sleep(delay)
+        handle(received, topic, payload)
+        count += 1
+    return count
@@ -0,0 +1,126 @@
+""" drop the copies of a packet that arrive via each gateway that heard it """
+
+import threading
+import time
+from array import array
+from typing import Any, Callable, Optional
+
+from meshtastic import mqtt_pb2  # type: ignore
+
+
+def packet_key(from_id: int, packet_id: int) -> int:
+    """ both are u32s, so pack them into one int """
+    return (from_id << 32) | packet_id
+
+
+def reception(se: Any) -> dict[str, Any]:
+    """ the per-gateway details of a ServiceEnvelope, for merging """
+    mp = se.packet
+    return {
+        "gateway_id": se.gateway_id,
+        "rssi": mp.rx_rssi,
+        "snr": mp.rx_snr,
+        "hop_limit": mp.hop_limit,
+    }
+
+
+class DedupIndex:
+    """ a time-windowed index of recently seen (from, id) pairs
+
+    Keys live in a fixed size ring buffer with a dict pointing at their slot,
+    so memory stays bounded - once the ring wraps the oldest keys are forgotten
+    even if they're still inside the window.
+
+    With `merge_delay` set, the first copy of a packet can be held with `hold`
+    and later copies' gateway details are added to its "gateways" list, until
+    `ready` hands it back once the delay's passed. Those three can be called
+    from different threads, eg `ready` from a timer.
+    """
+
+    def __init__(
+        self,
+        window: float = 300.0,
+        capacity: int = 65536,
+        merge_delay: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.window = window
+        self.capacity = capacity
+        self.merge_delay = merge_delay
+        self.clock = clock
+        self.duplicates = 0
+        self._keys = array("Q", bytes(8 * capacity))
+        self._times = array("d", bytes(8 * capacity))
+        self._slots: dict[int, int] = {}
+        self._next = 0
+        self._held: dict[int, tuple[float, dict[str, Any]]] = {}
+        self._held_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def seen(self, from_id: int, packet_id: int) -> bool:
+        """ returns True if this is a duplicate, otherwise records it """
+        key = packet_key(from_id, packet_id)
+        now = self.clock()
+        slot = self._slots.get(key)
+        if slot is not None and now - self._times[slot] <= self.window:
+            self.duplicates += 1
+            return True
+
+        if slot is not None:
+            # seen before, but outside the window, so it's new again
+            del self._slots[key]
+        slot = self._next
+        self._next = (slot + 1) % self.capacity
+        old_key = self._keys[slot]
+        if self._slots.get(old_key) == slot:
+            del self._slots[old_key]
+        self._keys[slot] = key
+        self._times[slot] = now
+        self._slots[key] = slot
+        return False
+
+    def hold(self, from_id: int, packet_id: int, message: dict[str, Any]) -> None:
+        """ keep the first copy of a packet around to merge the others into """
+        with self._held_lock:
+            self._held[packet_key(from_id, packet_id)] = (self.clock(), message)
+
+    def merge(self, from_id: int, packet_id: int, reception: dict[str, Any]) -> bool:
+        """ add another gateway's reception to a held packet """
+        with self._held_lock:
+            held = self._held.get(packet_key(from_id, packet_id))
+            if held is None:
+                return False
+            held[1].setdefault("gateways", []).append(reception)
+            return True
+
+    def ready(self, force: bool = False) -> list[dict[str, Any]]:
+        """ held packets whose merge delay has passed, oldest first """
+        if not self._held:
+            return []
+        with self._held_lock:
+            if force or self.merge_delay is None:
+                result = [message for _, message in self._held.values()]
+                self._held.clear()
+                return result
+            cutoff = self.clock() - self.merge_delay
+            result = []
+            # dicts keep insertion order, so stop at the first one that's too new
+            for key, (held_at, message) in list(self._held.items()):
+                if held_at > cutoff:
+                    break
+                result.append(message)
+                del self._held[key]
+            return result
+
+    def seen_envelope(self, payload: bytes) -> bool:
+        """ check a raw ServiceEnvelope, for when it's decoded somewhere else """
+        se = mqtt_pb2.ServiceEnvelope()
+        try:
+            se.ParseFromString(payload)
+        except Exception:
+            # let the decoder complain about it
+            return False
+        packet_id = se.packet.id
+        return packet_id != 0 and self.seen(getattr(se.packet, "from"), packet_id)
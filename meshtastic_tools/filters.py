@@ -0,0 +1,123 @@
+""" only decode the packets someone wants
+
+Filters are checked in stages, cheapest first, so a packet that's going to be
+thrown away stops costing anything as soon as possible:
+
+1. the MQTT topic, before the envelope's even parsed
+2. the envelope header - sender and channel, and the portnum if it's not encrypted
+3. the portnum once it's decrypted, before the payload's parsed
+
+Within each kind of filter any match is enough, a packet has to pass every kind
+that's been set.
+"""
+
+from typing import Any, Iterable, Optional
+
+from meshtastic import portnums_pb2  # type: ignore
+
+
+def topic_matches(pattern: list[str], levels: list[str]) -> bool:
+    """ MQTT wildcard matching, both split on / already """
+    for index, part in enumerate(pattern):
+        if part == "#":
+            return True
+        if index >= len(levels):
+            return False
+        if part != "+" and part != levels[index]:
+            return False
+    return len(pattern) == len(levels)
+
+
+def parse_portnum(value: str) -> int:
+    """ a portnum by name (POSITION_APP) or number """
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(portnums_pb2.PortNum.Value(value.upper()))
+    except ValueError as error:
+        raise ValueError(f"Unknown portnum {value}") from error
+
+
+def parse_node_id(value: str) -> int:
+    """ a node number as hex, with or without the !, eg !050c2e68 """
+    try:
+        return int(value.removeprefix("!"), 16)
+    except ValueError as error:
+        raise ValueError(f"Invalid node id {value}, should be hex like !050c2e68") from error
+
+
+class PacketFilter:
+    """ which packets to decode, anything left empty isn't filtered on
+
+    Channels can be names, which are matched against the envelope's channel_id,
+    or numbers, which are matched against the packet's channel hash.
+    """
+
+    def __init__(
+        self,
+        portnums: Iterable[int] = (),
+        channels: Iterable[str | int] = (),
+        senders: Iterable[int] = (),
+        topics: Iterable[str] = (),
+    ) -> None:
+        self.portnums = frozenset(portnums)
+        self.channel_names = frozenset(
+            channel for channel in channels if isinstance(channel, str)
+        )
+        self.channel_hashes = frozenset(
+            channel for channel in channels if isinstance(channel, int)
+        )
+        self.senders = frozenset(senders)
+        self.topics = [topic.split("/") for topic in topics]
+
+    @classmethod
+    def parse(
+        cls,
+        portnums: Iterable[str] = (),
+        channels: Iterable[str] = (),
+        senders: Iterable[str] = (),
+        topics: Iterable[str] = (),
+    ) -> Optional["PacketFilter"]:
+        """ build a filter from command line strings, None if there's nothing to filter """
+        packet_filter = cls(
+            [parse_portnum(portnum) for portnum in portnums],
+            [int(channel) if channel.isdigit() else channel for channel in channels],
+            [parse_node_id(sender) for sender in senders],
+            topics,
+        )
+        return packet_filter if packet_filter else None
+
+    def __bool__(self) -> bool:
+        return bool(
+            self.portnums
+            or self.channel_names
+            or self.channel_hashes
+            or self.senders
+            or self.topics
+        )
+
+    def topic_allowed(self, topic: str) -> bool:
+        """ stage 1, the MQTT topic """
+        if not self.topics:
+            return True
+        levels = topic.split("/")
+        return any(topic_matches(pattern, levels) for pattern in self.topics)
+
+    def header_allowed(self, se: Any) -> bool:
+        """ stage 2, the unencrypted parts of a ServiceEnvelope """
+        mp = se.packet
+        if self.senders and getattr(mp, "from") not in self.senders:
+            return False
+        if self.channel_names or self.channel_hashes:
+            if (
+                se.channel_id not in self.channel_names
+                and mp.channel not in self.channel_hashes
+            ):
+                return False
+        if self.portnums and mp.HasField("decoded"):
+            return self.portnum_allowed(mp.decoded.portnum)
+        return True
+
+    def portnum_allowed(self, portnum: int) -> bool:
+        """ stage 3, the decrypted portnum """
+        return not self.portnums or portnum in self.portnums
@@ -0,0 +1,306 @@
+""" where nodes are, indexed on a grid so nearby nodes can be found quickly
+
+Positions are bucketed into cells of `cell_degrees` by `cell_degrees`, so a
+query only looks at the nodes in the cells it overlaps. Gateways also go in a
+grid of their own, as there's far fewer of them to search for the nearest one.
+
+Nodes can send deliberately vague positions - `precision_bits` is how many of
+the top bits of latitude_i/longitude_i are kept, so the node's somewhere in a
+box around the position. That's kept as an uncertainty radius in metres, which
+radius queries can take into account.
+"""
+
+import math
+from typing import Iterable, Iterator
+
+EARTH_RADIUS = 6371008.8
+METRES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+# gateways are much sparser than nodes, so they get bigger cells
+GATEWAY_CELL_SCALE = 5
+# stop searching rings of cells for the nearest gateway after this many
+MAX_RINGS = 16
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """ great circle distance in metres """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    half_dphi = (phi2 - phi1) / 2
+    half_dlambda = math.radians(lon2 - lon1) / 2
+    a = (
+        math.sin(half_dphi) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(half_dlambda) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def uncertainty(precision_bits: int) -> float:
+    """ how far (in metres, north-south) a node could be from the position it sent
+
+    0 is what older firmware sends, which is full precision.
+    """
+    if precision_bits <= 0 or precision_bits >= 32:
+        return 0.0
+    # the dropped bits make a box 2^(32 - bits) * 1e-7 degrees across
+    return (1 << (31 - precision_bits)) * 1e-7 * METRES_PER_DEGREE
+
+
+class _Grid:
+    """ node numbers bucketed by cell, with the cells kept per row """
+
+    def __init__(self, cell_degrees: float) -> None:
+        self.cell_degrees = cell_degrees
+        self.columns = math.ceil(360 / cell_degrees)
+        self.rows = math.ceil(180 / cell_degrees)
+        # row -> column -> nodes
+        self.cells: dict[int, dict[int, set[int]]] = {}
+
+    def cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        row = max(0, min(int((latitude + 90) // self.cell_degrees), self.rows - 1))
+        column = int((longitude + 180) // self.cell_degrees) % self.columns
+        return row, column
+
+    def add(self, num: int, cell: tuple[int, int]) -> None:
+        row, column = cell
+        self.cells.setdefault(row, {}).setdefault(column, set()).add(num)
+
+    def remove(self, num: int, cell: tuple[int, int]) -> None:
+        row, column = cell
+        columns = self.cells.get(row)
+        if columns is None:
+            return
+        members = columns.get(column)
+        if members is not None:
+            members.discard(num)
+            if not members:
+                del columns[column]
+                if not columns:
+                    del self.cells[row]
+
+    def _row(self, row: int, first_column: int, count: int) -> Iterator[set[int]]:
+        """ the non-empty cells in part of a row, which can wrap around """
+        columns = self.cells.get(row)
+        if not columns:
+            return
+        if count < len(columns):
+            for offset in range(count):
+                members = columns.get((first_column + offset) % self.columns)
+                if members:
+                    yield members
+        else:
+            # quicker to look at the cells there are than the ones there could be
+            for column, members in columns.items():
+                if (column - first_column) % self.columns < count:
+                    yield members
+
+    def covering(
+        self, south: float, west: float, north: float, east: float
+    ) -> Iterator[set[int]]:
+        """ the non-empty cells overlapping a box, west > east crosses the antimeridian """
+        first_row, first_column = self.cell(south, west)
+        last_row, last_column = self.cell(north, east)
+        if east - west >= 360:
+            first_column, count = 0, self.columns
+        else:
+            count = (last_column - first_column) % self.columns + 1
+        for row in range(first_row, last_row + 1):
+            yield from self._row(row, first_column, count)
+
+    def ring(self, centre: tuple[int, int], radius: int) -> Iterator[set[int]]:
+        """ the non-empty cells exactly `radius` cells away from the centre """
+        row, column = centre
+        for ring_row in range(max(row - radius, 0), min(row + radius, self.rows - 1) + 1):
+            if abs(ring_row - row) == radius:
+                yield from self._row(ring_row, column - radius, 2 * radius + 1)
+            else:
+                columns = self.cells.get(ring_row)
+                if not columns:
+                    continue
+                for ring_column in {(column - radius) % self.columns, (column + radius) % self.columns}:
+                    members = columns.get(ring_column)
+                    if members:
+                        yield members
+
+
+class SpatialIndex:
+    """ node positions, for radius, bounding box and nearest gateway queries """
+
+    def __init__(self, cell_degrees: float = 0.1) -> None:
+        self.cell_degrees = cell_degrees
+        # num -> (latitude, longitude, uncertainty in metres)
+        self.positions: dict[int, tuple[float, float, float]] = {}
+        self.gateways: set[int] = set()
+        self._grid = _Grid(cell_degrees)
+        self._gateway_grid = _Grid(cell_degrees * GATEWAY_CELL_SCALE)
+        self._gateway_cells: dict[int, tuple[int, int]] = {}
+        # gateway -> (latitude and longitude in radians, cos(latitude))
+        self._gateway_trig: dict[int, tuple[float, float, float]] = {}
+        self._cells: dict[int, tuple[int, int]] = {}
+        self._max_uncertainty = 0.0
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, num: int) -> bool:
+        return num in self.positions
+
+    def update(
+        self, num: int, latitude: float, longitude: float, precision_bits: int = 0
+    ) -> None:
+        """ a node's new position, in degrees """
+        error = uncertainty(precision_bits)
+        self._max_uncertainty = max(self._max_uncertainty, error)
+        cell = self._grid.cell(latitude, longitude)
+        old_cell = self._cells.get(num)
+        if old_cell != cell:
+            if old_cell is not None:
+                self._grid.remove(num, old_cell)
+            self._grid.add(num, cell)
+            self._cells[num] = cell
+        self.positions[num] = (latitude, longitude, error)
+        if num in self.gateways:
+            self._place_gateway(num)
+
+    def _place_gateway(self, num: int) -> None:
+        latitude, longitude, _ = self.positions[num]
+        phi = math.radians(latitude)
+        self._gateway_trig[num] = (phi, math.radians(longitude), math.cos(phi))
+        cell = self._gateway_grid.cell(latitude, longitude)
+        old_cell = self._gateway_cells.get(num)
+        if old_cell != cell:
+            if old_cell is not None:
+                self._gateway_grid.remove(num, old_cell)
+            self._gateway_grid.add(num, cell)
+            self._gateway_cells[num] = cell
+
+    def remove(self, num: int) -> None:
+        """ forget a node """
+        cell = self._cells.pop(num, None)
+        if cell is not None:
+            self._grid.remove(num, cell)
+        cell = self._gateway_cells.pop(num, None)
+        if cell is not None:
+            self._gateway_grid.remove(num, cell)
+        self._gateway_trig.pop(num, None)
+        self.positions.pop(num, None)
+        self.gateways.discard(num)
+
+    def mark_gateway(self, num: int) -> None:
+        """ remember a node's a gateway, so it's found by `nearest_gateways` """
+        if num in self.gateways:
+            return
+        self.gateways.add(num)
+        if num in self.positions:
+            self._place_gateway(num)
+
+    def _box(self, latitude: float, longitude: float, radius: float) -> tuple[float, float, float, float]:
+        """ a lat/lon box around a circle """
+        lat_delta = radius / METRES_PER_DEGREE
+        south = latitude - lat_delta
+        north = latitude + lat_delta
+        if south <= -90 or north >= 90:
+            return south, -180.0, north, 180.0
+        widest = max(abs(south), abs(north))
+        lon_delta = lat_delta / max(math.cos(math.radians(widest)), 1e-9)
+        if lon_delta >= 180:
+            return south, -180.0, north, 180.0
+        west = (longitude - lon_delta + 180) % 360 - 180
+        east = (longitude + lon_delta + 180) % 360 - 180
+        return south, west, north, east
+
+    def within(
+        self,
+        latitude: float,
+        longitude: float,
+        radius: float,
+        include_uncertain: bool = False,
+    ) -> list[tuple[int, float]]:
+        """ (node, metres) for nodes within `radius` metres, nearest first
+
+        With `include_uncertain`, nodes whose vague position could put them
+        inside the radius are included too.
+        """
+        search = radius + self._max_uncertainty if include_uncertain else radius
+        positions = self.positions
+        # the haversine formula from distance(), inlined as it's the hot loop
+        sin = math.sin
+        cos_phi = math.cos(math.radians(latitude))
+        to_radians = math.pi / 360
+        diameter = 2 * EARTH_RADIUS
+        # compare sin^2(d / 2R) rather than working out every node's distance
+        limit = sin(min(search / diameter, math.pi / 2)) ** 2
+        result = []
+        for members in self._grid.covering(*self._box(latitude, longitude, search)):
+            for num in members:
+                node_lat, node_lon, error = positions[num]
+                a = (
+                    sin((node_lat - latitude) * to_radians) ** 2
+                    + cos_phi
+                    * math.cos(node_lat * 2 * to_radians)
+                    * sin((node_lon - longitude) * to_radians) ** 2
+                )
+                if a > limit:
+                    continue
+                metres = diameter * math.asin(min(1.0, math.sqrt(a)))
+                if metres <= radius or (include_uncertain and metres - error <= radius):
+                    result.append((num, metres))
+        result.sort(key=lambda item: item[1])
+        return result
+
+    def in_bbox(self, south: float, west: float, north: float, east: float) -> list[int]:
+        """ nodes inside a box, west > east crosses the antimeridian """
+        positions = self.positions
+        crosses = west > east
+        result = []
+        for members in self._grid.covering(south, west, north, east):
+            for num in members:
+                node_lat, node_lon, _ = positions[num]
+                if not south <= node_lat <= north:
+                    continue
+                if crosses:
+                    if node_lon >= west or node_lon <= east:
+                        result.append(num)
+                elif west <= node_lon <= east:
+                    result.append(num)
+        return result
+
+    def nearest_gateways(
+        self, latitude: float, longitude: float, limit: int = 1
+    ) -> list[tuple[int, float]]:
+        """ (gateway, metres) for the closest gateways with a known position """
+        grid = self._gateway_grid
+        trig = self._gateway_trig
+        sin = math.sin
+        phi = math.radians(latitude)
+        lam = math.radians(longitude)
+        cos_phi = math.cos(phi)
+
+        def closest(nums: Iterable[int]) -> list[tuple[float, int]]:
+            # sorting on the haversine's a gives the same order as the distance
+            found = []
+            for num in nums:
+                node_phi, node_lam, node_cos = trig[num]
+                a = sin((node_phi - phi) / 2) ** 2 + cos_phi * node_cos * sin((node_lam - lam) / 2) ** 2
+                found.append((a, num))
+            found.sort()
+            return found[:limit]
+
+        def metres(a: float) -> float:
+            return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+        centre = grid.cell(latitude, longitude)
+        candidates: list[int] = []
+        cell_metres = grid.cell_degrees * METRES_PER_DEGREE
+        for radius in range(MAX_RINGS + 1):
+            for members in grid.ring(centre, radius):
+                candidates.extend(members)
+            if len(candidates) >= limit:
+                found = closest(candidates)
+                # anything in the next ring is at least this far away, cells
+                # being narrowest at the highest latitude they reach
+                widest = min(abs(latitude) + (radius + 1) * grid.cell_degrees, 89.9)
+                if metres(found[-1][0]) <= radius * cell_metres * math.cos(math.radians(widest)):
+                    return [(num, metres(a)) for a, num in found]
+        # a long way from any gateway, so look at all of them
+        return [(num, metres(a)) for a, num in closest(trig)]
@@ -0,0 +1,351 @@
+""" channel keys for decrypting meshtastic packets
+
+Keys can also be loaded from a file, one `NAME:BASE64PSK` per line (blank
+lines and lines starting with # are ignored). The file's checked for changes
+every `reload_interval` seconds and reloaded without a restart.
+"""
+
+import base64
+import os
+from pathlib import Path
+import struct
+import sys
+import time
+from typing import Any, Callable, Optional
+
+import click
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from google.protobuf.message import DecodeError  # type: ignore
+from meshtastic import mesh_pb2  # type: ignore
+
+DEFAULT_CHANNEL = "LongFast"
+DEFAULT_KEY = "1PG7OiApB1nwvP+rz05pAQ=="
+
+# packet id and sender, both as little-endian u64
+_NONCE = struct.Struct("<QQ")
+_COUNTER_MASK = (1 << 128) - 1
+
+
+def xor_hash(data: bytes) -> int:
+    """ the single byte xor meshtastic uses for channel hashes """
+    result = 0
+    for value in data:
+        result ^= value
+    return result
+
+
+def expand_psk(psk: bytes) -> bytes:
+    """ expand the one-byte shorthand PSKs to the real AES key """
+    if len(psk) != 1:
+        return psk
+    if psk[0] == 0:
+        return b""
+    key = bytearray(base64.b64decode(DEFAULT_KEY))
+    key[-1] = (key[-1] + psk[0] - 1) & 0xFF
+    return bytes(key)
+
+
+def channel_hash(name: str, key: bytes) -> int:
+    """ the hash that ends up in MeshPacket.channel """
+    return xor_hash(name.encode("utf-8")) ^ xor_hash(key)
+
+
+class NoKeyError(ValueError):
+    """ there's no key for the packet's channel, so it wasn't worth trying """
+
+
+def parse_key(value: str) -> tuple[str, bytes]:
+    """ NAME:BASE64PSK, as used by --key and key files """
+    name, _, psk = value.partition(":")
+    if not name or not psk:
+        raise ValueError(f"Invalid key {value}, should be NAME:BASE64PSK")
+    try:
+        return name, base64.b64decode(psk.encode("ascii"), validate=True)
+    except ValueError as error:
+        raise ValueError(f"Invalid PSK for channel {name}, should be base64") from error
+
+
+def parse_key_option(
+    _ctx: click.Context, _param: click.Parameter, values: tuple[str, ...]
+) -> list[tuple[str, bytes]]:
+    """ a click callback for --key options, so a bad key's a usage error """
+    try:
+        return [parse_key(value) for value in values]
+    except ValueError as error:
+        raise click.BadParameter(str(error)) from error
+
+
+def read_key_file(path: Path) -> list[tuple[str, bytes]]:
+    """ the (name, psk) pairs in a key file """
+    keys = []
+    for number, line in enumerate(path.read_text().splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            keys.append(parse_key(line))
+        except ValueError as error:
+            raise ValueError(f"{path} line {number}: {error}") from error
+    return keys
+
+
+class ChannelKey:
+    """ a decoded channel key, ready to build ciphers with
+
+    Rather than setting up a new CTR cipher for every packet, this keeps one ECB
+    encryptor around and builds the CTR keystream from it. The encryptor isn't
+    thread safe, so don't share a ChannelKey between threads.
+    """
+
+    __slots__ = ("name", "key", "hash", "_ecb")
+
+    def __init__(self, name: str, key: bytes) -> None:
+        self.name = name
+        self.key = key
+        self.hash = channel_hash(name, key)
+        self._ecb = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+
+    def decrypt(self, packet_id: int, from_id: int, encrypted: bytes) -> bytes:
+        """ AES-CTR is symmetric, so this also encrypts """
+        length = len(encrypted)
+        if length == 0:
+            return b""
+        counter = int.from_bytes(_NONCE.pack(packet_id, from_id), "big")
+        if length <= 16:
+            keystream = self._ecb.update(counter.to_bytes(16, "big"))
+        else:
+            keystream = self._ecb.update(
+                b"".join(
+                    ((counter + block) & _COUNTER_MASK).to_bytes(16, "big")
+                    for block in range((length + 15) // 16)
+                )
+            )
+        return (
+            int.from_bytes(encrypted, "big")
+            ^ int.from_bytes(keystream[:length], "big")
+        ).to_bytes(length, "big")
+
+    def decrypt_many(self, packets: list[tuple[int, int, bytes]]) -> list[bytes]:
+        """ decrypt (packet id, from, encrypted) triples with one call into AES
+
+        The counter blocks for every packet are encrypted together, then split
+        up into each packet's keystream.
+        """
+        blocks: list[bytes] = []
+        for packet_id, from_id, encrypted in packets:
+            counter = int.from_bytes(_NONCE.pack(packet_id, from_id), "big")
+            blocks.extend(
+                ((counter + block) & _COUNTER_MASK).to_bytes(16, "big")
+                for block in range((len(encrypted) + 15) // 16)
+            )
+        keystream = self._ecb.update(b"".join(blocks))
+        result = []
+        offset = 0
+        for _, _, encrypted in packets:
+            length = len(encrypted)
+            result.append(
+                (
+                    int.from_bytes(encrypted, "big")
+                    ^ int.from_bytes(keystream[offset : offset + length], "big")
+                ).to_bytes(length, "big")
+            )
+            offset += (length + 15) // 16 * 16
+        return result
+
+    def __repr__(self) -> str:
+        return f"ChannelKey({self.name!r}, hash={self.hash})"
+
+
+class Keyring:
+    """ channel keys indexed by channel hash, PSKs are only decoded once
+
+    A packet whose channel hash doesn't match any key is skipped without trying
+    to decrypt it. Packets with no hash (0) could be on any channel, so they
+    get every key.
+    """
+
+    def __init__(self) -> None:
+        self._by_hash: dict[int, list[ChannelKey]] = {}
+        self._all: list[ChannelKey] = []
+        # keys from add() are kept when the key file's reloaded
+        self._added: list[ChannelKey] = []
+        self.path: Optional[Path] = None
+        self.reload_interval = 5.0
+        self.clock: Callable[[], float] = time.monotonic
+        self.reloads = 0
+        self._checked = 0.0
+        self._stamp: Optional[tuple[int, int]] = None
+
+    @classmethod
+    def default(cls) -> "Keyring":
+        """ a keyring with just the default LongFast key """
+        keyring = cls()
+        keyring.add(DEFAULT_CHANNEL, DEFAULT_KEY)
+        return keyring
+
+    @staticmethod
+    def _make_key(name: str, psk: str | bytes) -> Optional[ChannelKey]:
+        if isinstance(psk, str):
+            psk = base64.b64decode(psk.encode("ascii"))
+        key = expand_psk(psk)
+        if not key:
+            # unencrypted channel, nothing to decrypt
+            return None
+        if len(key) not in (16, 32):
+            raise ValueError(f"Invalid key length for channel {name}: {len(key)}")
+        return ChannelKey(name, key)
+
+    @staticmethod
+    def _index(
+        by_hash: dict[int, list[ChannelKey]], all_keys: list[ChannelKey], channel_key: ChannelKey
+    ) -> ChannelKey:
+        """ add a key to the index, unless it's already there """
+        for existing in by_hash.get(channel_key.hash, []):
+            if existing.name == channel_key.name and existing.key == channel_key.key:
+                return existing
+        by_hash.setdefault(channel_key.hash, []).append(channel_key)
+        all_keys.append(channel_key)
+        return channel_key
+
+    def add(self, name: str, psk: str | bytes) -> Optional[ChannelKey]:
+        """ add a key, PSKs can be raw bytes or base64 strings """
+        channel_key = self._make_key(name, psk)
+        if channel_key is None:
+            return None
+        indexed = self._index(self._by_hash, self._all, channel_key)
+        if indexed is channel_key:
+            self._added.append(channel_key)
+        return indexed
+
+    def load(
+        self,
+        path: Path,
+        reload_interval: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """ add the keys from a file, and keep them in sync with it """
+        self.path = path
+        self.reload_interval = reload_interval
+        self.clock = clock
+        self._stamp = None
+        self.reload()
+
+    def reload(self) -> bool:
+        """ re-read the key file if it's changed, returns True if it was
+
+        The keys are swapped in all at once, so a bad file leaves the old keys
+        in place.
+        """
+        if self.path is None:
+            return False
+        self._checked = self.clock()
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return False
+        by_hash: dict[int, list[ChannelKey]] = {}
+        all_keys: list[ChannelKey] = []
+        for channel_key in self._added:
+            self._index(by_hash, all_keys, channel_key)
+        for name, psk in read_key_file(self.path):
+            loaded = self._make_key(name, psk)
+            if loaded is not None:
+                self._index(by_hash, all_keys, loaded)
+        self._by_hash = by_hash
+        self._all = all_keys
+        self._stamp = stamp
+        self.reloads += 1
+        return True
+
+    def maybe_reload(self) -> None:
+        """ reload the key file if it's been long enough since it was checked """
+        if self.clock() - self._checked < self.reload_interval:
+            return
+        try:
+            if self.reload():
+                print(f"reloaded {len(self._all)} keys from {self.path}", file=sys.stderr)
+        except (OSError, ValueError) as error:
+            print(f"ERROR: reloading keys from {self.path}: {error}", file=sys.stderr)
+
+    def candidates(self, channel: int) -> list[ChannelKey]:
+        """ keys which could have encrypted a packet on this channel hash, maybe none """
+        if self.path is not None:
+            self.maybe_reload()
+        keys = self._by_hash.get(channel)
+        if keys is None:
+            if channel == 0:
+                # old firmware and some gateways don't fill in the hash
+                return self._all
+            return []
+        return keys
+
+    def decrypt(self, mp: Any) -> Any:
+        """ decrypt a MeshPacket's payload, returning the mesh_pb2.Data """
+        return self.decrypt_with(self.candidates(mp.channel), mp)
+
+    @staticmethod
+    def decrypt_with(candidates: list[ChannelKey], mp: Any) -> Any:
+        """ decrypt with an already looked-up list of candidate keys """
+        if not candidates:
+            raise NoKeyError(f"No key for channel {mp.channel}")
+        packet_id = mp.id
+        from_id = getattr(mp, "from")
+        encrypted = mp.encrypted
+        if len(candidates) == 1:
+            data = mesh_pb2.Data()
+            data.ParseFromString(candidates[0].decrypt(packet_id, from_id, encrypted))
+            return data
+        for channel_key in candidates:
+            data = mesh_pb2.Data()
+            try:
+                data.ParseFromString(
+                    channel_key.decrypt(packet_id, from_id, encrypted)
+                )
+            except DecodeError:
+                continue
+            # a wrong key usually still parses, but not to a real portnum
+            if data.portnum != 0:
+                return data
+        raise ValueError(f"No key could decrypt packet on channel {mp.channel}")
+
+    @staticmethod
+    def decrypt_group(candidates: list[ChannelKey], packets: list[Any]) -> list[Any]:
+        """ decrypt MeshPackets that share a channel hash, a key at a time
+
+        Each key decrypts everything that's still left in one go (see
+        `ChannelKey.decrypt_many`). Returns the mesh_pb2.Data for each packet,
+        or None for the ones no key could decrypt.
+        """
+        results: list[Any] = [None] * len(packets)
+        remaining = list(range(len(packets)))
+        for channel_key in candidates:
+            if not remaining:
+                break
+            plaintexts = channel_key.decrypt_many(
+                [
+                    (mp.id, getattr(mp, "from"), mp.encrypted)
+                    for mp in (packets[index] for index in remaining)
+                ]
+            )
+            left = []
+            for index, plaintext in zip(remaining, plaintexts, strict=True):
+                data = mesh_pb2.Data()
+                try:
+                    data.ParseFromString(plaintext)
+                except DecodeError:
+                    left.append(index)
+                    continue
+                # a wrong key usually still parses, but not to a real portnum
+                if data.portnum != 0 or len(candidates) == 1:
+                    results[index] = data
+                else:
+                    left.append(index)
+            remaining = left
+        return results
+
+    def keys(self) -> list[ChannelKey]:
+        """ all the keys, in the order they were added """
+        return list(self._all)
+
+    def __len__(self) -> int:
+        return len(self._all)
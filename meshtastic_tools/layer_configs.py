@@ -1,12 +1,25 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import os
 from pathlib import Path
+import pickle
+import stat
 import sys
-from typing import Any, Dict, Optional
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 import click
 from loguru import logger
 import yaml
 
+from meshtastic_tools.watch import Watcher, make_watcher, wait_for_changes
+
+# bump this when the merge or the cache format changes, so old entries aren't used
+CACHE_VERSION = "1"
+
+# set by --debug, checked before logging each key so the arguments aren't built for nothing
+DEBUG = False
+
 
 def recursive_update(source: Dict[str, Any], dest: Dict[str, Any]) -> Dict[str, Any]:
     """neatly update things, don't just blat them"""
@@ -15,28 +28,467 @@ def recursive_update(source: Dict[str, Any], dest: Dict[str, Any]) -> Dict[str,
     else:
         for key, value in source.items():
             if isinstance(value, dict) or isinstance(dest.get(key), dict):
-                logger.debug("recursing into {}", key)
+                if DEBUG:
+                    logger.debug("recursing into {}", key)
                 dest[key] = recursive_update(value, dest.get(key, {}))
             else:
-                logger.debug("setting {} -> {}", key, value)
+                if DEBUG:
+                    logger.debug("setting {} -> {}", key, value)
                 dest[key] = value
     return dest
 
 
+def content_hash(data: bytes) -> str:
+    """the sha256 of a layer file's contents"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def layer_key(data: bytes) -> str:
+    """the cache key for a parsed layer"""
+    return f"{CACHE_VERSION}-{content_hash(data)}"
+
+
+def prefix_keys(contents: List[bytes]) -> List[str]:
+    """the cache key for each prefix of a layer list, chained from the layers under it"""
+    keys = []
+    prefix_key = CACHE_VERSION
+    for data in contents:
+        prefix_key = content_hash(f"{prefix_key}:{content_hash(data)}".encode("ascii"))
+        keys.append(prefix_key)
+    return keys
+
+
+def live_entries(layer_lists: Iterable[List[Path]]) -> Set[str]:
+    """the cache entries the layer lists would use, as they are now"""
+    entries: Set[str] = set()
+    for layer_files in layer_lists:
+        contents = []
+        for layer_file in layer_files:
+            try:
+                contents.append(layer_file.read_bytes())
+            except OSError:
+                # nothing above a missing layer can be built
+                break
+        entries.update(f"layer-{layer_key(data)}" for data in contents)
+        entries.update(f"prefix-{key}" for key in prefix_keys(contents))
+    return entries
+
+
+class LayerCache:
+    """parsed layers and merged prefixes of layers, pickled and keyed by content hash
+
+    A prefix's key is chained from the keys of every layer under it, so changing
+    a layer only invalidates the prefixes from that layer up.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, kind: str, key: str) -> Path:
+        return self.directory / f"{kind}-{key}.pickle"
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        """the cached value, or None if there isn't one"""
+        try:
+            with self._path(kind, key).open("rb") as fh:
+                value = pickle.load(fh)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError) as error:
+            logger.warning("Ignoring broken cache entry {}-{}: {}", kind, key, error)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, kind: str, key: str, value: Any) -> None:
+        """write an entry, atomically so a concurrent run never reads half of it"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=self.directory, prefix=f".{kind}-", delete=False
+        ) as fh:
+            pickle.dump(value, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fh.name, self._path(kind, key))
+
+    def prune(self, live: Set[str]) -> int:
+        """remove the entries that aren't in `live`, returning how many went
+
+        Layers that have changed or gone leave entries nothing will ask for
+        again, without this the cache only grows.
+        """
+        removed = 0
+        try:
+            paths = list(self.directory.glob("*.pickle"))
+        except OSError:
+            return 0
+        for path in paths:
+            if path.name.startswith(".") or path.stem in live:
+                continue
+            try:
+                path.unlink()
+                removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logger.info("Removed {} unused cache entries", removed)
+        return removed
+
+
+def compose(layer_files: List[Path], cache: Optional[LayerCache] = None) -> Dict[str, Any]:
+    """merge the layer files in order, reusing whatever's in the cache"""
+    contents = [layer_file.read_bytes() for layer_file in layer_files]
+    keys = prefix_keys(contents)
+
+    config: Dict[str, Any] = {}
+    start = 0
+    if cache is not None:
+        # the longest run of unchanged layers from the bottom that's been merged before
+        for index in range(len(keys) - 1, -1, -1):
+            cached = cache.get("prefix", keys[index])
+            if cached is not None:
+                logger.info("Using the cached merge up to {}", layer_files[index])
+                config = cached
+                start = index + 1
+                break
+
+    for index in range(start, len(layer_files)):
+        layer_file_content = load_layer(layer_files[index], contents[index], cache)
+        config = recursive_update(layer_file_content, config)
+        if cache is not None:
+            cache.put("prefix", keys[index], config)
+    return config
+
+
+def load_layer(layer_file: Path, data: bytes, cache: Optional[LayerCache] = None) -> Any:
+    """parse a layer file's contents, unless it's in the cache"""
+    key = layer_key(data)
+    if cache is not None:
+        cached = cache.get("layer", key)
+        if cached is not None:
+            return cached
+    logger.info("Loading {}", layer_file)
+    parsed = yaml.safe_load(data)
+    if cache is not None:
+        cache.put("layer", key, parsed)
+    return parsed
+
+
+def read_layer_list(config_dir: str, id: str) -> Optional[List[Path]]:
+    """the layer files for an id, or None (having logged why) if they're not all there"""
+    layer_list_file = Path(os.path.join(config_dir, f"layers-{id}.yml"))
+
+    if not layer_list_file.exists():
+        logger.error("Can't find {}", layer_list_file)
+        return None
+
+    layers = yaml.safe_load(layer_list_file.read_text()).get("layers", [])
+
+    if not layers:
+        logger.error("No layers found in {}", layer_list_file)
+        return None
+
+    layer_files = []
+    for layer in layers:
+        layer_file = Path(os.path.join(config_dir, f"{layer}"))
+        if not layer_file.exists():
+            logger.error("Can't find  layer file {}", layer_file)
+            return None
+        layer_files.append(layer_file)
+    return layer_files
+
+
+def _new_file_mode() -> int:
+    """the mode open() would give a new file"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def write_if_changed(path: Path, content: str) -> bool:
+    """write a file by renaming a temporary file over it, if the content's different
+
+    The temporary file's created 0600, so it's given the existing file's mode,
+    or the usual mode for a new file, before it's renamed.
+    """
+    data = content.encode("utf-8")
+    try:
+        if path.read_bytes() == data:
+            return False
+        mode = stat.S_IMODE(path.stat().st_mode)
+    except FileNotFoundError:
+        mode = _new_file_mode()
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as fh:
+        fh.write(data)
+    os.chmod(fh.name, mode)
+    os.replace(fh.name, path)
+    return True
+
+
+def _copy_dicts(config: Any) -> Any:
+    """copy the nested dicts, which recursive_update changes, but not the values"""
+    if not isinstance(config, dict):
+        return config
+    return {key: _copy_dicts(value) for key, value in config.items()}
+
+
+def _parse_in_worker(layer_file: Path, cache_dir: Optional[Path]) -> Any:
+    return load_layer(
+        layer_file,
+        layer_file.read_bytes(),
+        LayerCache(cache_dir) if cache_dir is not None else None,
+    )
+
+
+def _render_in_worker(path: Path, config: Dict[str, Any], write: bool) -> Tuple[Path, bool]:
+    output = yaml.dump(config)
+    if not write:
+        try:
+            return path, path.read_text() != output
+        except FileNotFoundError:
+            return path, True
+    return path, write_if_changed(path, output)
+
+
+def build_all(
+    config_dir: str,
+    cache_dir: Optional[Path] = None,
+    jobs: Optional[int] = None,
+    write: bool = True,
+) -> Optional[Dict[str, bool]]:
+    """render every layers-*.yml in the config dir, returning whether each id's output changed
+
+    The layer lists make a tree of shared prefixes, eg every node starting with
+    config-base.yml. Each layer file's parsed once, each shared prefix is merged
+    once, and the YAML's rendered and written in a process pool.
+    """
+    ids = sorted(
+        path.name[len("layers-") : -len(".yml")]
+        for path in Path(config_dir).glob("layers-*.yml")
+    )
+    if not ids:
+        logger.error("No layers-*.yml files found in {}", config_dir)
+        return None
+    layer_lists: Dict[str, List[Path]] = {}
+    for id in ids:
+        layer_files = read_layer_list(config_dir, id)
+        if layer_files is None:
+            return None
+        layer_lists[id] = layer_files
+
+    unique = sorted({layer_file for layer_files in layer_lists.values() for layer_file in layer_files})
+    with ProcessPoolExecutor(jobs) as pool:
+        parsed = dict(
+            zip(unique, pool.map(_parse_in_worker, unique, [cache_dir] * len(unique)))
+        )
+
+        # merged config for each prefix of a layer list
+        prefixes: Dict[Tuple[Path, ...], Dict[str, Any]] = {(): {}}
+        configs = []
+        for id in ids:
+            layer_files = layer_lists[id]
+            for length in range(1, len(layer_files) + 1):
+                prefix = tuple(layer_files[:length])
+                if prefix not in prefixes:
+                    prefixes[prefix] = recursive_update(
+                        parsed[prefix[-1]], _copy_dicts(prefixes[prefix[:-1]])
+                    )
+            configs.append(prefixes[tuple(layer_files)])
+        logger.info(
+            "Merged {} layer files into {} configs with {} merges",
+            len(unique),
+            len(ids),
+            len(prefixes) - 1,
+        )
+
+        outputs = [Path(os.path.join(config_dir, f"layered-{id}.yml")) for id in ids]
+        results = pool.map(_render_in_worker, outputs, configs, [write] * len(ids))
+        changed = {id: was_changed for id, (_, was_changed) in zip(ids, results)}
+    if cache_dir is not None:
+        LayerCache(cache_dir).prune(live_entries(layer_lists.values()))
+    return changed
+
+
+class Fleet:
+    """every node's layer list and parsed layers, held in memory for watch mode
+
+    `users` maps each layer file to the ids whose layer lists include it, so a
+    changed file only rebuilds the configs that use it.
+    """
+
+    def __init__(self, config_dir: str, cache: Optional[LayerCache] = None) -> None:
+        self.config_dir = config_dir
+        self.cache = cache
+        self.layer_lists: Dict[str, List[Path]] = {}
+        self.users: Dict[Path, Set[str]] = {}
+        # layer file -> (content hash, parsed)
+        self.parsed: Dict[Path, Tuple[str, Any]] = {}
+
+    def ids(self) -> List[str]:
+        return sorted(
+            path.name[len("layers-") : -len(".yml")]
+            for path in Path(self.config_dir).glob("layers-*.yml")
+        )
+
+    def directories(self) -> Set[Path]:
+        """every directory with a layer list or layer file in it"""
+        return {Path(self.config_dir)} | {path.parent for path in self.users}
+
+    def load_list(self, id: str) -> bool:
+        """(re)read an id's layer list, returns False if it's missing or broken"""
+        for layer_file in self.layer_lists.pop(id, []):
+            self.users.get(layer_file, set()).discard(id)
+        try:
+            layer_files = read_layer_list(self.config_dir, id)
+        except (OSError, yaml.YAMLError, AttributeError) as error:
+            logger.error("Can't read the layer list for {}: {}", id, error)
+            return False
+        if layer_files is None:
+            return False
+        self.layer_lists[id] = layer_files
+        for layer_file in layer_files:
+            self.users.setdefault(layer_file, set()).add(id)
+        return True
+
+    def layer(self, layer_file: Path) -> Any:
+        """a parsed layer, only parsing it again if its contents have changed"""
+        data = layer_file.read_bytes()
+        key = content_hash(data)
+        cached = self.parsed.get(layer_file)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        parsed = load_layer(layer_file, data, self.cache)
+        self.parsed[layer_file] = (key, parsed)
+        return parsed
+
+    def affected(self, changed: Set[Path]) -> Set[str]:
+        """the ids to rebuild after some files changed"""
+        ids: Set[str] = set()
+        config_dir = Path(self.config_dir)
+        for path in changed:
+            name = path.name
+            if path.parent == config_dir and name.startswith("layers-") and name.endswith(".yml"):
+                id = name[len("layers-") : -len(".yml")]
+                if self.load_list(id):
+                    ids.add(id)
+            elif path in self.users:
+                previous = self.parsed.get(path)
+                try:
+                    if previous is not None and previous[0] == content_hash(path.read_bytes()):
+                        # touched, or saved without changes
+                        continue
+                except FileNotFoundError:
+                    pass
+                self.parsed.pop(path, None)
+                ids.update(self.users[path])
+        return ids
+
+    def build(self, ids: Set[str], write: bool = True) -> Dict[str, bool]:
+        """render some ids, returning whether each one's output changed"""
+        changed = {}
+        # shared prefixes are only merged once in each rebuild
+        prefixes: Dict[Tuple[Path, ...], Dict[str, Any]] = {(): {}}
+        for id in sorted(ids):
+            layer_files = self.layer_lists.get(id)
+            if layer_files is None:
+                continue
+            try:
+                for length in range(1, len(layer_files) + 1):
+                    prefix = tuple(layer_files[:length])
+                    if prefix not in prefixes:
+                        prefixes[prefix] = recursive_update(
+                            self.layer(prefix[-1]), _copy_dicts(prefixes[prefix[:-1]])
+                        )
+            except (OSError, yaml.YAMLError) as error:
+                logger.error("Can't build {}: {}", id, error)
+                continue
+            output = yaml.dump(prefixes[tuple(layer_files)])
+            yaml_file = Path(os.path.join(self.config_dir, f"layered-{id}.yml"))
+            changed[id] = write_if_changed(yaml_file, output) if write else True
+        return changed
+
+
+def watch(
+    config_dir: str,
+    cache: Optional[LayerCache] = None,
+    debounce: float = 0.2,
+    watcher: Optional[Watcher] = None,
+    rounds: Optional[int] = None,
+) -> None:
+    """rebuild the affected layered-*.yml files whenever a layer or layer list changes
+
+    `rounds` stops after that many batches of changes, for testing.
+    """
+    fleet = Fleet(config_dir, cache)
+    for id in fleet.ids():
+        fleet.load_list(id)
+    built = fleet.build(set(fleet.layer_lists))
+    logger.info("Built {} configs, {} changed", len(built), sum(built.values()))
+    if cache is not None:
+        cache.prune(live_entries(fleet.layer_lists.values()))
+
+    watcher = watcher or make_watcher()
+    try:
+        for directory in fleet.directories():
+            watcher.add(directory)
+        logger.info("Watching {} for changes", config_dir)
+        while rounds is None or rounds > 0:
+            changed = wait_for_changes(watcher, debounce)
+            ids = fleet.affected(changed)
+            # a layer list might have added a layer from another directory
+            for directory in fleet.directories():
+                watcher.add(directory)
+            if ids:
+                for id, was_changed in fleet.build(ids).items():
+                    if was_changed:
+                        logger.info("Rebuilt layered-{}.yml", id)
+                if cache is not None:
+                    cache.prune(live_entries(fleet.layer_lists.values()))
+            if rounds is not None:
+                rounds -= 1
+    finally:
+        watcher.close()
+
+
 @click.command()
-@click.argument("id")
+@click.argument("id", required=False)
 @click.option(
     "--config-dir", "-c", default="configs", help="Directory containing the configs"
 )
 @click.option("--debug", "-d", is_flag=True, help="Enable debug logging")
 @click.option("--no-write", "-n", is_flag=True, help="Don't write the output to a file")
+@click.option(
+    "--cache-dir",
+    help="Where to cache parsed and merged layers, defaults to .layer-cache in the config dir",
+)
+@click.option("--no-cache", is_flag=True, help="Parse and merge every layer from scratch")
+@click.option(
+    "--all", "all_ids", is_flag=True, help="Build every layers-*.yml in the config dir"
+)
+@click.option("--jobs", "-j", type=int, help="Processes to use with --all, defaults to the number of CPUs")
+@click.option(
+    "--watch", "watch_mode", is_flag=True, help="Keep running, rebuilding configs when their layers change"
+)
+@click.option("--poll", is_flag=True, help="With --watch, poll for changes instead of using inotify")
 def main(
-    id: str,
+    id: Optional[str] = None,
     config_dir: str = "configs",
     debug: Optional[bool] = False,
     no_write: Optional[bool] = False,
+    cache_dir: Optional[str] = None,
+    no_cache: Optional[bool] = False,
+    all_ids: Optional[bool] = False,
+    jobs: Optional[int] = None,
+    watch_mode: Optional[bool] = False,
+    poll: Optional[bool] = False,
 ) -> int:
     """layer the configs and output a yml file"""
+    global DEBUG
+    DEBUG = bool(debug)
 
     if debug is not None and debug:
         logger.remove()
@@ -45,35 +497,49 @@ def main(
         logger.remove()
         logger.add(sys.stderr, level="INFO")
 
-    layer_list_file = Path(os.path.join(config_dir, f"layers-{id}.yml"))
+    cache_path = None
+    if not no_cache:
+        cache_path = Path(cache_dir or os.path.join(config_dir, ".layer-cache"))
 
-    if not layer_list_file.exists():
-        logger.error("Can't find {}", layer_list_file)
+    if watch_mode:
+        try:
+            watch(
+                config_dir,
+                LayerCache(cache_path) if cache_path is not None else None,
+                watcher=make_watcher(poll=bool(poll)),
+            )
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if all_ids:
+        changed = build_all(config_dir, cache_path, jobs, write=not no_write)
+        if changed is None:
+            return 1
+        for changed_id, was_changed in changed.items():
+            if was_changed:
+                logger.info("{} layered-{}.yml", "Would write" if no_write else "Wrote", changed_id)
+        logger.info("{} of {} configs changed", sum(changed.values()), len(changed))
+        return 0
+    if id is None:
+        logger.error("Give an id, or --all to build them all")
         return 1
 
-    layers = yaml.safe_load(layer_list_file.read_text()).get("layers", [])
-
-    if not layers:
-        logger.error("No layers found in {}", layer_list_file)
+    layer_files = read_layer_list(config_dir, id)
+    if layer_files is None:
         return 1
+    cache = LayerCache(cache_path) if cache_path is not None else None
+    # not pruned, that'd mean reading every other id's layers too
+    config = compose(layer_files, cache)
 
-    config: Dict[str, Any] = {}
-
-    for layer in layers:
-        layer_file = Path(os.path.join(config_dir, f"{layer}"))
-        if not layer_file.exists():
-            logger.error("Can't find  layer file {}", layer_file)
-            return 1
-        logger.info("Loading {}", layer_file)
-        layer_file_content = yaml.safe_load(layer_file.read_text())
-        config = recursive_update(layer_file_content, config)
-
-    print(yaml.dump(config))
+    output = yaml.dump(config)
+    print(output)
     if no_write is not None and no_write:
         return 0
     yaml_file = Path(os.path.join(config_dir, f"layered-{id}.yml"))
-    logger.info("Writing to {}", yaml_file)
-    yaml_file.write_text(yaml.dump(config))
+    if write_if_changed(yaml_file, output):
+        logger.info("Wrote {}", yaml_file)
+    else:
+        logger.info("{} hasn't changed", yaml_file)
     return 0
 
 
@@ -0,0 +1,313 @@
+""" counters and histograms for the decode path, served in the Prometheus text format
+
+Each thread that records a value gets its own cell to add to, so recording
+never takes a lock - the cells are only summed up when something asks for them.
+Cells of threads that have finished are folded into one shared total, so a
+thread per connection doesn't leave a cell per connection behind.
+"""
+
+import bisect
+import copy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from typing import Any, Callable, Optional
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, for decode latency
+DEFAULT_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.1,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _PerThread:
+    """ hands each thread its own cell, remembering them all for collection
+
+    `merge(total, cell)` adds a finished thread's cell into the shared total.
+    """
+
+    def __init__(
+        self, factory: Callable[[], Any], merge: Callable[[Any, Any], None]
+    ) -> None:
+        self._factory = factory
+        self._merge = merge
+        self._local = threading.local()
+        self._retired = factory()
+        self._cells: list[tuple[threading.Thread, Any]] = []
+        self._lock = threading.Lock()
+
+    def cell(self) -> Any:
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._factory()
+            self._local.cell = cell
+            with self._lock:
+                self._retire()
+                self._cells.append((threading.current_thread(), cell))
+            return cell
+
+    def _retire(self) -> None:
+        """ fold the cells of finished threads into the total, they can't change now """
+        live = []
+        for thread, cell in self._cells:
+            if thread.is_alive():
+                live.append((thread, cell))
+            else:
+                self._merge(self._retired, cell)
+        self._cells = live
+
+    def cells(self) -> list[Any]:
+        """ copies of the cells, so a concurrent fold can't count anything twice """
+        with self._lock:
+            self._retire()
+            cells = [self._retired] + [cell for _, cell in self._cells]
+            return [copy.copy(cell) for cell in cells]
+
+
+def _merge_counts(total: dict[str, float], cell: dict[str, float]) -> None:
+    for label_value, value in cell.items():
+        total[label_value] = total.get(label_value, 0) + value
+
+
+def _merge_buckets(total: list[float], cell: list[float]) -> None:
+    for index, value in enumerate(cell):
+        total[index] += value
+
+
+class Counter:
+    """ a counter, optionally split up by the value of one label """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label: Optional[str] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._cells = _PerThread(dict, _merge_counts)
+
+    def inc(self, amount: float = 1, label_value: str = "") -> None:
+        cell = self._cells.cell()
+        cell[label_value] = cell.get(label_value, 0) + amount
+
+    def collect(self) -> dict[str, float]:
+        """ label value -> total across all threads """
+        result: dict[str, float] = {}
+        for cell in self._cells.cells():
+            _merge_counts(result, cell)
+        return result
+
+    def add(self, totals: dict[str, float]) -> None:
+        """ add label value -> amount, eg counted in another process """
+        _merge_counts(self._cells.cell(), totals)
+
+    def render(self) -> list[str]:
+        lines = []
+        for label_value, value in sorted(self.collect().items()):
+            if self.label is None:
+                lines.append(f"{self.name}_total {value}")
+            else:
+                lines.append(
+                    f'{self.name}_total{{{self.label}="{_escape(label_value)}"}} {value}'
+                )
+        return lines
+
+
+class Histogram:
+    """ a histogram with fixed buckets """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        # bucket counts, then the +Inf bucket, then the sum
+        self._cells = _PerThread(lambda: [0.0] * (len(buckets) + 2), _merge_buckets)
+
+    def observe(self, value: float) -> None:
+        cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def totals(self) -> list[float]:
+        """ the count in each bucket (not cumulative), then +Inf, then the sum """
+        totals = [0.0] * (len(self.buckets) + 2)
+        for cell in self._cells.cells():
+            _merge_buckets(totals, cell)
+        return totals
+
+    def add(self, totals: list[float]) -> None:
+        """ add bucket counts and a sum like `totals()`, from another process """
+        _merge_buckets(self._cells.cell(), totals)
+
+    def collect(self) -> tuple[list[float], float]:
+        """ cumulative bucket counts (with +Inf last) and the sum """
+        totals = self.totals()
+        cumulative = []
+        running = 0.0
+        for value in totals[:-1]:
+            running += value
+            cumulative.append(running)
+        return cumulative, totals[-1]
+
+    def render(self) -> list[str]:
+        cumulative, total = self.collect()
+        lines = []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], cumulative):
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative[-1]}")
+        return lines
+
+
+class Callback:
+    """ a value that's read when the metrics are collected, eg a queue depth """
+
+    def __init__(
+        self, name: str, documentation: str, func: Callable[[], float], kind: str = "gauge"
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        suffix = "_total" if self.kind == "counter" else ""
+        return [f"{self.name}{suffix} {self.func()}"]
+
+
+class Registry:
+    """ all the metrics, so they can be rendered together """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Histogram | Callback] = {}
+
+    def counter(self, name: str, documentation: str, label: Optional[str] = None) -> Counter:
+        counter = Counter(name, documentation, label)
+        self._metrics[name] = counter
+        return counter
+
+    def histogram(
+        self, name: str, documentation: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        histogram = Histogram(name, documentation, buckets)
+        self._metrics[name] = histogram
+        return histogram
+
+    def callback(
+        self, name: str, documentation: str, func: Callable[[], float], kind: str = "gauge"
+    ) -> Callback:
+        """ register (or replace) a metric that's read from a function """
+        callback = Callback(name, documentation, func, kind)
+        self._metrics[name] = callback
+        return callback
+
+    def snapshot(self) -> dict[str, Any]:
+        """ the current values, for pulling from python rather than over HTTP """
+        result: dict[str, Any] = {}
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Counter):
+                values = metric.collect()
+                result[name] = values.get("", 0) if metric.label is None else values
+            elif isinstance(metric, Histogram):
+                cumulative, total = metric.collect()
+                result[name] = {"count": cumulative[-1], "sum": total}
+            else:
+                result[name] = metric.func()
+        return result
+
+    def totals(self) -> dict[str, Any]:
+        """ the counters' and histograms' totals, for passing to `changes` """
+        result: dict[str, Any] = {}
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Counter):
+                result[name] = metric.collect()
+            elif isinstance(metric, Histogram):
+                result[name] = metric.totals()
+        return result
+
+    def add(self, changes: dict[str, Any]) -> None:
+        """ add what `changes` says another process recorded, eg a worker """
+        for name, values in changes.items():
+            metric = self._metrics.get(name)
+            if isinstance(metric, (Counter, Histogram)):
+                metric.add(values)
+
+    def render(self) -> str:
+        """ the Prometheus text exposition format
+
+        In 0.0.4 a counter's samples have to be named after its family, so like
+        prometheus_client the family's `<name>_total`, not `<name>`.
+        """
+        lines = []
+        for name, metric in self._metrics.items():
+            if metric.kind == "counter":
+                name = f"{name}_total"
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def changes(after: dict[str, Any], before: dict[str, Any]) -> dict[str, Any]:
+    """ what's been recorded between two `Registry.totals()`, if anything """
+    result: dict[str, Any] = {}
+    for name, values in after.items():
+        previous = before.get(name)
+        if isinstance(values, dict):
+            previous = previous or {}
+            counts = {
+                label_value: value - previous.get(label_value, 0)
+                for label_value, value in values.items()
+                if value != previous.get(label_value, 0)
+            }
+            if counts:
+                result[name] = counts
+        elif values != previous:
+            previous = previous or [0.0] * len(values)
+            result[name] = [value - old for value, old in zip(values, previous, strict=True)]
+    return result
+
+
+def serve(registry: Registry, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """ serve /metrics from a background thread """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_args: Any) -> None:
+            # don't spam stderr with every scrape
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
+
+
+METRICS = Registry()
@@ -0,0 +1,171 @@
+""" a bounded cache of node names, which can be snapshotted to SQLite """
+
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    num INTEGER PRIMARY KEY,
+    short_name TEXT NOT NULL,
+    long_name TEXT NOT NULL,
+    last_heard REAL NOT NULL
+)
+"""
+
+
+class NodeInfo:
+    """ what we know about a node """
+
+    __slots__ = ("short_name", "long_name", "last_heard")
+
+    def __init__(self, short_name: str, long_name: str, last_heard: float) -> None:
+        self.short_name = short_name
+        self.long_name = long_name
+        self.last_heard = last_heard
+
+    def __repr__(self) -> str:
+        return f"NodeInfo({self.short_name!r}, {self.long_name!r}, {self.last_heard})"
+
+
+class NodeDirectory:
+    """ node names keyed by node number, with LRU and TTL eviction
+
+    If there's a `path`, changed entries are written to the SQLite file at most
+    every `save_interval` seconds, and `load` reads them back on startup.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 100000,
+        ttl: float = 7 * 86400,
+        path: Optional[Path] = None,
+        save_interval: float = 60.0,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.capacity = capacity
+        self.ttl = ttl
+        self.path = path
+        self.save_interval = save_interval
+        self.clock = clock
+        self._nodes: OrderedDict[int, NodeInfo] = OrderedDict()
+        self._dirty: set[int] = set()
+        self._last_save = clock()
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, num: int) -> bool:
+        return self.get(num) is not None
+
+    def get(self, num: int) -> Optional[NodeInfo]:
+        """ look up a node, expired nodes are dropped """
+        node = self._nodes.get(num)
+        if node is None:
+            return None
+        if self.clock() - node.last_heard > self.ttl:
+            del self._nodes[num]
+            return None
+        self._nodes.move_to_end(num)
+        return node
+
+    def short_name(self, num: int) -> Optional[str]:
+        """ the node's short name, if we know it """
+        node = self.get(num)
+        return node.short_name if node is not None else None
+
+    def update(self, num: int, short_name: str, long_name: str) -> NodeInfo:
+        """ record a node's names, usually from a NODEINFO packet """
+        node = self._nodes.get(num)
+        now = self.clock()
+        if node is None:
+            node = NodeInfo(short_name, long_name, now)
+            self._nodes[num] = node
+            if len(self._nodes) > self.capacity:
+                self._nodes.popitem(last=False)
+        else:
+            node.short_name = short_name
+            node.long_name = long_name
+            node.last_heard = now
+            self._nodes.move_to_end(num)
+        self._dirty.add(num)
+        self.maybe_save()
+        return node
+
+    def heard(self, num: int) -> Optional[NodeInfo]:
+        """ look up a node we've just heard from, bumping its last heard time """
+        node = self.get(num)
+        if node is not None:
+            node.last_heard = self.clock()
+            self._dirty.add(num)
+        return node
+
+    def maybe_save(self) -> None:
+        """ save if there's a path and it's been long enough """
+        if self.path is not None and self.clock() - self._last_save >= self.save_interval:
+            self.save()
+
+    def _connect(self, path: Path) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(SCHEMA)
+        return conn
+
+    def save(self, path: Optional[Path] = None) -> None:
+        """ write changed entries to the SQLite snapshot """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to save the node directory to")
+        self._last_save = self.clock()
+        rows = []
+        for num in self._dirty:
+            node = self._nodes.get(num)
+            if node is not None:
+                rows.append((num, node.short_name, node.long_name, node.last_heard))
+        self._dirty.clear()
+        if not rows:
+            return
+        conn = self._connect(path)
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO nodes (num, short_name, long_name, last_heard) "
+                    "VALUES (?, ?, ?, ?) ON CONFLICT(num) DO UPDATE SET "
+                    "short_name=excluded.short_name, long_name=excluded.long_name, "
+                    "last_heard=max(last_heard, excluded.last_heard)",
+                    rows,
+                )
+        finally:
+            conn.close()
+
+    @classmethod
+    def load(
+        cls,
+        path: Path,
+        capacity: int = 100000,
+        ttl: float = 7 * 86400,
+        save_interval: float = 60.0,
+        clock: Callable[[], float] = time.time,
+    ) -> "NodeDirectory":
+        """ build a directory from a snapshot, creating it if it's not there """
+        directory = cls(capacity, ttl, path, save_interval, clock)
+        conn = directory._connect(path)
+        try:
+            with conn:
+                conn.execute(
+                    "DELETE FROM nodes WHERE last_heard < ?",
+                    (directory.clock() - directory.ttl,),
+                )
+            rows = conn.execute(
+                "SELECT num, short_name, long_name, last_heard FROM nodes "
+                "ORDER BY last_heard DESC LIMIT ?",
+                (directory.capacity,),
+            ).fetchall()
+        finally:
+            conn.close()
+        # oldest first, so the LRU order matches
+        for num, short_name, long_name, last_heard in reversed(rows):
+            directory._nodes[num] = NodeInfo(short_name, long_name, last_heard)
+        return directory
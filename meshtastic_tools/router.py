@@ -0,0 +1,106 @@
+""" turn whatever's published to the broker into JSON, in process
+
+This does what `meshtastic_benthos/meshtastic.blobl` does in Benthos:
+
+- `.../stat` topics are wrapped as `{"value": "..."}`
+- LongFast topics are parsed as JSON, falling back to `{"message": base64, "binary": true}`
+- anything else is parsed as JSON, falling back to `{"message": "..."}`
+- numbers and strings are wrapped as `{"value": ...}`
+- the topic's added to the result as `topic`
+
+If `route` is given a `decode` function, binary payloads on LongFast and the
+other ServiceEnvelope topics (`/2/e/`, `/2/c/` and `/2/map/`) are handed to it
+rather than being base64'd, so they go straight to the protobuf decoder.
+"""
+
+import base64
+import json
+import re
+from typing import Any, Callable, Optional
+
+# what the Benthos config subscribes to
+TOPICS = ["msh/#", "meshtastic/#", "rdz_sonde_server/#"]
+
+Decoder = Callable[[bytes | memoryview], Optional[dict[str, Any]]]
+Handler = Callable[[bytes | memoryview, Optional[Decoder]], Optional[Any]]
+
+# a JSON document can only start with one of these, after any whitespace
+JSON_START = frozenset(b'{["-0123456789tfn')
+# topics are cached against their handler, up to this many
+MAX_CACHED_TOPICS = 65536
+
+
+def _json(payload: bytes | memoryview) -> Any:
+    """ the parsed JSON, raises ValueError if it isn't any """
+    data = bytes(payload)
+    stripped = data.lstrip()
+    if not stripped or stripped[0] not in JSON_START:
+        # a protobuf or plain text, don't bother trying to parse it
+        raise ValueError("not JSON")
+    return json.loads(data)
+
+
+def _stat(payload: bytes | memoryview, _decode: Optional[Decoder]) -> Any:
+    return {"value": bytes(payload).decode("utf-8", errors="replace")}
+
+
+def _binary(payload: bytes | memoryview, decode: Optional[Decoder]) -> Optional[Any]:
+    try:
+        return _json(payload)
+    except ValueError:
+        pass
+    if decode is not None:
+        return decode(payload)
+    return {"message": base64.b64encode(payload).decode("ascii"), "binary": True}
+
+
+def _text(payload: bytes | memoryview, _decode: Optional[Decoder]) -> Any:
+    try:
+        return _json(payload)
+    except ValueError:
+        return {"message": bytes(payload).decode("utf-8", errors="replace")}
+
+
+def _protobuf(payload: bytes | memoryview, decode: Optional[Decoder]) -> Optional[Any]:
+    if decode is None:
+        # the bloblang mapping treats these like any other topic
+        return _text(payload, decode)
+    return _binary(payload, decode)
+
+
+# checked in order, the first match wins, like the if/else in the bloblang
+ROUTES: list[tuple[re.Pattern[str], Handler]] = [
+    (re.compile(r"^[a-z]+/[a-zA-Z0-9]{4}/[0-9]+/stat"), _stat),
+    (re.compile(r"LongFast"), _binary),
+    (re.compile(r"(?:^|/)2/(?:c|e|map)/"), _protobuf),
+]
+
+_handlers: dict[str, Handler] = {}
+
+
+def handler_for(topic: str) -> Handler:
+    """ which handler a topic goes to """
+    handler = _handlers.get(topic)
+    if handler is None:
+        handler = next(
+            (handler for pattern, handler in ROUTES if pattern.search(topic)), _text
+        )
+        if len(_handlers) >= MAX_CACHED_TOPICS:
+            _handlers.clear()
+        _handlers[topic] = handler
+    return handler
+
+
+def route(
+    topic: str, payload: bytes | memoryview, decode: Optional[Decoder] = None
+) -> Optional[dict[str, Any]]:
+    """ the JSON object for a message, or None if `decode` didn't return anything """
+    result = handler_for(topic)(payload, decode)
+    if result is None:
+        return None
+    if not isinstance(result, dict):
+        # the bloblang only wraps numbers and strings, anything else would fail
+        # when the topic's added, so they're wrapped too
+        result = {"value": result}
+    result["topic"] = topic
+    return result
@@ -0,0 +1,202 @@
+""" a faster MessageToDict, with converters built once per message type
+
+The output matches google.protobuf.json_format.MessageToDict with its default
+options - camelCase keys, int64s as strings, enums as names, bytes as base64
+and only the fields that are set.
+"""
+
+import base64
+import functools
+import json
+import math
+from typing import Any, Callable, Optional
+
+from google.protobuf.descriptor import FieldDescriptor  # type: ignore
+from google.protobuf.internal import type_checkers  # type: ignore
+from google.protobuf.json_format import MessageToDict  # type: ignore
+
+# None means the value can be used as-is
+_Converter = Optional[Callable[[Any], Any]]
+
+_TABLES: dict[str, dict[int, tuple[str, _Converter]]] = {}
+
+_INT64_TYPES = (FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT64)
+
+# orjson's optional, and only imported when it's used
+OUTPUT_FORMATS = ("json", "orjson")
+
+
+def _is_repeated(field: Any) -> bool:
+    is_repeated = getattr(field, "is_repeated", None)
+    if is_repeated is not None:
+        return bool(is_repeated)
+    return bool(field.label == FieldDescriptor.LABEL_REPEATED)
+
+
+def _is_map_entry(field: Any) -> bool:
+    message_type = field.message_type
+    return bool(
+        message_type is not None
+        and message_type.has_options
+        and message_type.GetOptions().map_entry
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_float(value: float) -> Any:
+    # ToShortestFloat is slow and the same readings come up a lot
+    if math.isinf(value):
+        return "-Infinity" if value < 0.0 else "Infinity"
+    if math.isnan(value):
+        return "NaN"
+    return type_checkers.ToShortestFloat(value)
+
+
+def _float(value: float) -> Any:
+    if value == 0.0:
+        # 0.0 and -0.0 are equal, so they'd share a cache entry
+        return type_checkers.ToShortestFloat(value)
+    return _cached_float(value)
+
+
+def _double(value: float) -> Any:
+    if math.isinf(value):
+        return "-Infinity" if value < 0.0 else "Infinity"
+    if math.isnan(value):
+        return "NaN"
+    return value
+
+
+def _bytes(value: bytes) -> str:
+    return base64.b64encode(value).decode("utf-8")
+
+
+def _enum_converter(field: Any) -> _Converter:
+    names = {value.number: value.name for value in field.enum_type.values}
+    if field.enum_type.full_name == "google.protobuf.NullValue":
+        return lambda value: None
+    return lambda value: names.get(value, value)
+
+
+def _scalar_converter(field: Any) -> _Converter:
+    """ the converter for a single value of a field """
+    cpp_type = field.cpp_type
+    if cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+        if field.message_type.full_name.startswith("google.protobuf."):
+            # well known types have their own JSON forms
+            return MessageToDict  # type: ignore[no-any-return]
+        return message_to_dict
+    if cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        return _enum_converter(field)
+    if cpp_type == FieldDescriptor.CPPTYPE_STRING:
+        return _bytes if field.type == FieldDescriptor.TYPE_BYTES else None
+    if cpp_type == FieldDescriptor.CPPTYPE_BOOL:
+        return bool
+    if cpp_type in _INT64_TYPES:
+        return str
+    if cpp_type == FieldDescriptor.CPPTYPE_FLOAT:
+        return _float
+    if cpp_type == FieldDescriptor.CPPTYPE_DOUBLE:
+        return _double
+    return None
+
+
+def _field_converter(field: Any) -> _Converter:
+    """ the converter for a whole field, dealing with repeated and map fields """
+    if _is_map_entry(field):
+        key_field = field.message_type.fields_by_name["key"]
+        value_convert = _scalar_converter(field.message_type.fields_by_name["value"])
+        bool_keys = key_field.cpp_type == FieldDescriptor.CPPTYPE_BOOL
+
+        def convert_map(value: Any) -> dict[str, Any]:
+            result = {}
+            for key in value:
+                if bool_keys:
+                    name = "true" if key else "false"
+                else:
+                    name = str(key)
+                item = value[key]
+                result[name] = item if value_convert is None else value_convert(item)
+            return result
+
+        return convert_map
+
+    convert = _scalar_converter(field)
+    if _is_repeated(field):
+        if convert is None:
+            return list
+        element_convert = convert
+        return lambda value: [element_convert(item) for item in value]
+    return convert
+
+
+def _table(message_descriptor: Any) -> dict[int, tuple[str, _Converter]]:
+    """ field number -> (json name, converter), built once per message type """
+    table = _TABLES.get(message_descriptor.full_name)
+    if table is None:
+        table = {}
+        # register it first, so recursive message types find it
+        _TABLES[message_descriptor.full_name] = table
+        for field in message_descriptor.fields:
+            table[field.number] = (field.json_name, _field_converter(field))
+    return table
+
+
+def message_to_dict(message: Any) -> dict[str, Any]:
+    """ the same output as MessageToDict(message), but quicker """
+    message_descriptor = message.DESCRIPTOR
+    if message_descriptor.full_name.startswith("google.protobuf."):
+        return MessageToDict(message)  # type: ignore[no-any-return]
+    table = _table(message_descriptor)
+    result: dict[str, Any] = {}
+    for field, value in message.ListFields():
+        entry = table.get(field.number)
+        if entry is None or field.is_extension:
+            # extensions aren't in the table, let protobuf deal with them
+            return MessageToDict(message)  # type: ignore[no-any-return]
+        name, convert = entry
+        result[name] = value if convert is None else convert(value)
+    return result
+
+
+def json_default(value: Any) -> Any:
+    """ raw payloads end up base64'd in the JSON output """
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Can't serialize {type(value)}")
+
+
+def _orjson() -> Any:
+    try:
+        import orjson  # type: ignore[import-not-found,unused-ignore]
+    except ImportError:
+        raise ImportError(
+            "orjson output needs orjson, pip install 'meshtastic-tools[orjson]'"
+        ) from None
+    return orjson
+
+
+def check_output_format(output_format: str) -> None:
+    """ raise ValueError or ImportError now, rather than on the first message """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}")
+    if output_format == "orjson":
+        _orjson()
+
+
+def dumps(
+    message: dict[str, Any],
+    output_format: str = "json",
+    default: Optional[Callable[[Any], Any]] = None,
+) -> bytes:
+    """ serialize a decoded message
+
+    "json" is byte for byte the same as json.dumps, "orjson" has the same keys
+    and values but no spaces.
+    """
+    if output_format == "json":
+        return json.dumps(message, default=default).encode("utf-8")
+    if output_format == "orjson":
+        result: bytes = _orjson().dumps(message, default=default)
+        return result
+    raise ValueError(f"Unknown output format {output_format}")
@@ -0,0 +1,312 @@
+""" where decoded packets end up, with writes batched up rather than one per packet """
+
+import abc
+import base64
+import json
+import os
+from pathlib import Path
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Optional
+
+from meshtastic_tools.serializer import json_default
+
+SINK_TYPES = ("stdout", "ndjson", "parquet", "sqlite")
+
+
+class Sink(abc.ABC):
+    """ buffers decoded packets and writes them out in batches
+
+    A batch is written when it reaches `batch_size` packets, or when it's been
+    `flush_interval` seconds since the last write - that's checked by a
+    background thread, so a quiet feed still gets written out.
+
+    If writing a batch fails it's logged, counted in `failed` and dropped, so a
+    full disk or a locked database doesn't stop the decoder feeding the sink.
+    """
+
+    def __init__(self, batch_size: int = 1000, flush_interval: float = 5.0) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.failed = 0
+        self._lines: list[str] = []
+        # the decoded packet for each line, when the caller still had it
+        self._messages: list[Optional[dict[str, Any]]] = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._last_flush = time.monotonic()
+        self._timer: Optional[threading.Thread] = None
+        if flush_interval > 0 and batch_size > 1:
+            self._timer = threading.Thread(
+                target=self._flush_timer,
+                name=f"{type(self).__name__}-flush",
+                daemon=True,
+            )
+            self._timer.start()
+
+    def write(self, message: dict[str, Any]) -> None:
+        """ add a decoded packet """
+        self.write_line(json.dumps(message, default=json_default), message)
+
+    def write_line(self, line: str, message: Optional[dict[str, Any]] = None) -> None:
+        """ add a packet that's already been turned into a line of JSON
+
+        Pass the decoded `message` too if it's to hand, so sinks that need
+        the fields don't have to parse the line again.
+        """
+        with self._lock:
+            self._lines.append(line)
+            self._messages.append(message)
+            if len(self._lines) >= self.batch_size:
+                self._flush()
+
+    def flush(self) -> None:
+        """ write out whatever's buffered """
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._lines:
+            return
+        lines, self._lines = self._lines, []
+        messages, self._messages = self._messages, []
+        try:
+            self.write_batch(lines, messages)
+        except Exception as error:
+            self.failed += len(lines)
+            print(
+                f"ERROR: {type(self).__name__} dropped {len(lines)} packets: {error}",
+                file=sys.stderr,
+            )
+            return
+        self.written += len(lines)
+
+    @abc.abstractmethod
+    def write_batch(
+        self, lines: list[str], messages: list[Optional[dict[str, Any]]]
+    ) -> None:
+        """ actually write a batch, lock's held when this is called
+
+        `messages` are the decoded packets, None where only the line was given.
+        """
+
+    @staticmethod
+    def decoded(
+        lines: list[str], messages: list[Optional[dict[str, Any]]]
+    ) -> list[dict[str, Any]]:
+        """ the decoded packets, only parsing the lines that came without one """
+        return [
+            message if message is not None else json.loads(line)
+            for line, message in zip(lines, messages)
+        ]
+
+    def _flush_timer(self) -> None:
+        while not self._closed.wait(self.flush_interval / 2):
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def close(self) -> None:
+        """ flush and let go of any files """
+        self._closed.set()
+        self.flush()
+
+    def __enter__(self) -> "Sink":
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.close()
+
+
+class StdoutSink(Sink):
+    """ the original behaviour, a line of JSON per packet on stdout """
+
+    def __init__(self, batch_size: int = 1, flush_interval: float = 1.0) -> None:
+        super().__init__(batch_size, flush_interval)
+
+    def write_batch(
+        self, lines: list[str], messages: list[Optional[dict[str, Any]]]
+    ) -> None:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+
+class NdjsonSink(Sink):
+    """ newline-delimited JSON files, rotated when they get too big
+
+    Rotated files get a numeric suffix, `packets.ndjson.1` being the newest.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_bytes: int = 100 * 1024 * 1024,
+        backup_count: int = 5,
+        batch_size: int = 1000,
+        flush_interval: float = 5.0,
+    ) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._fh = path.open("a", encoding="utf-8")
+        super().__init__(batch_size, flush_interval)
+
+    def _rotate(self) -> None:
+        self._fh.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{index}")
+            if source.exists():
+                os.replace(source, self.path.with_name(f"{self.path.name}.{index + 1}"))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+        self._fh = self.path.open("a", encoding="utf-8")
+
+    def write_batch(
+        self, lines: list[str], messages: list[Optional[dict[str, Any]]]
+    ) -> None:
+        self._fh.write("\n".join(lines) + "\n")
+        self._fh.flush()
+        if self.max_bytes > 0 and self._fh.tell() >= self.max_bytes:
+            self._rotate()
+
+    def close(self) -> None:
+        super().close()
+        self._fh.close()
+
+
+class SqliteSink(Sink):
+    """ a SQLite database in WAL mode, with a row per packet
+
+    The common fields get their own columns and the whole packet is kept as
+    JSON in `message`, so it can be picked apart with SQLite's JSON functions.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS packets (
+        received REAL NOT NULL,
+        channel INTEGER,
+        from_id TEXT,
+        to_id TEXT,
+        portnum TEXT,
+        message TEXT NOT NULL
+    )
+    """
+
+    def __init__(
+        self, path: Path, batch_size: int = 1000, flush_interval: float = 5.0
+    ) -> None:
+        self.path = path
+        # the flush timer thread uses it too, but only with the lock held
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(self.SCHEMA)
+        self._conn.commit()
+        super().__init__(batch_size, flush_interval)
+
+    def write_batch(
+        self, lines: list[str], messages: list[Optional[dict[str, Any]]]
+    ) -> None:
+        now = time.time()
+        rows = []
+        for line, message in zip(lines, self.decoded(lines, messages)):
+            rows.append(
+                (
+                    now,
+                    message.get("channel"),
+                    message.get("from_id"),
+                    message.get("to_id"),
+                    message.get("portnum"),
+                    line,
+                )
+            )
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO packets (received, channel, from_id, to_id, portnum, message) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def close(self) -> None:
+        super().close()
+        self._conn.close()
+
+
+class ParquetSink(Sink):
+    """ a new Parquet file per batch in a directory, needs pyarrow
+
+    Nested values (payload lists and sub-messages) are stored as JSON strings,
+    so every portnum can share the same flat columns.
+    """
+
+    def __init__(
+        self, directory: Path, batch_size: int = 10000, flush_interval: float = 60.0
+    ) -> None:
+        try:
+            import pyarrow  # type: ignore[import-not-found,unused-ignore]
+            import pyarrow.parquet  # type: ignore[import-not-found,unused-ignore]
+        except ImportError as error:
+            raise ImportError(
+                "The parquet sink needs pyarrow, pip install pyarrow"
+            ) from error
+        self._pyarrow = pyarrow
+        self.directory = directory
+        directory.mkdir(parents=True, exist_ok=True)
+        self._sequence = 0
+        super().__init__(batch_size, flush_interval)
+
+    def write_batch(
+        self, lines: list[str], messages: list[Optional[dict[str, Any]]]
+    ) -> None:
+        # different portnums have different keys, so every row gets every column
+        columns: dict[str, list[Any]] = {}
+        for index, message in enumerate(self.decoded(lines, messages)):
+            for key, value in message.items():
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value, default=json_default)
+                elif isinstance(value, bytes):
+                    # as it'd be in the JSON line
+                    value = base64.b64encode(value).decode("ascii")
+                column = columns.get(key)
+                if column is None:
+                    column = columns[key] = [None] * len(lines)
+                column[index] = value
+        table = self._pyarrow.Table.from_pydict(columns)
+        self._sequence += 1
+        filename = (
+            self.directory
+            / f"packets-{int(time.time())}-{os.getpid()}-{self._sequence:06d}.parquet"
+        )
+        temp_filename = filename.with_suffix(".tmp")
+        self._pyarrow.parquet.write_table(table, temp_filename)
+        os.replace(temp_filename, filename)
+
+
+def make_sink(
+    spec: str, batch_size: Optional[int] = None, flush_interval: Optional[float] = None
+) -> Sink:
+    """ build a sink from stdout, ndjson:PATH, parquet:DIR or sqlite:PATH """
+    sink_type, _, target = spec.partition(":")
+    if sink_type not in SINK_TYPES:
+        raise ValueError(
+            f"Unknown sink {sink_type}, should be one of {','.join(SINK_TYPES)}"
+        )
+    if sink_type != "stdout" and not target:
+        raise ValueError(f"The {sink_type} sink needs a path, eg {sink_type}:packets")
+    kwargs: dict[str, Any] = {}
+    if batch_size is not None:
+        kwargs["batch_size"] = batch_size
+    if flush_interval is not None:
+        kwargs["flush_interval"] = flush_interval
+    if sink_type == "stdout":
+        return StdoutSink(**kwargs)
+    if sink_type == "ndjson":
+        return NdjsonSink(Path(target), **kwargs)
+    if sink_type == "sqlite":
+        return SqliteSink(Path(target), **kwargs)
+    return ParquetSink(Path(target), **kwargs)
@@ -0,0 +1,299 @@
+""" synthetic meshtastic traffic, for benchmarks and tests
+
+Builds encrypted ServiceEnvelopes that look like what comes off the public
+brokers - a mix of portnums from a pool of nodes, heard by a few gateways each.
+The same seed always gives the same stream.
+
+Run `python -m meshtastic_tools.traffic --help` to write a capture file or
+publish the stream to a local broker.
+"""
+
+import random
+import sys
+import time
+from collections import deque
+from typing import Any, Iterator, Optional
+
+import click
+from meshtastic import BROADCAST_NUM, mesh_pb2, mqtt_pb2, portnums_pb2, telemetry_pb2  # type: ignore
+
+from meshtastic_tools.batch import LENGTH_PREFIX
+from meshtastic_tools.keyring import (
+    DEFAULT_CHANNEL,
+    ChannelKey,
+    Keyring,
+    parse_key_option,
+)
+
+# roughly what the public brokers see
+DEFAULT_MIX = {
+    "POSITION_APP": 0.3,
+    "TELEMETRY_APP": 0.3,
+    "NODEINFO_APP": 0.15,
+    "TEXT_MESSAGE_APP": 0.15,
+    "NEIGHBORINFO_APP": 0.1,
+}
+
+# when the first packet's sent, fixed so the payloads don't depend on the clock
+DEFAULT_START_TIME = 1700000000
+
+# a key nobody has, for packets that shouldn't decrypt
+_UNKNOWN_KEY = bytes(range(1, 17))
+
+
+class TrafficGenerator:
+    """ a reproducible stream of (topic, ServiceEnvelope bytes)
+
+    - `mix` is portnum name -> relative weight
+    - `keyring` is the keys to encrypt with, a packet's channel is picked at random
+    - `duplicate_rate` is the chance each message is another gateway's copy of a
+      recent packet
+    - `undecryptable_rate` is the chance a packet's encrypted with a key that
+      isn't in the keyring
+    - `text_size` is the (min, max) length of text messages
+    - `start_time` is the unix time in the first packet, each new packet's
+      a second later
+    """
+
+    def __init__(
+        self,
+        seed: int = 0,
+        mix: Optional[dict[str, float]] = None,
+        keyring: Optional[Keyring] = None,
+        nodes: int = 500,
+        gateways: int = 20,
+        duplicate_rate: float = 0.3,
+        undecryptable_rate: float = 0.0,
+        text_size: tuple[int, int] = (5, 200),
+        start_time: int = DEFAULT_START_TIME,
+    ) -> None:
+        self.random = random.Random(seed)
+        mix = mix or DEFAULT_MIX
+        self.portnums = [portnums_pb2.PortNum.Value(name) for name in mix]
+        self.weights = list(mix.values())
+        self.keys = (keyring or Keyring.default()).keys()
+        self.unknown_key = ChannelKey(DEFAULT_CHANNEL, _UNKNOWN_KEY)
+        self.nodes = [self.random.getrandbits(32) for _ in range(nodes)]
+        self.gateways = [self.random.getrandbits(32) for _ in range(gateways)]
+        self.duplicate_rate = duplicate_rate
+        self.undecryptable_rate = undecryptable_rate
+        self.text_size = text_size
+        self.now = start_time
+        self._recent: deque[tuple[str, Any]] = deque(maxlen=64)
+
+    def payload(self, portnum: int, from_id: int) -> bytes:
+        """ a plausible payload for the portnum """
+        rand = self.random
+        message: Any
+        if portnum == portnums_pb2.PortNum.POSITION_APP:
+            message = mesh_pb2.Position(
+                latitude_i=rand.randint(-900000000, 900000000),
+                longitude_i=rand.randint(-1800000000, 1800000000),
+                altitude=rand.randint(0, 2000),
+                time=self.now,
+                precision_bits=rand.choice((13, 16, 32)),
+                sats_in_view=rand.randint(3, 14),
+            )
+        elif portnum == portnums_pb2.PortNum.TELEMETRY_APP:
+            message = telemetry_pb2.Telemetry(time=self.now)
+            metrics = message.device_metrics
+            metrics.battery_level = rand.randint(0, 101)
+            metrics.voltage = round(rand.uniform(3.3, 4.2), 2)
+            metrics.channel_utilization = round(rand.uniform(0, 40), 2)
+            metrics.air_util_tx = round(rand.uniform(0, 5), 2)
+            metrics.uptime_seconds = rand.randint(0, 10000000)
+        elif portnum == portnums_pb2.PortNum.NODEINFO_APP:
+            short_name = f"{from_id & 0xFFFF:04x}"
+            message = mesh_pb2.User(
+                id=f"!{from_id:08x}",
+                long_name=f"Node {short_name}",
+                short_name=short_name,
+                hw_model=rand.choice(
+                    (mesh_pb2.HardwareModel.TBEAM, mesh_pb2.HardwareModel.HELTEC_V3)
+                ),
+            )
+        elif portnum == portnums_pb2.PortNum.NEIGHBORINFO_APP:
+            message = mesh_pb2.NeighborInfo(
+                node_id=from_id, node_broadcast_interval_secs=900
+            )
+            for _ in range(rand.randint(1, 8)):
+                message.neighbors.add(
+                    node_id=rand.choice(self.nodes), snr=round(rand.uniform(-20, 10), 2)
+                )
+        else:
+            length = rand.randint(*self.text_size)
+            return bytes(rand.choices(b"abcdefghijklmnopqrstuvwxyz ", k=length))
+        return bytes(message.SerializeToString())
+
+    def packet(self) -> tuple[str, Any]:
+        """ a new packet, and the channel name it's on """
+        rand = self.random
+        from_id = rand.choice(self.nodes)
+        portnum = rand.choices(self.portnums, self.weights)[0]
+        data = mesh_pb2.Data(portnum=portnum, payload=self.payload(portnum, from_id))
+        self.now += 1
+        if self.undecryptable_rate and rand.random() < self.undecryptable_rate:
+            channel_key = self.unknown_key
+        else:
+            channel_key = rand.choice(self.keys)
+        mp = mesh_pb2.MeshPacket(
+            id=rand.getrandbits(32) or 1,
+            to=BROADCAST_NUM,
+            channel=channel_key.hash,
+            hop_limit=3,
+            hop_start=3,
+        )
+        setattr(mp, "from", from_id)
+        mp.encrypted = channel_key.decrypt(mp.id, from_id, data.SerializeToString())
+        return channel_key.name, mp
+
+    def envelope(self) -> tuple[str, bytes]:
+        """ the next message, which might be a copy of a recent one """
+        rand = self.random
+        if self._recent and rand.random() < self.duplicate_rate:
+            channel, mp = rand.choice(self._recent)
+        else:
+            channel, mp = self.packet()
+            self._recent.append((channel, mp))
+        gateway = rand.choice(self.gateways)
+        se = mqtt_pb2.ServiceEnvelope(channel_id=channel, gateway_id=f"!{gateway:08x}")
+        se.packet.CopyFrom(mp)
+        se.packet.rx_rssi = rand.randint(-130, -40)
+        se.packet.rx_snr = round(rand.uniform(-20, 10), 2)
+        se.packet.hop_limit = rand.randint(0, 3)
+        return f"msh/2/e/{channel}/!{gateway:08x}", se.SerializeToString()
+
+    def stream(self, count: int) -> Iterator[tuple[str, bytes]]:
+        """ `count` messages """
+        for _ in range(count):
+            yield self.envelope()
+
+
+def parse_mix(value: str) -> tuple[str, float]:
+    """ PORTNUM=WEIGHT, eg POSITION_APP=0.3 """
+    name, separator, weight = value.partition("=")
+    if not separator:
+        raise ValueError(f"{value!r} isn't PORTNUM=WEIGHT")
+    try:
+        portnums_pb2.PortNum.Value(name)
+    except ValueError:
+        raise ValueError(f"Unknown portnum {name!r}") from None
+    try:
+        parsed = float(weight)
+    except ValueError:
+        raise ValueError(f"Weight for {name} isn't a number: {weight!r}") from None
+    if parsed <= 0:
+        raise ValueError(f"Weight for {name} has to be more than 0")
+    return name, parsed
+
+
+def parse_mix_option(
+    _ctx: click.Context, _param: click.Parameter, values: tuple[str, ...]
+) -> Optional[dict[str, float]]:
+    """ a click callback for --mix options, None if there weren't any """
+    try:
+        return dict(parse_mix(value) for value in values) or None
+    except ValueError as error:
+        raise click.BadParameter(str(error)) from error
+
+
+def check_text_size(
+    _ctx: click.Context, _param: click.Parameter, value: tuple[int, int]
+) -> tuple[int, int]:
+    """ a click callback for --text-size """
+    low, high = value
+    if low < 0 or high < low:
+        raise click.BadParameter(f"{low} {high} isn't a MIN MAX with 0 <= MIN <= MAX")
+    return value
+
+
+@click.command()
+@click.option("--count", type=int, default=10000, help="Messages to generate")
+@click.option("--seed", type=int, default=0)
+@click.option("--duplicate-rate", type=float, default=0.3)
+@click.option("--undecryptable-rate", type=float, default=0.0)
+@click.option(
+    "--mix",
+    multiple=True,
+    callback=parse_mix_option,
+    help="Relative weight of a portnum as PORTNUM=WEIGHT, can be repeated",
+)
+@click.option(
+    "--text-size",
+    type=(int, int),
+    default=(5, 200),
+    callback=check_text_size,
+    help="MIN MAX length of text messages",
+)
+@click.option(
+    "--start-time",
+    type=int,
+    default=DEFAULT_START_TIME,
+    help="Unix time in the first packet, the same seed and start give the same stream",
+)
+@click.option(
+    "--key",
+    "keys",
+    multiple=True,
+    callback=parse_key_option,
+    help="Extra channel key to encrypt with, as NAME:BASE64PSK",
+)
+@click.option(
+    "--output",
+    type=click.File("wb"),
+    help="Write a length-prefixed capture file, for --decode-file",
+)
+@click.option("--publish", help="Publish to the broker at host[:port] instead")
+@click.option("--rate", type=float, default=0, help="Messages per second to publish, 0 is as fast as possible")
+def main(
+    count: int,
+    seed: int,
+    duplicate_rate: float,
+    undecryptable_rate: float,
+    mix: Optional[dict[str, float]],
+    text_size: tuple[int, int],
+    start_time: int,
+    keys: list[tuple[str, bytes]],
+    output: Optional[Any],
+    publish: Optional[str],
+    rate: float,
+) -> None:
+    keyring = Keyring.default()
+    for name, psk in keys:
+        keyring.add(name, psk)
+    generator = TrafficGenerator(
+        seed,
+        mix=mix,
+        keyring=keyring,
+        duplicate_rate=duplicate_rate,
+        undecryptable_rate=undecryptable_rate,
+        text_size=text_size,
+        start_time=start_time,
+    )
+    if output is not None:
+        for _, payload in generator.stream(count):
+            output.write(LENGTH_PREFIX.pack(len(payload)) + payload)
+    elif publish is not None:
+        import paho.mqtt.client as mqtt
+
+        host, _, port = publish.partition(":")
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)  # type: ignore[attr-defined]
+        client.connect(host, int(port or 1883))
+        client.loop_start()
+        start = time.monotonic()
+        for index, (topic, payload) in enumerate(generator.stream(count)):
+            client.publish(topic, payload).wait_for_publish()
+            if rate > 0:
+                delay = start + (index + 1) / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        client.loop_stop()
+        client.disconnect()
+    else:
+        print("one of --output or --publish is needed", file=sys.stderr)
+        return
+    print(f"generated {count} messages", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
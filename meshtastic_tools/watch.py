@@ -0,0 +1,167 @@
+""" watch directories for changed files
+
+On Linux this uses inotify through libc, so there's nothing extra to install.
+Anywhere else, or if inotify isn't available, the directories are polled and
+the files' mtimes and sizes compared.
+"""
+
+import ctypes
+import ctypes.util
+import os
+from pathlib import Path
+import select
+import struct
+import sys
+import time
+from typing import Callable, Optional, Protocol
+
+# from sys/inotify.h
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+
+class Watcher(Protocol):
+    def add(self, directory: Path) -> None:
+        """ start watching a directory, if it isn't already """
+
+    def changes(self, timeout: Optional[float]) -> set[Path]:
+        """ files that have changed, waiting up to `timeout` seconds for one """
+
+    def close(self) -> None: ...
+
+
+def _files(directory: Path) -> dict[Path, tuple[int, int]]:
+    """ the files in a directory, with their mtimes and sizes """
+    files = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files[directory / entry.name] = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        pass
+    return files
+
+
+class InotifyWatcher:
+    """ inotify on the directories, so editors that rename a new file into place are noticed """
+
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories: dict[int, Path] = {}
+
+    def add(self, directory: Path) -> None:
+        if directory in self._directories.values():
+            return
+        wd = self._add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"Can't watch {directory}: {os.strerror(errno)}")
+        self._directories[wd] = directory
+
+    def changes(self, timeout: Optional[float]) -> set[Path]:
+        changed: set[Path] = set()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, so anything could have changed
+                    for directory in self._directories.values():
+                        changed.update(_files(directory))
+                elif wd in self._directories and name:
+                    changed.add(self._directories[wd] / os.fsdecode(name))
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """ compares each directory's listing every `interval` seconds """
+
+    def __init__(
+        self,
+        interval: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self._listings: dict[Path, dict[Path, tuple[int, int]]] = {}
+
+    def add(self, directory: Path) -> None:
+        if directory not in self._listings:
+            self._listings[directory] = _files(directory)
+
+    def _poll(self) -> set[Path]:
+        changed: set[Path] = set()
+        for directory, before in self._listings.items():
+            after = _files(directory)
+            changed.update(path for path in before.keys() | after.keys() if before.get(path) != after.get(path))
+            self._listings[directory] = after
+        return changed
+
+    def changes(self, timeout: Optional[float]) -> set[Path]:
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            changed = self._poll()
+            if changed:
+                return changed
+            if deadline is not None and self.clock() >= deadline:
+                return changed
+            wait = self.interval
+            if deadline is not None:
+                wait = max(0.0, min(wait, deadline - self.clock()))
+            self.sleep(wait)
+
+    def close(self) -> None:
+        self._listings.clear()
+
+
+def make_watcher(poll: bool = False, interval: float = 1.0) -> Watcher:
+    """ inotify if it's there, polling if it isn't or `poll` is set """
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(interval)
+
+
+def wait_for_changes(watcher: Watcher, debounce: float, timeout: Optional[float] = None) -> set[Path]:
+    """ the files changed, once they've stopped changing for `debounce` seconds
+
+    Saving a file often means several events (or several files, with a git
+    checkout), this gathers them up into one set.
+    """
+    changed = watcher.changes(timeout)
+    while changed:
+        more = watcher.changes(debounce)
+        if not more:
+            break
+        changed |= more
+    return changed
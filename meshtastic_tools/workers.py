@@ -0,0 +1,196 @@
+""" decode MQTT messages in a pool of worker processes
+
+The paho network loop only has to put messages on a bounded queue, if the
+queue's full the message is dropped and counted rather than blocking the loop.
+Metrics recorded in the workers are sent back with each result and added to
+the parent's, so they show up on its /metrics.
+"""
+
+import multiprocessing
+from pathlib import Path
+import queue
+import sys
+import threading
+from typing import Any, Callable, Iterator, Optional
+
+from meshtastic_tools.dedup import DedupIndex
+from meshtastic_tools.filters import PacketFilter
+from meshtastic_tools.metrics import METRICS, changes
+from meshtastic_tools.nodedb import NodeDirectory
+
+# queued messages are (topic, payload)
+_Item = tuple[str, bytes]
+_STOP = ("", b"")
+
+# what happened to a message
+DECODED = "decoded"
+# filtered, no key for its channel, no handler for its portnum...
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# results are (status, output, metrics recorded decoding it)
+_Result = tuple[str, Optional[str], dict[str, Any]]
+
+# the worker's metrics as of the last result, so each result only carries what's new
+_reported: dict[str, Any] = {}
+
+
+def init_worker(
+    keys: list[tuple[str, bytes]],
+    node_db: Optional[str] = None,
+    output_format: str = "json",
+    packet_filter: Optional[PacketFilter] = None,
+    key_file: Optional[str] = None,
+) -> None:
+    """ set up the keyring, node names, filters and output in each worker process """
+    from meshtastic_tools import mqtt_parser
+
+    mqtt_parser.OUTPUT_FORMAT = output_format
+    mqtt_parser.FILTER = packet_filter
+    for name, key in keys:
+        mqtt_parser.KEYRING.add(name, key)
+    if key_file is not None:
+        mqtt_parser.KEYRING.load(Path(key_file))
+    if node_db is not None:
+        mqtt_parser.NODES = NodeDirectory.load(Path(node_db))
+    _reported.update(METRICS.totals())
+
+
+def decode_in_worker(item: _Item) -> _Result:
+    """ runs in the worker processes """
+    from meshtastic_tools import mqtt_parser
+
+    topic, payload = item
+    error = False
+    try:
+        output = mqtt_parser.format_message(payload, None)
+    except Exception as e:
+        print(f"ERROR: failed to decode message on {topic}: {e}", file=sys.stderr)
+        output = None
+        error = True
+    totals = METRICS.totals()
+    recorded = changes(totals, _reported)
+    _reported.update(totals)
+    if output is not None:
+        status = DECODED
+    elif error or any(
+        counter.name in recorded
+        for counter in (mqtt_parser.ENVELOPE_FAILURES, mqtt_parser.DECRYPT_FAILURES)
+    ):
+        status = FAILED
+    else:
+        status = SKIPPED
+    return status, output, recorded
+
+
+class DecodePool:
+    """ a bounded queue in front of a pool of decoding processes
+
+    Duplicate packets are checked for here, before they're queued, so copies
+    handled by different workers are still caught. Each worker has its own
+    node directory, so a NODEINFO seen by one worker won't name the node in
+    packets handled by another until it's been through the `node_db` snapshot.
+
+    The topic filter is checked before queueing too, the rest of `packet_filter`
+    is checked in the workers.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        queue_size: int = 1000,
+        ordered: bool = True,
+        keys: Optional[list[tuple[str, bytes]]] = None,
+        output: Callable[[str], None] = print,
+        dedup: Optional[DedupIndex] = None,
+        node_db: Optional[str] = None,
+        output_format: str = "json",
+        packet_filter: Optional[PacketFilter] = None,
+        key_file: Optional[str] = None,
+    ) -> None:
+        self.received = 0
+        self.filtered = 0
+        self.dropped = 0
+        self.decoded = 0
+        self.skipped = 0
+        self.failed = 0
+        self._output = output
+        self._dedup = dedup
+        self._filter = packet_filter
+        self._queue: queue.Queue[_Item] = queue.Queue(maxsize=queue_size)
+        # bounds what's been handed to the pool but not output yet
+        self._in_flight = threading.BoundedSemaphore(queue_size)
+        self._pool = multiprocessing.Pool(
+            workers, initializer=init_worker, initargs=(keys or [], node_db, output_format, packet_filter, key_file)
+        )
+        mapper = self._pool.imap if ordered else self._pool.imap_unordered
+        self._results = mapper(decode_in_worker, self._feed())
+        self._thread = threading.Thread(
+            target=self._collect, name="decode-pool-output", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, topic: str, payload: bytes) -> bool:
+        """ queue a message for decoding, never blocks, returns False if dropped """
+        self.received += 1
+        if self._filter is not None and not self._filter.topic_allowed(topic):
+            self.filtered += 1
+            return True
+        if self._dedup is not None and self._dedup.seen_envelope(payload):
+            return True
+        try:
+            self._queue.put_nowait((topic, payload))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def queue_depth(self) -> int:
+        """ messages waiting to be handed to the pool """
+        return self._queue.qsize()
+
+    def stats(self) -> dict[str, int]:
+        """ counters for reporting """
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "filtered": self.filtered,
+            "decoded": self.decoded,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "queued": self.queue_depth(),
+        }
+
+    def _feed(self) -> Iterator[_Item]:
+        """ runs in the pool's task handler thread """
+        while True:
+            self._in_flight.acquire()
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            yield item
+
+    def _collect(self) -> None:
+        for status, result, recorded in self._results:
+            self._in_flight.release()
+            METRICS.add(recorded)
+            if status == FAILED:
+                self.failed += 1
+            elif status == SKIPPED:
+                self.skipped += 1
+            elif result is not None:
+                self.decoded += 1
+                self._output(result)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """ finish off what's queued and shut the workers down """
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self) -> "DecodePool":
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.close()
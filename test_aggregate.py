@@ -0,0 +1,123 @@
+import json
+from pathlib import Path
+from typing import Any
+
+import pytest
+from meshtastic import mesh_pb2, mqtt_pb2, portnums_pb2, telemetry_pb2  # type: ignore
+
+from conftest import FakeClock
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.aggregate import Aggregator
+from meshtastic_tools.traffic import TrafficGenerator
+
+
+def packet(from_num: int, portnum: int, **kwargs: Any) -> Any:
+    mp = mesh_pb2.MeshPacket(to=0xFFFFFFFF, **kwargs)
+    setattr(mp, "from", from_num)
+    mp.decoded.portnum = portnum
+    return mp
+
+
+def test_rates_and_buckets() -> None:
+    clock = FakeClock()
+    aggregator = Aggregator(capacity=16, bucket_seconds=10, buckets=6, clock=clock)
+    for _ in range(5):
+        aggregator.packet(packet(1, portnums_pb2.PortNum.TEXT_MESSAGE_APP), None)
+    clock.now += 10
+    aggregator.packet(packet(2, portnums_pb2.PortNum.TEXT_MESSAGE_APP), None)
+    assert aggregator.packet_count(1, 20) == 5
+    assert aggregator.packet_count(1, 10) == 0
+    assert aggregator.top_talkers(window=60) == [(1, 5), (2, 1)]
+    assert aggregator.portnum_rates(60)["TEXT_MESSAGE_APP"] == pytest.approx(6 / 20)
+    # a minute later the old buckets have been reused
+    clock.now += 60
+    aggregator.packet(packet(2, portnums_pb2.PortNum.TEXT_MESSAGE_APP), None)
+    assert aggregator.packet_count(1, 60) == 0
+    assert aggregator.node(1) is not None
+    assert aggregator.node(1)["packets"] == 5  # type: ignore[index]
+
+
+def test_position_and_telemetry() -> None:
+    aggregator = Aggregator(capacity=16, clock=FakeClock())
+    position = mesh_pb2.Position(latitude_i=-274664344, longitude_i=1531438018, altitude=7, precision_bits=13)
+    aggregator.packet(packet(1, portnums_pb2.PortNum.POSITION_APP), position)
+    telemetry = telemetry_pb2.Telemetry()
+    telemetry.device_metrics.battery_level = 87
+    telemetry.device_metrics.channel_utilization = 12.5
+    aggregator.packet(packet(1, portnums_pb2.PortNum.TELEMETRY_APP), telemetry)
+    node = aggregator.node(1)
+    assert node is not None
+    assert node["position"]["latitude"] == pytest.approx(-27.4664344)
+    assert node["position"]["precision_bits"] == 13
+    assert node["telemetry"]["battery_level"] == 87
+    assert aggregator.channel_utilization_history() == [(960.0, 12.5)]
+
+
+def test_telemetry_left_out() -> None:
+    """ metrics a node doesn't send aren't counted as zero """
+    aggregator = Aggregator(capacity=16, clock=FakeClock())
+    telemetry = telemetry_pb2.Telemetry()
+    telemetry.device_metrics.channel_utilization = 10.0
+    aggregator.packet(packet(1, portnums_pb2.PortNum.TELEMETRY_APP), telemetry)
+    telemetry = telemetry_pb2.Telemetry()
+    telemetry.device_metrics.voltage = 4.1
+    aggregator.packet(packet(1, portnums_pb2.PortNum.TELEMETRY_APP), telemetry)
+    node = aggregator.node(1)
+    assert node is not None
+    assert node["telemetry"]["voltage"] == 4.1
+    assert node["telemetry"]["battery_level"] is None
+    assert node["telemetry"]["channel_utilization"] is None
+    # the second packet didn't report any, so the mean's still 10
+    assert aggregator.channel_utilization_history() == [(960.0, 10.0)]
+
+
+def test_memory_is_bounded() -> None:
+    clock = FakeClock()
+    aggregator = Aggregator(capacity=100, link_capacity=100, clock=clock)
+    for num in range(1000):
+        clock.now += 1
+        aggregator.packet(packet(num, portnums_pb2.PortNum.TEXT_MESSAGE_APP), None)
+    assert len(aggregator.nodes) == 100
+    # the most recent nodes survive
+    assert aggregator.node(999) is not None
+    assert aggregator.node(0) is None
+
+
+def test_links_and_edges() -> None:
+    aggregator = Aggregator(capacity=16, clock=FakeClock())
+    direct = mqtt_pb2.ServiceEnvelope(gateway_id="!00000099")
+    direct.packet.CopyFrom(packet(1, 0, hop_start=3, hop_limit=3, rx_rssi=-80, rx_snr=5.5))
+    relayed = mqtt_pb2.ServiceEnvelope(gateway_id="!00000098")
+    relayed.packet.CopyFrom(packet(1, 0, hop_start=3, hop_limit=1, rx_rssi=-90, rx_snr=1))
+    aggregator.reception(direct)
+    aggregator.reception(relayed)
+    assert [link["gateway"] for link in aggregator.gateways_for(1)] == [0x99]
+    assert aggregator.gateways_for(1)[0]["rssi"] == -80
+
+    neighbors = mesh_pb2.NeighborInfo(node_id=5)
+    neighbors.neighbors.add(node_id=3, snr=4.0)
+    aggregator.packet(packet(5, portnums_pb2.PortNum.NEIGHBORINFO_APP), neighbors)
+    route = mesh_pb2.RouteDiscovery(route=[7], snr_towards=[20, 12], route_back=[7], snr_back=[8, -128])
+    reply = packet(6, portnums_pb2.PortNum.TRACEROUTE_APP)
+    reply.to = 4
+    reply.decoded.request_id = 1
+    aggregator.packet(reply, route)
+    snapshot = aggregator.snapshot()
+    edges = {(edge["a"], edge["b"]): edge for edge in snapshot["edges"]}
+    assert edges[("00000003", "00000005")]["snr"] == 4.0
+    # 4 -> 7 at 5dB, 7 -> 6 at 3dB and back 6 -> 7 at 2dB
+    assert edges[("00000004", "00000007")]["snr"] == 5.0
+    assert edges[("00000006", "00000007")] == {"a": "00000006", "b": "00000007", "count": 2, "snr": 2.5}
+    json.dumps(snapshot)
+
+
+def test_from_decode_message(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    aggregator = Aggregator(capacity=1024, path=tmp_path / "aggregates.json")
+    monkeypatch.setattr(mqtt_parser, "AGGREGATES", aggregator)
+    for _, payload in TrafficGenerator(seed=9, duplicate_rate=0).stream(200):
+        mqtt_parser.decode_message(payload, None)
+    aggregator.save()
+    snapshot = json.loads((tmp_path / "aggregates.json").read_text())
+    assert sum(node["packets"] for node in snapshot["nodes"].values()) == 200
+    assert any("position" in node for node in snapshot["nodes"].values())
+    assert snapshot["edges"]
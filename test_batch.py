@@ -0,0 +1,100 @@
+import base64
+import io
+import json
+import struct
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from meshtastic import mesh_pb2, portnums_pb2  # type: ignore
+
+from conftest import envelope
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.batch import decode_batch, read_base64_lines, read_length_prefixed
+from meshtastic_tools.keyring import Keyring
+
+TESTMESSAGE = Path(__file__).parent / "meshtastic_benthos" / "testmessage.bytes"
+
+
+def encrypted_envelope(keyring: Keyring, packet_id: int) -> bytes:
+    """ an encrypted position packet on LongFast """
+    position = mesh_pb2.Position(latitude_i=-274664344, longitude_i=1531438018)
+    return envelope(
+        packet_id=packet_id,
+        rssi=-90,
+        portnum=portnums_pb2.PortNum.POSITION_APP,
+        payload=position.SerializeToString(),
+        keyring=keyring,
+    )
+
+
+def test_decode_batch() -> None:
+    """ columns line up and failures are counted """
+    keyring = Keyring.default()
+    envelopes = [
+        TESTMESSAGE.read_bytes(),
+        b"\xff\xff",
+        encrypted_envelope(keyring, 1),
+        encrypted_envelope(keyring, 2),
+    ]
+    batch = decode_batch(envelopes, keyring)
+    assert len(batch) == 3
+    assert batch.parse_errors == 1
+    assert batch.portnum_names() == ["TRACEROUTE_APP", "POSITION_APP", "POSITION_APP"]
+    assert batch.columns["id"][1:] == [1, 2]
+    assert batch.columns["rx_rssi"][1] == -90
+    assert batch.columns["payload"][1]["latitudeI"] == -274664344
+    assert all(len(column) == 3 for column in batch.columns.values())
+
+
+def test_read_length_prefixed() -> None:
+    records = [b"one", b"", b"three"]
+    fh = io.BytesIO(b"".join(struct.pack(">I", len(r)) + r for r in records))
+    assert list(read_length_prefixed(fh)) == records
+
+
+def test_read_base64_lines() -> None:
+    """ a bad line is skipped and reported, rather than ending the backfill """
+    fh = io.BytesIO(b"b25l\n\nnot base64!\ndHdv\n")
+    errors: list[int] = []
+    envelopes = read_base64_lines(fh, lambda number, _error: errors.append(number))
+    assert list(envelopes) == [b"one", b"two"]
+    assert errors == [3]
+
+
+def test_messages_match_live() -> None:
+    """ --decode-file outputs the same dicts as decoding live """
+    keyring = Keyring.default()
+    envelopes = [TESTMESSAGE.read_bytes(), encrypted_envelope(keyring, 1)]
+    live = [mqtt_parser.decode_message(envelope, None) for envelope in envelopes]
+    assert list(decode_batch(envelopes, keyring).messages()) == live
+    assert live[1] is not None
+    assert live[1]["from_id"] == "12345678"
+    assert live[1]["to_id"] == "all"
+    assert live[1]["portnum"] == "POSITION_APP"
+
+
+def test_decode_capture_output_format(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """ --decode-file uses --output-format like decoding live """
+    pytest.importorskip("orjson")
+    capture = tmp_path / "capture.txt"
+    capture.write_bytes(base64.b64encode(TESTMESSAGE.read_bytes()) + b"\n")
+    monkeypatch.setattr(mqtt_parser, "OUTPUT_FORMAT", "orjson")
+    mqtt_parser.decode_capture(str(capture), "base64", 100)
+    line = capsys.readouterr().out.strip()
+    live = mqtt_parser.format_message(TESTMESSAGE.read_bytes(), None)
+    assert line == live
+    assert ", " not in line
+    assert json.loads(line)["portnum"]
+
+
+def test_decode_file_not_recorded(tmp_path: Path) -> None:
+    """ there's nothing to record when decoding a file """
+    capture = tmp_path / "capture.txt"
+    capture.write_bytes(base64.b64encode(TESTMESSAGE.read_bytes()) + b"\n")
+    arguments = ["--decode-file", str(capture), "--record", str(tmp_path / "recorded")]
+    result = CliRunner().invoke(mqtt_parser.main, arguments)
+    assert "--record can only be used with --hostname or --broker" in result.output
+    assert not (tmp_path / "recorded").exists()
@@ -0,0 +1,98 @@
+from pathlib import Path
+
+import pytest
+
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.capture import CaptureReader, CaptureWriter, parse_time, replay
+from meshtastic_tools.traffic import TrafficGenerator
+
+
+def record(directory: Path, count: int, segment_bytes: int = 64 * 1024) -> list[tuple[str, bytes]]:
+    """ a message a second, starting at 1000 """
+    messages = list(TrafficGenerator(seed=8).stream(count))
+    with CaptureWriter(directory, segment_bytes=segment_bytes, index_every=16) as writer:
+        for received, (topic, payload) in enumerate(messages, start=1000):
+            writer.write(topic, payload, float(received))
+    return messages
+
+
+def test_roundtrip(tmp_path: Path) -> None:
+    messages = record(tmp_path, 1000)
+    assert len(list(tmp_path.glob("*.seg"))) > 1
+    with CaptureReader(tmp_path) as reader:
+        records = [(topic, bytes(payload)) for _, topic, payload in reader.records()]
+    assert records == messages
+
+
+def test_time_range(tmp_path: Path) -> None:
+    messages = record(tmp_path, 1000)
+    with CaptureReader(tmp_path) as reader:
+        records = list(reader.records(start=1500, end=1600))
+        assert [received for received, _, _ in records] == [float(n) for n in range(1500, 1601)]
+        assert bytes(records[0][2]) == messages[500][1]
+
+
+def test_close_releases_payloads(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    """ payloads kept past close are released rather than keeping the file mapped """
+    record(tmp_path, 10)
+    reader = CaptureReader(tmp_path)
+    payloads = [payload for _, _, payload in reader.records()]
+    reader.close()
+    assert reader.segments[0]._mmap is None
+    with pytest.raises(ValueError):
+        bytes(payloads[0])
+
+    # a view taken of a payload can't be released for it, so it's tried again
+    reader = CaptureReader(tmp_path)
+    held = memoryview(next(reader.records())[2])
+    reader.close()
+    assert "still in use" in capsys.readouterr().err
+    assert reader.segments[0]._mmap is not None
+    held.release()
+    reader.close()
+    assert reader.segments[0]._mmap is None
+
+
+def test_partial_record(tmp_path: Path) -> None:
+    """ a recorder that died mid-write leaves a truncated record at the end """
+    record(tmp_path, 10)
+    segment = sorted(tmp_path.glob("*.seg"))[-1]
+    segment.write_bytes(segment.read_bytes()[:-5])
+    with CaptureReader(tmp_path) as reader:
+        assert len(list(reader.records())) == 9
+
+
+def test_new_writer_new_segment(tmp_path: Path) -> None:
+    record(tmp_path, 5)
+    record(tmp_path, 5)
+    assert len(list(tmp_path.glob("*.seg"))) == 2
+    with CaptureReader(tmp_path) as reader:
+        assert len(list(reader.records())) == 10
+
+
+def test_replay_pacing() -> None:
+    now = [0.0]
+    sleeps = []
+
+    def sleep(delay: float) -> None:
+        sleeps.append(delay)
+        now[0] += delay
+
+    records = [(100.0, "a", memoryview(b"")), (102.0, "b", memoryview(b"")), (103.0, "c", memoryview(b""))]
+    handled = []
+    count = replay(iter(records), lambda _, topic, __: handled.append(topic), 2.0, lambda: now[0], sleep)
+    assert count == 3
+    assert handled == ["a", "b", "c"]
+    assert sleeps == [1.0, 0.5]
+
+
+def test_replay_decodes(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    record(tmp_path, 20)
+    mqtt_parser.replay_capture(str(tmp_path), 1005, 1009, 0)
+    captured = capsys.readouterr()
+    assert "replayed 5 messages" in captured.err
+
+
+def test_parse_time() -> None:
+    assert parse_time("1716678942.5") == 1716678942.5
+    assert parse_time("2024-05-26T00:00:00+00:00") == 1716681600
@@ -0,0 +1,430 @@
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from meshtastic.protobuf import localonly_pb2  # type: ignore
+from pubsub import pub
+from pydantic import BaseModel, ValidationError
+import pytest
+import yaml
+
+from configure import (
+    Compiled,
+    Config,
+    Device,
+    Plan,
+    SnapshotStore,
+    apply_plan,
+    compile_fleet,
+    compile_layered,
+    connect_device,
+    load_compiled,
+    make_plan,
+    plan_compiled,
+    plan_sections,
+    provision,
+    provision_fleet,
+    section_spec,
+    summarise,
+)
+
+
+class FakeNode:
+    """ records what would've been sent to the device """
+
+    def __init__(self, node_num: int = 0x050C2E68) -> None:
+        self.nodeNum = node_num
+        self.localConfig = localonly_pb2.LocalConfig()
+        self.moduleConfig = localonly_pb2.LocalModuleConfig()
+        self.calls: list[tuple[Any, ...]] = []
+        self.on_commit: Callable[[], None] = lambda: None
+
+    def beginSettingsTransaction(self) -> None:
+        self.calls.append(("begin",))
+
+    def commitSettingsTransaction(self) -> None:
+        self.calls.append(("commit",))
+        self.on_commit()
+
+    def writeConfig(self, section: str) -> None:
+        self.calls.append(("write", section))
+
+    def setOwner(self, long_name: Optional[str] = None, short_name: Optional[str] = None) -> None:
+        self.calls.append(("owner", long_name, short_name))
+
+    def setFixedPosition(self, lat: float, lon: float, alt: int) -> None:
+        self.calls.append(("fixed", lat, lon, alt))
+
+    def waitForConfig(self) -> None:
+        self.calls.append(("wait",))
+
+
+class FakeClient:
+    def __init__(self, node: Optional[FakeNode] = None, long_name: str = "Meshtastic 2e68") -> None:
+        self.localNode = node or FakeNode()
+        self.long_name = long_name
+        self.closed = False
+
+    def getShortName(self) -> str:
+        return "2e68"
+
+    def getLongName(self) -> str:
+        return self.long_name
+
+    def close(self) -> None:
+        self.closed = True
+
+
+CONFIG = {
+    "owner": {"short_name": "{id}", "long_name": "Node {id}"},
+    "lora": {"region": "ANZ", "modem_preset": "LONG_FAST"},
+    "mqtt": {"address": "mqtt.example.com", "username": "u", "password": "p", "root": "msh/{id}", "enabled": True},
+    "bluetooth": {"enabled": True, "mode": "FIXED_PIN", "fixedPin": 123456},
+    "gps": {"fixed_position": True, "latitude": -27.4, "longitude": 153.0, "altitude": 10},
+}
+
+
+def test_plan_and_apply() -> None:
+    """ every change is written in one transaction """
+    node = FakeNode()
+    config = Config.model_validate(CONFIG)
+    plan = make_plan(node, config, FakeClient())
+    assert "owner/long_name: 'Meshtastic 2e68' -> 'Node 2e68'" in plan.describe()
+    assert "mqtt/root: '' -> 'msh/2e68'" in plan.describe()
+    assert plan.sections == ["lora", "mqtt", "bluetooth", "position"]
+    # planning doesn't touch the device's config
+    assert node.localConfig.lora.region == 0
+    assert node.calls == []
+
+    apply_plan(node, plan)
+    assert node.calls == [
+        ("begin",),
+        ("owner", "Node 2e68", "2e68"),
+        ("fixed", -27.4, 153.0, 10),
+        ("write", "lora"),
+        ("write", "mqtt"),
+        ("write", "bluetooth"),
+        ("write", "position"),
+        ("commit",),
+    ]
+    assert node.localConfig.lora.region == node.localConfig.lora.ANZ
+    assert node.moduleConfig.mqtt.root == "msh/2e68"
+    assert node.localConfig.bluetooth.fixed_pin == 123456
+
+    # once it's all applied there's nothing left to do, apart from the owner
+    # which the fake client doesn't remember
+    plan = make_plan(node, config, FakeClient())
+    assert plan.sections == []
+    node.calls.clear()
+    lora_only = Config.model_validate({"lora": CONFIG["lora"]})
+    apply_plan(node, make_plan(node, lora_only, FakeClient()))
+    assert node.calls == []
+
+
+def test_enums_from_protobuf() -> None:
+    """ regions and presets are checked against the firmware's names for them """
+    config = Config.model_validate({"lora": {"region": "ph_433", "modem_preset": "short_turbo"}})
+    assert config.lora.region == "PH_433"
+    with pytest.raises(ValidationError, match="Invalid region"):
+        Config.model_validate({"lora": {"region": "MARS"}})
+    with pytest.raises(ValidationError, match="Invalid region"):
+        Config.model_validate({"lora": {"region": "UNSET"}})
+    with pytest.raises(ValidationError, match="Invalid modem preset"):
+        Config.model_validate({"lora": {"region": "ANZ", "modem_preset": "WARP_SPEED"}})
+
+    node = FakeNode()
+    plan = make_plan(node, config, FakeClient())
+    assert plan.changes[0][:2] == ("lora", "region")
+    assert plan.changes[0].new == node.localConfig.lora.PH_433
+    assert plan.changes[1].new == node.localConfig.lora.SHORT_TURBO
+
+
+class DisplayConfig(BaseModel):
+    screenOnSecs: Optional[int] = None
+    units: Optional[str] = None
+    not_a_setting: bool = True
+
+
+class DisplayingConfig(Config):
+    display: Optional[DisplayConfig] = None
+
+
+def test_new_section() -> None:
+    """ a model's enough to plan another section """
+    sections = (section_spec("display", "display", DisplayConfig),)
+    assert [field.key for field in sections[0].fields] == ["screen_on_secs", "units"]
+    config = DisplayingConfig.model_validate(
+        {"lora": CONFIG["lora"], "display": {"screenOnSecs": 30, "units": "imperial"}}
+    )
+    node = FakeNode()
+    plan = Plan()
+    plan_sections(plan, node, config, "2e68", sections)
+    assert plan.describe() == ["display/screen_on_secs: 0 -> 30", "display/units: 0 -> 1"]
+    apply_plan(node, plan)
+    assert node.localConfig.display.units == node.localConfig.display.IMPERIAL
+
+    config.display = DisplayConfig(units="furlongs")
+    with pytest.raises(ValueError, match="Invalid DisplayUnits"):
+        plan_sections(Plan(), node, config, "2e68", sections)
+
+
+class FakeFleet:
+    """ devices that keep their config between connections, and reboot on commit
+
+    The `silent` ones don't drop the connection when they're committed to, and the
+    `forgetful` ones send a copy of their config on each connection and never
+    save what's written to it.
+    """
+
+    def __init__(
+        self,
+        broken: set[str],
+        silent: Optional[set[str]] = None,
+        forgetful: Optional[set[str]] = None,
+    ) -> None:
+        self.nodes: dict[str, FakeNode] = {}
+        self.names: dict[str, str] = {}
+        self.broken = broken
+        self.silent = silent if silent is not None else set()
+        self.forgetful = forgetful if forgetful is not None else set()
+        self.connections: dict[str, int] = {}
+
+    def connect(self, device: Device) -> FakeClient:
+        if device.name in self.broken:
+            raise ConnectionError(f"no route to {device.name}")
+        self.connections[device.name] = self.connections.get(device.name, 0) + 1
+        node = self.nodes.setdefault(device.name, FakeNode(len(self.nodes) + 1))
+        if device.name in self.forgetful:
+            saved = node
+            node = FakeNode(saved.nodeNum)
+            node.localConfig.CopyFrom(saved.localConfig)
+            node.moduleConfig.CopyFrom(saved.moduleConfig)
+        client = FakeClient(node, self.names.get(device.name, "Meshtastic 2e68"))
+
+        def reboot() -> None:
+            for call in node.calls:
+                if call[0] == "owner":
+                    self.names[device.name] = call[1]
+            if device.name not in self.silent:
+                pub.sendMessage("meshtastic.connection.lost", interface=client)
+
+        node.on_commit = reboot
+        return client
+
+
+def test_provision_fleet() -> None:
+    """ devices are provisioned concurrently, and one failing doesn't stop the rest """
+    fleet = FakeFleet(broken={"10.0.0.3"})
+    devices = [Device(host=f"10.0.0.{number}") for number in range(1, 5)] + [Device(serial="/dev/ttyUSB0")]
+    config = Config.model_validate(CONFIG)
+    results = provision_fleet(devices, config, jobs=3, connect=fleet.connect, reboot_timeout=5)
+    assert [result.device for result in results] == [device.name for device in devices]
+    assert [result.status for result in results] == ["applied", "applied", "failed", "applied", "applied"]
+    assert results[2].error == "no route to 10.0.0.3"
+    # connected, then reconnected after the reboot
+    assert fleet.connections["10.0.0.1"] == 2
+    assert summarise(results)[-1] == "4 applied, 1 failed"
+
+    results = provision_fleet(devices, config, jobs=3, connect=fleet.connect, reboot_timeout=5)
+    assert [result.status for result in results] == ["unchanged", "unchanged", "failed", "unchanged", "unchanged"]
+
+
+def test_provision_no_reboot() -> None:
+    """ if the connection isn't dropped, it carries on with the one it's got """
+    fleet = FakeFleet(broken=set(), silent={"10.0.0.1"})
+    result = provision(
+        Device(host="10.0.0.1"), Config.model_validate(CONFIG), connect=fleet.connect, reboot_timeout=0.1
+    )
+    assert result.status == "applied"
+    # reconnected to check the settings it saved
+    assert fleet.connections["10.0.0.1"] == 2
+
+    # the copy changed in memory isn't what's checked
+    fleet = FakeFleet(broken=set(), silent={"10.0.0.1"}, forgetful={"10.0.0.1"})
+    result = provision(
+        Device(host="10.0.0.1"), Config.model_validate(CONFIG), connect=fleet.connect, reboot_timeout=0.1
+    )
+    assert result.status == "failed"
+    assert result.error == "Some settings didn't stick after the reboot"
+
+
+def test_provision_owner_only() -> None:
+    """ changing only the owner doesn't reboot the device, so it's not waited for """
+    fleet = FakeFleet(broken=set())
+    config = Config.model_validate(CONFIG)
+    assert provision(Device(host="10.0.0.1"), config, connect=fleet.connect, reboot_timeout=5).status == "applied"
+
+    fleet.silent.add("10.0.0.1")
+    assert config.owner is not None
+    config.owner.long_name = "Gateway {id}"
+    result = provision(Device(host="10.0.0.1"), config, connect=fleet.connect, reboot_timeout=30)
+    assert result.status == "applied"
+    assert result.changes == 1
+    assert result.seconds < 5
+    assert fleet.connections["10.0.0.1"] == 4
+    assert fleet.names["10.0.0.1"] == "Gateway 2e68"
+
+
+def test_provision_snapshots(tmp_path: Path) -> None:
+    """ devices that haven't changed since the last run are skipped, and drift is noticed """
+    fleet = FakeFleet(broken=set())
+    devices = [Device(host="10.0.0.1"), Device(host="10.0.0.2")]
+    config = Config.model_validate(CONFIG)
+    snapshots = SnapshotStore(tmp_path)
+    results = provision_fleet(devices, config, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert [result.status for result in results] == ["applied", "applied"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["00000001.json", "00000002.json"]
+
+    fleet.nodes["10.0.0.1"].calls.clear()
+    results = provision_fleet(devices, config, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert [result.status for result in results] == ["skipped", "skipped"]
+    assert fleet.nodes["10.0.0.1"].calls == [("wait",)]
+    assert summarise(results)[-1] == "2 skipped"
+
+    # changed on the device, but not something the config sets
+    fleet.nodes["10.0.0.2"].localConfig.lora.hop_limit = 7
+    results = provision_fleet(devices, config, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert [result.status for result in results] == ["skipped", "unchanged"]
+    assert results[1].drifted == ("lora",)
+    assert "changed since the last run: lora" in summarise(results)[1]
+    results = provision_fleet(devices, config, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert [result.status for result in results] == ["skipped", "skipped"]
+
+    # changed on the device and in the config
+    fleet.nodes["10.0.0.1"].localConfig.bluetooth.enabled = False
+    results = provision_fleet(devices, config, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert [result.status for result in results] == ["applied", "skipped"]
+    assert results[0].drifted == ("bluetooth",)
+    assert fleet.nodes["10.0.0.1"].localConfig.bluetooth.enabled
+
+    # a new config means planning again
+    config.lora.modem_preset = "SHORT_FAST"
+    results = provision_fleet(devices, config, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert [result.status for result in results] == ["applied", "applied"]
+
+    # a broken snapshot is ignored
+    snapshots.path(1).write_text("not json")
+    results = provision_fleet(devices, config, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert [result.status for result in results] == ["unchanged", "skipped"]
+
+
+def test_device_connections(monkeypatch: pytest.MonkeyPatch) -> None:
+    """ a host or a serial port, and with neither the serial port's auto-detected """
+    with pytest.raises(ValueError):
+        Device(host="10.0.0.1", serial="/dev/ttyUSB0")
+
+    from meshtastic import serial_interface  # type: ignore
+
+    opened: list[Optional[str]] = []
+
+    def fake_serial(devPath: Optional[str] = None, noNodes: bool = False) -> FakeClient:
+        opened.append(devPath)
+        return FakeClient()
+
+    monkeypatch.setattr(serial_interface, "SerialInterface", fake_serial)
+    device = Device()
+    assert device.name == "auto-detected serial port"
+    assert isinstance(connect_device(device), FakeClient)
+    assert isinstance(connect_device(Device(serial="/dev/ttyUSB0")), FakeClient)
+    assert opened == [None, "/dev/ttyUSB0"]
+
+
+LAYERED = {
+    "owner": "Node 2e68",
+    "owner_short": "N68",
+    "config": {
+        "lora": {"region": "ANZ", "modemPreset": "LONG_FAST", "hopLimit": 5},
+        "bluetooth": {"enabled": True, "mode": "FIXED_PIN", "fixedPin": 123456},
+        "position": {"fixedPosition": True},
+        "network": {"enabledProtocols": 1, "ntpServer": "ntp.example.com"},
+        "security": {"adminKey": ["base64:" + "A" * 43 + "="]},
+    },
+    "module_config": {"mqtt": {"enabled": True, "root": "msh/2e68"}, "externalNotification": {"enabled": True}},
+    "location": {"lat": -27.4, "lon": 153.0, "alt": 10},
+    "channel_url": "https://meshtastic.org/e/#example",
+}
+
+
+def test_compile_layered() -> None:
+    """ a layered config's checked and turned into the device's protobufs """
+    compiled = compile_layered("2e68", LAYERED)
+    local, module = compiled.protobufs()
+    assert local.lora.hop_limit == 5
+    assert local.bluetooth.fixed_pin == 123456
+    assert len(local.security.admin_key[0]) == 32
+    assert module.external_notification.enabled
+    assert compiled.fields["lora"] == ["modem_preset", "region", "hop_limit"]
+    assert compiled.config.gps is not None and compiled.config.gps.latitude == -27.4
+    assert compiled.config.owner is not None and compiled.config.owner.short_name == "N68"
+    # the same config compiles to the same thing
+    assert compile_layered("2e68", LAYERED).hash == compiled.hash
+    assert Compiled.model_validate_json(compiled.model_dump_json()) == compiled
+
+
+@pytest.mark.parametrize(
+    "change, message",
+    [
+        ({"config": {"lora": {"region": "MARS"}}}, "Invalid enum value MARS"),
+        ({"config": {"lora": {"region": "ANZ", "warp": 9}}}, "no field named \"warp\""),
+        ({"config": {"bluetooth": {"enabled": True}}}, "Invalid region"),
+        (
+            {"config": {"lora": {"region": "ANZ"}, "position": {"fixedPosition": True}}, "location": None},
+            "no location",
+        ),
+        ({"owner": "Node", "owner_short": "TOO LONG"}, "Short name"),
+        (
+            {"config": {"lora": {"region": "ANZ"}, "bluetooth": {"enabled": True}, "network": {"wifiEnabled": True}}},
+            "BLE and Wifi",
+        ),
+    ],
+)
+def test_compile_invalid(change: dict[str, Any], message: str) -> None:
+    layered = {key: value for key, value in LAYERED.items() if key not in change}
+    layered.update(change)
+    with pytest.raises(ValueError, match=message):
+        compile_layered("2e68", layered)
+
+
+def test_plan_compiled() -> None:
+    """ only the settings the layers set are written """
+    node = FakeNode()
+    node.localConfig.lora.tx_power = 20
+    plan = plan_compiled(node, compile_layered("2e68", LAYERED), FakeClient())
+    assert "lora/hop_limit: 0 -> 5" in plan.describe()
+    assert "position/fixed_position: False -> True" in plan.describe()
+    assert plan.sections == ["network", "lora", "bluetooth", "security", "mqtt", "external_notification", "position"]
+    apply_plan(node, plan)
+    assert node.localConfig.lora.tx_power == 20
+    assert node.localConfig.network.ntp_server == "ntp.example.com"
+    assert len(node.localConfig.security.admin_key) == 1
+    assert ("fixed", -27.4, 153.0, 10) in node.calls
+    assert plan_compiled(node, compile_layered("2e68", LAYERED), FakeClient(long_name="Node 2e68")).sections == []
+
+
+def test_compile_fleet(tmp_path: Path) -> None:
+    """ the whole fleet's validated in one go, and the compiled configs can be applied """
+    (tmp_path / "layered-2e68.yml").write_text(yaml.dump(LAYERED))
+    (tmp_path / "layered-broken.yml").write_text(yaml.dump({"config": {"lora": {"region": "MARS"}}}))
+    errors = compile_fleet(tmp_path, write=False)
+    assert errors["2e68"] is None
+    assert "MARS" in str(errors["broken"])
+    assert not list(tmp_path.glob("compiled-*"))
+
+    compile_fleet(tmp_path)
+    assert [path.name for path in tmp_path.glob("compiled-*")] == ["compiled-2e68.json"]
+    path = tmp_path / "compiled-2e68.json"
+    compiled = load_compiled(path)
+    assert compiled.hash == compile_layered("2e68", LAYERED).hash
+
+    fleet = FakeFleet(broken=set())
+    device = Device(host="10.0.0.1", compiled=path)
+    snapshots = SnapshotStore(tmp_path / "snapshots")
+    result = provision(device, None, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert result.status == "applied"
+    assert fleet.nodes["10.0.0.1"].localConfig.lora.hop_limit == 5
+    result = provision(device, None, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert result.status == "skipped"
+
+    path.write_text(path.read_text().replace("N68", "N69"))
+    result = provision(device, None, connect=fleet.connect, reboot_timeout=5, snapshots=snapshots)
+    assert result.status == "failed"
+    assert "changed since it was compiled" in str(result.error)
@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+
+import pytest
+
+from conftest import FakeClock, envelope
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.dedup import DedupIndex
+
+
+def test_window() -> None:
+    clock = FakeClock(0.0)
+    dedup = DedupIndex(window=10, capacity=4, clock=clock)
+    assert not dedup.seen(1, 1)
+    assert dedup.seen(1, 1)
+    assert not dedup.seen(2, 1)
+    clock.now = 11
+    assert not dedup.seen(1, 1)
+    assert dedup.duplicates == 1
+
+
+def test_capacity() -> None:
+    """ the oldest keys fall out once the ring wraps """
+    dedup = DedupIndex(window=10, capacity=4, clock=FakeClock(0.0))
+    for packet_id in range(1, 6):
+        assert not dedup.seen(1, packet_id)
+    assert len(dedup) == 4
+    assert not dedup.seen(1, 1)
+    assert dedup.seen(1, 5)
+
+
+def test_parse_message_merge(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """ copies from other gateways are merged into the first one """
+
+    def copy(gateway_id: str, rssi: int) -> bytes:
+        return envelope(packet_id=42, gateway_id=gateway_id, rssi=rssi)
+
+    clock = FakeClock(0.0)
+    monkeypatch.setattr(
+        mqtt_parser, "DEDUP", DedupIndex(window=10, merge_delay=2, clock=clock)
+    )
+    mqtt_parser.parse_message(copy("!00000001", -80), None)
+    mqtt_parser.parse_message(copy("!00000002", -100), None)
+    assert capsys.readouterr().out == ""
+    clock.now = 3
+    mqtt_parser.parse_message(copy("!00000003", -90), None)
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    message = json.loads(lines[0])
+    assert [gateway["gateway_id"] for gateway in message["gateways"]] == [
+        "!00000001",
+        "!00000002",
+        "!00000003",
+    ]
+    assert message["gateways"][1]["rssi"] == -100
+
+
+def test_held_output_format(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """ merged packets come out in --output-format like everything else """
+    pytest.importorskip("orjson")
+    clock = FakeClock(0.0)
+    monkeypatch.setattr(mqtt_parser, "OUTPUT_FORMAT", "orjson")
+    monkeypatch.setattr(
+        mqtt_parser, "DEDUP", DedupIndex(window=10, merge_delay=2, clock=clock)
+    )
+    mqtt_parser.parse_message(envelope(packet_id=42), None)
+    clock.now = 3
+    mqtt_parser.flush_held()
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    # orjson doesn't put spaces after the separators
+    assert '"portnum":"TEXT_MESSAGE_APP"' in lines[0]
+
+
+def test_held_flushed_by_timer(
+    monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """ the last packets held go out without waiting for another message """
+    monkeypatch.setattr(
+        mqtt_parser, "DEDUP", DedupIndex(window=10, merge_delay=0.05)
+    )
+    mqtt_parser.parse_message(envelope(packet_id=42), None)
+    assert capsys.readouterr().out == ""
+    stopped = threading.Event()
+    timer = threading.Thread(
+        target=mqtt_parser._flush_held_timer, args=(stopped, 0.02), daemon=True
+    )
+    timer.start()
+    try:
+        deadline = time.monotonic() + 5
+        out = ""
+        while not out and time.monotonic() < deadline:
+            time.sleep(0.02)
+            out = capsys.readouterr().out
+    finally:
+        stopped.set()
+        timer.join()
+    assert json.loads(out)["gateways"][0]["gateway_id"] == "!050c2e68"
@@ -0,0 +1,73 @@
+from typing import Any
+
+import pytest
+from meshtastic import mqtt_pb2, portnums_pb2  # type: ignore
+
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.batch import decode_batch
+from meshtastic_tools.filters import PacketFilter, topic_matches
+from meshtastic_tools.keyring import Keyring
+from meshtastic_tools.traffic import TrafficGenerator
+
+
+class Message:
+    def __init__(self, topic: str, payload: bytes) -> None:
+        self.topic = topic
+        self.payload = payload
+        self.info = None
+
+
+def test_topic_matches() -> None:
+    assert topic_matches("msh/2/e/#".split("/"), "msh/2/e/LongFast/!1234".split("/"))
+    assert topic_matches("msh/+/e/+/!1234".split("/"), "msh/2/e/LongFast/!1234".split("/"))
+    assert not topic_matches("msh/2/c/#".split("/"), "msh/2/e/LongFast/!1234".split("/"))
+    assert not topic_matches("msh/2/e/+".split("/"), "msh/2/e/LongFast/!1234".split("/"))
+
+
+def test_parse() -> None:
+    assert PacketFilter.parse() is None
+    packet_filter = PacketFilter.parse(["position_app", "67"], ["LongFast", "8"], ["!050c2e68"])
+    assert packet_filter is not None
+    assert packet_filter.portnums == {portnums_pb2.PortNum.POSITION_APP, 67}
+    assert packet_filter.channel_names == {"LongFast"}
+    assert packet_filter.channel_hashes == {8}
+    assert packet_filter.senders == {0x050C2E68}
+    with pytest.raises(ValueError):
+        PacketFilter.parse(["NOT_A_PORTNUM"])
+
+
+def test_stages(monkeypatch: Any) -> None:
+    """ each stage drops what it can before the next one runs """
+    generator = TrafficGenerator(seed=6, duplicate_rate=0)
+    messages = [Message(topic, payload) for topic, payload in generator.stream(300)]
+    first = mqtt_pb2.ServiceEnvelope()
+    first.ParseFromString(messages[0].payload)
+    sender = getattr(first.packet, "from")
+
+    def decoded(packet_filter: PacketFilter) -> list[dict[str, Any]]:
+        monkeypatch.setattr(mqtt_parser, "FILTER", packet_filter)
+        results = [mqtt_parser.decode_message(msg.payload, msg) for msg in messages]
+        return [result for result in results if result is not None]
+
+    assert decoded(PacketFilter(topics=["msh/2/c/#"])) == []
+    assert decoded(PacketFilter(channels=["Private"])) == []
+    positions = decoded(PacketFilter(portnums=[portnums_pb2.PortNum.POSITION_APP]))
+    assert positions
+    assert {message["portnum"] for message in positions} == {"POSITION_APP"}
+    from_sender = decoded(PacketFilter(senders=[sender]))
+    assert from_sender
+    assert all(message["from_id"].startswith(f"{sender:08x}") for message in from_sender)
+
+
+def test_decode_batch_filter() -> None:
+    generator = TrafficGenerator(seed=7, duplicate_rate=0)
+    envelopes = [payload for _, payload in generator.stream(300)]
+    packet_filter = PacketFilter(portnums=[portnums_pb2.PortNum.TELEMETRY_APP])
+    batch = decode_batch(envelopes, Keyring.default(), packet_filter=packet_filter)
+    assert set(batch.portnum_names()) == {"TELEMETRY_APP"}
+    assert len(batch) + batch.filtered == 300
+    # the unencrypted header is enough to skip these
+    se = mqtt_pb2.ServiceEnvelope(channel_id="LongFast")
+    se.packet.decoded.portnum = portnums_pb2.PortNum.TEXT_MESSAGE_APP
+    batch = decode_batch([se.SerializeToString()], packet_filter=packet_filter)
+    assert batch.filtered == 1
@@ -0,0 +1,74 @@
+import random
+
+import pytest
+from meshtastic import mesh_pb2, mqtt_pb2, portnums_pb2  # type: ignore
+
+from meshtastic_tools.aggregate import Aggregator
+from meshtastic_tools.geo import SpatialIndex, distance, uncertainty
+
+BRISBANE = (-27.4698, 153.0251)
+
+
+def test_distance_and_uncertainty() -> None:
+    # Brisbane to Sydney is about 730km
+    assert distance(*BRISBANE, -33.8688, 151.2093) == pytest.approx(732000, rel=0.01)
+    assert uncertainty(32) == 0
+    assert uncertainty(0) == 0
+    # the firmware describes 13 bits as about 2.9km
+    assert uncertainty(13) == pytest.approx(2914, rel=0.01)
+
+
+def test_within_and_bbox() -> None:
+    index = SpatialIndex()
+    index.update(1, *BRISBANE)
+    index.update(2, BRISBANE[0] + 0.03, BRISBANE[1])  # ~3.3km north
+    index.update(3, BRISBANE[0] + 0.05, BRISBANE[1], precision_bits=13)  # ~5.6km, +-2.9km
+    index.update(4, -33.8688, 151.2093)
+    assert [num for num, _ in index.within(*BRISBANE, 4000)] == [1, 2]
+    assert [num for num, _ in index.within(*BRISBANE, 4000, include_uncertain=True)] == [1, 2, 3]
+    assert sorted(index.in_bbox(-28, 152, -27, 154)) == [1, 2, 3]
+    # moving a node takes it out of its old cell
+    index.update(1, 10, 10)
+    assert [num for num, _ in index.within(*BRISBANE, 100)] == []
+    index.remove(2)
+    assert 2 not in index
+    assert sorted(index.in_bbox(-28, 152, -27, 154)) == [3]
+
+
+def test_antimeridian() -> None:
+    index = SpatialIndex()
+    index.update(1, -17.0, 179.95)
+    index.update(2, -17.0, -179.95)
+    index.update(3, -17.0, 170.0)
+    assert sorted(index.in_bbox(-18, 179, -16, -179)) == [1, 2]
+    assert sorted(num for num, _ in index.within(-17.0, 180.0, 10000)) == [1, 2]
+
+
+def test_nearest_gateways_matches_brute_force() -> None:
+    rand = random.Random(10)
+    index = SpatialIndex()
+    gateways = []
+    for num in range(2000):
+        index.update(num, rand.uniform(-60, 70), rand.uniform(-180, 180))
+        if num % 20 == 0:
+            index.mark_gateway(num)
+            gateways.append(num)
+    for _ in range(50):
+        point = (rand.uniform(-80, 80), rand.uniform(-180, 180))
+        expected = sorted(gateways, key=lambda num: distance(*point, *index.positions[num][:2]))
+        assert [num for num, _ in index.nearest_gateways(*point, limit=3)] == expected[:3]
+
+
+def test_aggregator_feeds_the_index() -> None:
+    aggregator = Aggregator(capacity=2)
+    for num in (1, 2, 3):
+        mp = mesh_pb2.MeshPacket()
+        setattr(mp, "from", num)
+        mp.decoded.portnum = portnums_pb2.PortNum.POSITION_APP
+        position = mesh_pb2.Position(latitude_i=-274698000 + num, longitude_i=1530251000)
+        aggregator.packet(mp, position, now=float(num))
+    # node 1 was pushed out of the aggregates, so it's gone from the index too
+    assert sorted(num for num, _ in aggregator.spatial.within(*BRISBANE, 1000)) == [2, 3]
+    se = mqtt_pb2.ServiceEnvelope(gateway_id="!00000003")
+    aggregator.reception(se)
+    assert aggregator.spatial.nearest_gateways(*BRISBANE)[0][0] == 3
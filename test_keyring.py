@@ -0,0 +1,136 @@
+import base64
+from pathlib import Path
+
+from click.testing import CliRunner
+import pytest
+from meshtastic import mesh_pb2, portnums_pb2  # type: ignore
+
+from meshtastic_tools import mqtt_parser, traffic
+
+from meshtastic_tools.keyring import (
+    DEFAULT_KEY,
+    ChannelKey,
+    Keyring,
+    NoKeyError,
+    channel_hash,
+    expand_psk,
+)
+from meshtastic_tools.mqtt_parser import try_decode
+
+
+def make_packet(keyring: Keyring, name: str, text: bytes) -> mesh_pb2.MeshPacket:
+    """ build an encrypted text packet using the first key for the channel """
+    channel_key = [key for key in keyring.keys() if key.name == name][0]
+    data = mesh_pb2.Data(portnum=portnums_pb2.PortNum.TEXT_MESSAGE_APP, payload=text)
+    mp = mesh_pb2.MeshPacket(id=1234, to=0xFFFFFFFF, channel=channel_key.hash)
+    setattr(mp, "from", 0x050C2E68)
+    mp.encrypted = channel_key.decrypt(mp.id, 0x050C2E68, data.SerializeToString())
+    return mp
+
+
+def test_default_channel_hash() -> None:
+    """ LongFast with the default key is channel 8 """
+    assert channel_hash("LongFast", expand_psk(b"\x01")) == 8
+    assert Keyring.default().candidates(8)[0].name == "LongFast"
+
+
+def test_decrypt_roundtrip() -> None:
+    """ packets encrypted with a key come back out """
+    keyring = Keyring.default()
+    mp = make_packet(keyring, "LongFast", b"hello")
+    try_decode(mp, keyring)
+    assert mp.decoded.payload == b"hello"
+
+
+def test_multiple_keys() -> None:
+    """ keys sharing a channel hash are all tried """
+    default = expand_psk(b"\x01")
+    # swapping two bytes keeps the xor, so the channel hash is the same
+    swapped = default[1:2] + default[0:1] + default[2:]
+    keyring = Keyring()
+    keyring.add("LongFast", default)
+    other = keyring.add("LongFast", swapped)
+    assert other is not None
+    assert len(keyring.candidates(8)) == 2
+
+    data = mesh_pb2.Data(portnum=portnums_pb2.PortNum.TEXT_MESSAGE_APP, payload=b"hi")
+    mp = mesh_pb2.MeshPacket(id=1234, channel=8)
+    setattr(mp, "from", 1)
+    mp.encrypted = other.decrypt(mp.id, 1, data.SerializeToString())
+    try_decode(mp, keyring)
+    assert mp.decoded.payload == b"hi"
+
+
+def test_decrypt_group() -> None:
+    """ each key decrypts what's left of the group in one go """
+    right = ChannelKey("LongFast", expand_psk(base64.b64decode(DEFAULT_KEY)))
+    wrong = ChannelKey("LongFast", bytes(range(16)))
+    unknown = ChannelKey("LongFast", bytes(range(16, 32)))
+    packets = []
+    for number, channel_key in enumerate([right] * 4 + [unknown]):
+        data = mesh_pb2.Data(
+            portnum=portnums_pb2.PortNum.TEXT_MESSAGE_APP, payload=b"x" * number * 7
+        )
+        mp = mesh_pb2.MeshPacket(id=1000 + number, channel=8)
+        setattr(mp, "from", 0x050C2E68)
+        mp.encrypted = channel_key.decrypt(mp.id, 0x050C2E68, data.SerializeToString())
+        packets.append(mp)
+    decrypted = Keyring.decrypt_group([wrong, right], packets)
+    assert [data.payload for data in decrypted[:4]] == [b"x" * n * 7 for n in range(4)]
+    assert decrypted[4] is None
+    for mp, data in zip(packets[:4], decrypted[:4], strict=True):
+        assert Keyring.decrypt_with([wrong, right], mp) == data
+
+
+def test_invalid_key() -> None:
+    with pytest.raises(ValueError):
+        Keyring().add("Broken", b"\x01\x02\x03")
+    assert Keyring().add("Open", b"\x00") is None
+
+
+@pytest.mark.parametrize("key", ["Private:not base64!", "Private", ":AQ=="])
+def test_invalid_key_option(key: str) -> None:
+    """ a bad --key is a usage error, not a traceback """
+    for command in (mqtt_parser.main, traffic.main):
+        result = CliRunner().invoke(command, ["--key", key])
+        assert result.exit_code == 2
+        assert "Invalid value for '--key'" in result.output
+
+
+def test_unknown_channel_skipped() -> None:
+    """ packets on a channel hash with no key aren't tried against every key """
+    keyring = Keyring.default()
+    assert keyring.candidates(9) == []
+    # a missing hash could be anything
+    assert keyring.candidates(0) == keyring.keys()
+    mp = make_packet(keyring, "LongFast", b"hello")
+    mp.channel = 9
+    with pytest.raises(NoKeyError):
+        keyring.decrypt(mp)
+
+
+def test_key_file_reload(tmp_path: Path) -> None:
+    """ the key file's reloaded when it changes, keys from add() stay """
+    now = 0.0
+    key_file = tmp_path / "keys.txt"
+    key_file.write_text("# a comment\n\nPrivate:AQ==\n")
+    keyring = Keyring.default()
+    keyring.load(key_file, reload_interval=10, clock=lambda: now)
+    assert sorted(key.name for key in keyring.keys()) == ["LongFast", "Private"]
+    private = channel_hash("Private", expand_psk(b"\x01"))
+    assert keyring.candidates(private)[0].name == "Private"
+
+    key_file.write_text("Other:Ag==\n")
+    # not checked again until the interval's passed
+    assert keyring.candidates(private)
+    now = 11.0
+    assert keyring.candidates(private) == []
+    assert sorted(key.name for key in keyring.keys()) == ["LongFast", "Other"]
+    assert keyring.reloads == 2
+
+    # a broken file leaves the keys alone
+    key_file.write_text("Broken\n")
+    now = 22.0
+    assert sorted(key.name for key in keyring.keys()) == ["LongFast", "Other"]
+    keyring.candidates(8)
+    assert sorted(key.name for key in keyring.keys()) == ["LongFast", "Other"]
@@ -0,0 +1,222 @@
+from pathlib import Path
+import os
+import threading
+from typing import Any
+
+import pytest
+import yaml
+
+from meshtastic_tools.layer_configs import (
+    Fleet,
+    LayerCache,
+    build_all,
+    compose,
+    live_entries,
+    read_layer_list,
+    watch,
+    write_if_changed,
+)
+from meshtastic_tools.watch import PollingWatcher
+
+
+def write_layers(directory: Path, count: int) -> list[Path]:
+    paths = []
+    for index in range(count):
+        path = directory / f"layer-{index}.yml"
+        path.write_text(
+            yaml.dump({"config": {"lora": {"hop_limit": index}, f"key{index}": [index]}})
+        )
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def parsed(monkeypatch: pytest.MonkeyPatch) -> list[Any]:
+    """ what yaml.safe_load was called with """
+    calls: list[Any] = []
+    safe_load = yaml.safe_load
+
+    def counting(data: Any) -> Any:
+        calls.append(data)
+        return safe_load(data)
+
+    monkeypatch.setattr(yaml, "safe_load", counting)
+    return calls
+
+
+def test_compose_cached(tmp_path: Path, parsed: list[Any]) -> None:
+    """ only changed layers are parsed, and only the layers above them are merged """
+    paths = write_layers(tmp_path, 5)
+    cache = LayerCache(tmp_path / "cache")
+    expected = compose(paths)
+    parsed.clear()
+
+    assert compose(paths, cache) == expected
+    assert len(parsed) == 5
+    parsed.clear()
+    # nothing's changed, so it's the cached merge of all of them
+    assert compose(paths, cache) == expected
+    assert parsed == []
+
+    paths[3].write_text(yaml.dump({"config": {"lora": {"hop_limit": 7}}}))
+    config = compose(paths, cache)
+    assert len(parsed) == 1
+    assert config["config"]["lora"]["hop_limit"] == 4
+    assert "key3" not in config["config"]
+    assert config == compose(paths)
+
+
+def test_compose_reordered(tmp_path: Path, parsed: list[Any]) -> None:
+    """ the prefixes depend on the order, the parsed layers don't """
+    paths = write_layers(tmp_path, 3)
+    cache = LayerCache(tmp_path / "cache")
+    compose(paths, cache)
+    parsed.clear()
+    reordered = [paths[2], paths[0], paths[1]]
+    assert compose(reordered, cache) == compose(reordered)
+    assert len(parsed) == 3  # just the uncached compose
+    assert compose(reordered, cache)["config"]["lora"]["hop_limit"] == 1
+
+
+def test_broken_cache_entry(tmp_path: Path) -> None:
+    paths = write_layers(tmp_path, 2)
+    cache = LayerCache(tmp_path / "cache")
+    expected = compose(paths, cache)
+    for entry in (tmp_path / "cache").iterdir():
+        entry.write_bytes(b"not a pickle")
+    assert compose(paths, cache) == expected
+
+
+def make_fleet(directory: Path) -> None:
+    (directory / "config-base.yml").write_text(
+        yaml.dump({"config": {"bluetooth": {"enabled": False, "mode": "RANDOM_PIN"}}})
+    )
+    (directory / "config-router.yml").write_text(yaml.dump({"config": {"device": {"role": "ROUTER"}}}))
+    for node, layers in {
+        "1234": ["config-base.yml", "config-router.yml"],
+        "5678": ["config-base.yml", "config-router.yml", "layer-5678.yml"],
+        "9abc": ["config-base.yml", "layer-9abc.yml"],
+    }.items():
+        (directory / f"layers-{node}.yml").write_text(yaml.dump({"layers": layers}))
+        if f"layer-{node}.yml" in layers:
+            (directory / f"layer-{node}.yml").write_text(
+                yaml.dump({"config": {"bluetooth": {"enabled": True}, "owner": node}})
+            )
+
+
+def test_build_all(tmp_path: Path) -> None:
+    """ every id's rendered, and only the changed outputs are written """
+    make_fleet(tmp_path)
+    changed = build_all(str(tmp_path), tmp_path / "cache", jobs=2)
+    assert changed == {"1234": True, "5678": True, "9abc": True}
+    for node in changed:
+        layer_files = read_layer_list(str(tmp_path), node)
+        assert layer_files is not None
+        assert yaml.safe_load((tmp_path / f"layered-{node}.yml").read_text()) == compose(layer_files)
+    assert yaml.safe_load((tmp_path / "layered-5678.yml").read_text())["config"]["device"] == {"role": "ROUTER"}
+
+    assert build_all(str(tmp_path), tmp_path / "cache", jobs=2) == {
+        "1234": False,
+        "5678": False,
+        "9abc": False,
+    }
+    (tmp_path / "config-router.yml").write_text(yaml.dump({"config": {"device": {"role": "CLIENT"}}}))
+    assert build_all(str(tmp_path), None, jobs=2, write=False) == {
+        "1234": True,
+        "5678": True,
+        "9abc": False,
+    }
+    assert "ROUTER" in (tmp_path / "layered-1234.yml").read_text()
+
+
+def test_build_all_missing_layer(tmp_path: Path) -> None:
+    make_fleet(tmp_path)
+    (tmp_path / "layer-9abc.yml").unlink()
+    assert build_all(str(tmp_path), jobs=1) is None
+
+
+def test_write_if_changed_mode(tmp_path: Path) -> None:
+    """ renaming the temporary file over the output doesn't leave it private """
+    path = tmp_path / "layered-1234.yml"
+    umask = os.umask(0o022)
+    try:
+        assert write_if_changed(path, "a: 1\n")
+    finally:
+        os.umask(umask)
+    assert path.stat().st_mode & 0o777 == 0o644
+    path.chmod(0o640)
+    assert write_if_changed(path, "a: 2\n")
+    assert path.stat().st_mode & 0o777 == 0o640
+    assert path.read_text() == "a: 2\n"
+
+
+def test_cache_pruned(tmp_path: Path) -> None:
+    """ entries for layers that have changed or gone are removed """
+    make_fleet(tmp_path)
+    cache_dir = tmp_path / "cache"
+    build_all(str(tmp_path), cache_dir, jobs=1)
+    before = {path.stem for path in cache_dir.glob("*.pickle")}
+    (tmp_path / "layer-9abc.yml").write_text(yaml.dump({"config": {"owner": "renamed"}}))
+    compose(read_layer_list(str(tmp_path), "9abc") or [], LayerCache(cache_dir))
+    build_all(str(tmp_path), cache_dir, jobs=1)
+    after = {path.stem for path in cache_dir.glob("*.pickle")}
+    assert len(before - after) == 1
+    layer_lists = [read_layer_list(str(tmp_path), node) or [] for node in ["1234", "5678", "9abc"]]
+    assert after <= live_entries(layer_lists)
+    assert any(entry.startswith("prefix-") for entry in after)
+
+    (tmp_path / "layers-9abc.yml").unlink()
+    (tmp_path / "layer-9abc.yml").unlink()
+    gone = after - live_entries(layer_lists[:2])
+    assert gone
+    assert LayerCache(cache_dir).prune(live_entries(layer_lists[:2])) == len(gone)
+    assert {path.stem for path in cache_dir.glob("*.pickle")} == after - gone
+
+
+def test_fleet_rebuilds_affected(tmp_path: Path, parsed: list[Any]) -> None:
+    """ a changed layer only rebuilds the ids that use it, without reparsing the rest """
+    make_fleet(tmp_path)
+    fleet = Fleet(str(tmp_path))
+    for node in fleet.ids():
+        fleet.load_list(node)
+    parsed.clear()
+    assert fleet.users[tmp_path / "config-router.yml"] == {"1234", "5678"}
+    assert fleet.build(set(fleet.layer_lists)) == {"1234": True, "5678": True, "9abc": True}
+    assert len(parsed) == 4
+    parsed.clear()
+
+    router = tmp_path / "config-router.yml"
+    router.write_text(yaml.dump({"config": {"device": {"role": "CLIENT"}}}))
+    assert fleet.affected({router, tmp_path / "layered-1234.yml"}) == {"1234", "5678"}
+    assert fleet.build({"1234", "5678"}) == {"1234": True, "5678": True}
+    assert len(parsed) == 1
+    assert "CLIENT" in (tmp_path / "layered-5678.yml").read_text()
+
+    # saved without changing it
+    router.write_text(router.read_text())
+    assert fleet.affected({router}) == set()
+
+    # a layer list changing picks up its new layers
+    (tmp_path / "layers-9abc.yml").write_text(
+        yaml.dump({"layers": ["config-base.yml", "config-router.yml", "layer-9abc.yml"]})
+    )
+    assert fleet.affected({tmp_path / "layers-9abc.yml"}) == {"9abc"}
+    assert fleet.users[router] == {"1234", "5678", "9abc"}
+    assert fleet.build({"9abc"}) == {"9abc": True}
+    assert "CLIENT" in (tmp_path / "layered-9abc.yml").read_text()
+
+
+def test_watch(tmp_path: Path) -> None:
+    """ the watch loop rebuilds what a change affects """
+    make_fleet(tmp_path)
+    watcher = PollingWatcher(interval=0.01)
+    timer = threading.Timer(
+        0.2,
+        lambda: (tmp_path / "layer-9abc.yml").write_text(yaml.dump({"config": {"owner": "changed"}})),
+    )
+    timer.start()
+    try:
+        watch(str(tmp_path), debounce=0.05, watcher=watcher, rounds=1)
+    finally:
+        timer.cancel()
+    assert "changed" in (tmp_path / "layered-9abc.yml").read_text()
@@ -0,0 +1,121 @@
+import threading
+import urllib.request
+from pathlib import Path
+
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.metrics import METRICS, Registry, changes, serve
+
+TESTMESSAGE = Path(__file__).parent / "meshtastic_benthos" / "testmessage.bytes"
+
+
+def test_counters_across_threads() -> None:
+    registry = Registry()
+    counter = registry.counter("test_things", "Things", label="kind")
+
+    def work() -> None:
+        for _ in range(1000):
+            counter.inc(1, "a")
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(2, "b")
+    assert counter.collect() == {"a": 4000, "b": 2}
+
+
+def test_finished_threads_folded() -> None:
+    """ a thread per connection doesn't leave a cell per connection behind """
+    registry = Registry()
+    counter = registry.counter("test_connections", "Connections")
+    histogram = registry.histogram("test_latency", "Latency", buckets=(0.1, 1.0))
+
+    def work() -> None:
+        counter.inc()
+        histogram.observe(0.5)
+
+    for _ in range(50):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    assert counter.collect() == {"": 50}
+    assert histogram.collect() == ([0.0, 50.0, 50.0], 25.0)
+    assert len(counter._cells._cells) <= 1
+    assert len(histogram._cells._cells) <= 1
+
+
+def test_changes_added() -> None:
+    """ what another process recorded can be added to this one's metrics """
+    worker = Registry()
+    counter = worker.counter("test_things", "Things", label="kind")
+    histogram = worker.histogram("test_latency", "Latency", buckets=(0.1, 1.0))
+    worker.counter("test_unused", "Unused")
+    counter.inc(1, "a")
+    before = worker.totals()
+    counter.inc(2, "a")
+    counter.inc(1, "b")
+    histogram.observe(0.5)
+    recorded = changes(worker.totals(), before)
+    assert recorded == {
+        "test_things": {"a": 2, "b": 1},
+        "test_latency": [0.0, 1.0, 0.0, 0.5],
+    }
+
+    parent = Registry()
+    parent.counter("test_things", "Things", label="kind").inc(1, "a")
+    parent.histogram("test_latency", "Latency", buckets=(0.1, 1.0))
+    parent.add(recorded)
+    parent.add(recorded)
+    snapshot = parent.snapshot()
+    assert snapshot["test_things"] == {"a": 5, "b": 2}
+    assert snapshot["test_latency"] == {"count": 2.0, "sum": 1.0}
+
+
+def test_counter_render() -> None:
+    """ the family's named like the samples, or 0.0.4 scrapers leave them untyped """
+    registry = Registry()
+    registry.counter("test_things", "Things", label="kind").inc(1, "a")
+    registry.callback("test_callbacks", "Callbacks", lambda: 3, kind="counter")
+    assert registry.render().splitlines() == [
+        "# HELP test_things_total Things",
+        "# TYPE test_things_total counter",
+        'test_things_total{kind="a"} 1',
+        "# HELP test_callbacks_total Callbacks",
+        "# TYPE test_callbacks_total counter",
+        "test_callbacks_total 3",
+    ]
+
+
+def test_histogram_render() -> None:
+    registry = Registry()
+    histogram = registry.histogram("test_latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value)
+    rendered = registry.render()
+    assert '# TYPE test_latency_seconds histogram' in rendered
+    assert 'test_latency_seconds_bucket{le="0.1"} 1.0' in rendered
+    assert 'test_latency_seconds_bucket{le="1.0"} 2.0' in rendered
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3.0' in rendered
+    assert "test_latency_seconds_count 3.0" in rendered
+
+
+def test_decode_metrics_served() -> None:
+    """ decoding shows up on the /metrics endpoint """
+    before = METRICS.snapshot()
+    mqtt_parser.format_message(TESTMESSAGE.read_bytes(), None)
+    mqtt_parser.format_message(b"\xff", None)
+    after = METRICS.snapshot()
+    assert after["meshtastic_messages_received"] - before["meshtastic_messages_received"] == 2
+    assert after["meshtastic_envelope_parse_failures"] - before["meshtastic_envelope_parse_failures"] == 1
+    assert after["meshtastic_packets"]["TRACEROUTE_APP"] >= 1
+    assert after["meshtastic_decode_latency_seconds"]["count"] >= 2
+
+    server = serve(METRICS, 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+    assert 'meshtastic_packets_total{portnum="TRACEROUTE_APP"}' in body
@@ -0,0 +1,78 @@
+import json
+import socket
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+from conftest import envelope_lines
+from meshtastic_tools.mqtt_parser import decode_stream, make_decode_server
+
+
+def test_decode_stream() -> None:
+    """ a line out for every line in, so they can be matched up """
+    lines = envelope_lines(50)
+    output: list[str] = []
+    assert decode_stream(lines + [b"\n", b"not base64!\n"], output.append) == 51
+    assert len(output) == 51
+    assert output[-1] == "null"
+    decoded = [json.loads(line) for line in output[:-1] if line != "null"]
+    assert 0 < len(decoded) < 50
+    assert {message["portnum"] for message in decoded} == {"POSITION_APP", "TEXT_MESSAGE_APP"}
+
+
+def test_decode_socket(tmp_path: Path) -> None:
+    path = tmp_path / "decode.sock"
+    path.touch()
+    # not a socket, so it's left alone
+    try:
+        make_decode_server(str(path))
+    except OSError:
+        pass
+    else:
+        raise AssertionError("replaced a file that wasn't a socket")
+    path.unlink()
+
+    server = make_decode_server(str(path))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        lines = envelope_lines(10)
+        for _ in range(2):
+            with socket.socket(socket.AF_UNIX) as client:
+                client.connect(str(path))
+                client.sendall(b"".join(lines))
+                client.shutdown(socket.SHUT_WR)
+                received = b""
+                while chunk := client.recv(65536):
+                    received += chunk
+            assert len(received.splitlines()) == 10
+    finally:
+        server.shutdown()
+        server.server_close()
+    # a stale socket from a server that's gone is replaced
+    make_decode_server(str(path)).server_close()
+
+
+def imported(module: str, modules: list[str]) -> list[str]:
+    """ which of `modules` importing `module` loads, in a fresh interpreter """
+    result = subprocess.run(
+        [sys.executable, "-c", f"import json, sys, {module}; print(json.dumps([m for m in {modules!r} if m in sys.modules]))"],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return list(json.loads(result.stdout))
+
+
+def test_lazy_imports() -> None:
+    """ the one-shot paths don't pay for the network and pool modules """
+    assert imported(
+        "meshtastic_tools.mqtt_parser",
+        ["paho", "asyncio", "multiprocessing", "orjson", "meshtastic_tools.aggregate", "meshtastic_tools.async_engine"],
+    ) == []
+    assert imported(
+        "configure",
+        ["meshtastic.tcp_interface", "meshtastic.serial_interface", "yaml", "meshtastic_tools.layer_configs"],
+    ) == []
@@ -0,0 +1,43 @@
+from pathlib import Path
+
+from conftest import FakeClock
+from meshtastic_tools.nodedb import NodeDirectory
+
+
+def test_lru_and_ttl() -> None:
+    clock = FakeClock()
+    nodes = NodeDirectory(capacity=2, ttl=100, clock=clock)
+    nodes.update(1, "one", "Node One")
+    nodes.update(2, "two", "Node Two")
+    # touching 1 makes 2 the least recently used
+    assert nodes.short_name(1) == "one"
+    nodes.update(3, "thre", "Node Three")
+    assert nodes.get(2) is None
+    assert len(nodes) == 2
+
+    clock.now += 50
+    assert nodes.heard(3) is not None
+    clock.now += 60
+    assert 1 not in nodes
+    assert nodes.short_name(3) == "thre"
+
+
+def test_snapshot(tmp_path: Path) -> None:
+    """ names survive a restart """
+    clock = FakeClock()
+    path = tmp_path / "nodes.db"
+    nodes = NodeDirectory.load(path, ttl=100, clock=clock)
+    nodes.update(0x050C2E68, "2e68", "Gateway")
+    nodes.update(1, "old", "Old Node")
+    nodes.save()
+
+    clock.now += 10
+    nodes.heard(0x050C2E68)
+    nodes.save()
+
+    clock.now += 95
+    loaded = NodeDirectory.load(path, ttl=100, clock=clock)
+    assert loaded.short_name(0x050C2E68) == "2e68"
+    node = loaded.get(0x050C2E68)
+    assert node is not None and node.long_name == "Gateway"
+    assert loaded.get(1) is None
@@ -0,0 +1,85 @@
+""" the router against the Benthos test cases """
+
+import json
+from pathlib import Path
+from typing import Any, Optional
+
+import pytest
+import yaml
+
+from meshtastic_tools.router import handler_for, route
+from meshtastic_tools.traffic import TrafficGenerator
+
+BENTHOS = Path(__file__).parent / "meshtastic_benthos"
+CASES = yaml.safe_load((BENTHOS / "benthos_benthos_test.yaml").read_text())["tests"]
+
+
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_benthos_cases(case: dict[str, Any]) -> None:
+    """ the same output as the bloblang mapping """
+    for message, expected in zip(case["input_batch"], case["output_batches"][0]):
+        if "file_content" in message:
+            payload = (BENTHOS / message["file_content"]).read_bytes()
+        else:
+            payload = message["content"].encode("utf-8")
+        assert route(message["metadata"]["mqtt_topic"], payload) == expected["json_equals"]
+
+
+def test_stat() -> None:
+    assert route("msh/2e68/2/stat/!050c2e68", b"online") == {
+        "value": "online",
+        "topic": "msh/2e68/2/stat/!050c2e68",
+    }
+    # stat topics aren't parsed as JSON
+    assert route("msh/2e68/2/stat/!050c2e68", b"12") == {
+        "value": "12",
+        "topic": "msh/2e68/2/stat/!050c2e68",
+    }
+
+
+def test_scalars_and_text() -> None:
+    assert route("rdz_sonde_server/count", b"12") == {"value": 12, "topic": "rdz_sonde_server/count"}
+    assert route("rdz_sonde_server/name", b'"sonde"') == {"value": "sonde", "topic": "rdz_sonde_server/name"}
+    assert route("rdz_sonde_server/list", b"[1, 2]") == {"value": [1, 2], "topic": "rdz_sonde_server/list"}
+    assert route("rdz_sonde_server/text", b"not json") == {"message": "not json", "topic": "rdz_sonde_server/text"}
+    assert route("rdz_sonde_server/text", b"\xff") == {"message": "�", "topic": "rdz_sonde_server/text"}
+
+
+def test_decoder() -> None:
+    """ binary payloads on encrypted topics go to the decoder """
+    topic, payload = next(TrafficGenerator(1).stream(1))
+    seen = []
+
+    def decode(data: bytes | memoryview) -> Optional[dict[str, Any]]:
+        seen.append(bytes(data))
+        return {"decoded": True}
+
+    assert route(topic, payload, decode) == {"decoded": True, "topic": topic}
+    assert seen == [payload]
+    # JSON on the same topic doesn't need decoding
+    assert route(topic, b'{"a": 1}', decode) == {"a": 1, "topic": topic}
+    assert len(seen) == 1
+    # and nothing's output if the decoder drops it
+    assert route(topic, payload, lambda _data: None) is None
+    # without a decoder, encrypted topics other than LongFast are like any other
+    assert route("msh/2/e/MediumFast/!abcd", b"hello") == {
+        "message": "hello",
+        "topic": "msh/2/e/MediumFast/!abcd",
+    }
+    assert route("msh/2/e/MediumFast/!abcd", payload, decode) == {
+        "decoded": True,
+        "topic": "msh/2/e/MediumFast/!abcd",
+    }
+    # unencrypted and map report ServiceEnvelopes are protobufs too
+    for other in ("msh/ANZ/2/c/MediumFast/!abcd", "msh/ANZ/2/map/"):
+        assert route(other, payload, decode) == {"decoded": True, "topic": other}
+    # but JSON topics aren't
+    assert route("msh/ANZ/2/json/MediumFast/!abcd", b"hello", decode) == {
+        "message": "hello",
+        "topic": "msh/ANZ/2/json/MediumFast/!abcd",
+    }
+
+
+def test_handler_cache() -> None:
+    assert handler_for("msh/2/e/LongFast/!abcd") is handler_for("msh/2/e/LongFast/!abcd")
+    assert json.dumps(route("msh/2/e/LongFast/!abcd", b"\x0a\x00"))
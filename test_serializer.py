@@ -0,0 +1,88 @@
+import base64
+import json
+import sys
+from pathlib import Path
+from typing import Any
+
+import pytest
+from click.testing import CliRunner
+from google.protobuf.json_format import MessageToDict  # type: ignore
+from meshtastic import mesh_pb2, telemetry_pb2  # type: ignore
+
+from meshtastic_tools import mqtt_parser
+from meshtastic_tools.serializer import check_output_format, dumps, message_to_dict
+
+TESTMESSAGE = Path(__file__).parent / "meshtastic_benthos" / "testmessage.bytes"
+
+
+def position() -> Any:
+    return mesh_pb2.Position(
+        latitude_i=-274664344,
+        longitude_i=1531438018,
+        altitude=7,
+        time=1716678942,
+        precision_bits=32,
+        sats_in_view=4,
+        ground_speed=0,
+    )
+
+
+def telemetry() -> Any:
+    pb = telemetry_pb2.Telemetry(time=1716678942)
+    pb.device_metrics.battery_level = 101
+    pb.device_metrics.voltage = 4.2
+    pb.device_metrics.channel_utilization = 0.1
+    pb.device_metrics.air_util_tx = float("inf")
+    return pb
+
+
+def nodeinfo() -> Any:
+    return mesh_pb2.User(
+        id="!050c2e68",
+        long_name="Gateway",
+        short_name="2e68",
+        macaddr=b"\x01\x02\x03\x04\x05\x06",
+        hw_model=mesh_pb2.HardwareModel.TBEAM,
+        role=3,
+    )
+
+
+def neighborinfo() -> Any:
+    pb = mesh_pb2.NeighborInfo(node_id=1, last_sent_by_id=2)
+    pb.neighbors.add(node_id=3, snr=-7.25)
+    pb.neighbors.add(node_id=4, snr=0.3)
+    return pb
+
+
+@pytest.mark.parametrize("pb", [position(), telemetry(), nodeinfo(), neighborinfo(), mesh_pb2.User()])
+def test_matches_message_to_dict(pb: Any) -> None:
+    """ the JSON has to be byte for byte the same """
+    assert json.dumps(message_to_dict(pb)) == json.dumps(MessageToDict(pb))
+
+
+def test_negative_zero() -> None:
+    """ -0.0 after 0.0 keeps its sign, even though they're equal """
+    for snr in (0.0, -0.0, 0.0):
+        pb = mesh_pb2.NeighborInfo(node_id=1)
+        pb.neighbors.add(node_id=3, snr=snr)
+        assert json.dumps(message_to_dict(pb)) == json.dumps(MessageToDict(pb))
+
+
+def test_dumps() -> None:
+    message = {"portnum": "POSITION_APP", "latitudeI": -274664344}
+    assert dumps(message) == json.dumps(message).encode("utf-8")
+    with pytest.raises(ValueError):
+        dumps(message, "xml")
+
+
+def test_orjson_missing(monkeypatch: pytest.MonkeyPatch) -> None:
+    """ without orjson, --output-format orjson fails before decoding anything """
+    monkeypatch.setitem(sys.modules, "orjson", None)
+    with pytest.raises(ImportError, match="orjson output needs orjson"):
+        check_output_format("orjson")
+    check_output_format("json")
+    payload = base64.b64encode(TESTMESSAGE.read_bytes()).decode("ascii")
+    arguments = ["--output-format", "orjson", "--decode", payload]
+    result = CliRunner().invoke(mqtt_parser.main, arguments)
+    assert "ERROR: orjson output needs orjson" in result.output
+    assert "portnum" not in result.output
@@ -0,0 +1,90 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from meshtastic_tools.sinks import NdjsonSink, Sink, SqliteSink, make_sink
+
+MESSAGE = {
+    "channel": 0,
+    "from_id": "050c2e68",
+    "to_id": "all",
+    "portnum": "TEXT_MESSAGE_APP",
+}
+
+
+def test_ndjson_batches_and_rotates(tmp_path: Path) -> None:
+    path = tmp_path / "packets.ndjson"
+    sink = NdjsonSink(
+        path, max_bytes=500, backup_count=2, batch_size=3, flush_interval=0
+    )
+    sink.write(MESSAGE)
+    sink.write(MESSAGE)
+    assert path.read_text() == ""
+    sink.write(MESSAGE)
+    assert len(path.read_text().splitlines()) == 3
+    for _ in range(30):
+        sink.write(MESSAGE)
+    sink.close()
+    assert sink.written == 33
+    assert (tmp_path / "packets.ndjson.1").exists()
+    assert (tmp_path / "packets.ndjson.2").exists()
+    assert not (tmp_path / "packets.ndjson.3").exists()
+    rotated = (tmp_path / "packets.ndjson.1").read_text().splitlines()
+    assert json.loads(rotated[0]) == MESSAGE
+
+
+def test_write_bytes(tmp_path: Path) -> None:
+    """ raw payloads are base64'd, like they are on stdout """
+    path = tmp_path / "packets.ndjson"
+    with NdjsonSink(path, batch_size=1, flush_interval=0) as sink:
+        sink.write({**MESSAGE, "payload": b"\xffhello"})
+    assert sink.failed == 0
+    assert json.loads(path.read_text())["payload"] == "/2hlbGxv"
+
+
+def test_sqlite(tmp_path: Path) -> None:
+    path = tmp_path / "packets.db"
+    with SqliteSink(path, batch_size=10, flush_interval=0) as sink:
+        for _ in range(25):
+            sink.write(MESSAGE)
+    conn = sqlite3.connect(path)
+    counts = conn.execute("SELECT count(*), portnum FROM packets").fetchone()
+    assert counts == (25, "TEXT_MESSAGE_APP")
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
+def test_sqlite_uses_messages(tmp_path: Path) -> None:
+    """ lines that come with their message aren't parsed again """
+    with SqliteSink(tmp_path / "packets.db", batch_size=10, flush_interval=0) as sink:
+        sink.write_line("not json", MESSAGE)
+    conn = sqlite3.connect(tmp_path / "packets.db")
+    assert conn.execute("SELECT from_id, message FROM packets").fetchall() == [
+        ("050c2e68", "not json")
+    ]
+
+
+class BrokenSink(Sink):
+    def write_batch(self, lines: list[str], messages: list[Any]) -> None:
+        raise OSError("disk full")
+
+
+def test_write_batch_errors_contained() -> None:
+    """ a sink that can't write drops the batch rather than stopping the decoder """
+    with pytest.raises(TypeError):
+        Sink()  # type: ignore[abstract]
+    sink = BrokenSink(batch_size=2, flush_interval=0)
+    for _ in range(5):
+        sink.write(MESSAGE)
+    sink.close()
+    assert sink.failed == 5
+    assert sink.written == 0
+
+
+def test_make_sink() -> None:
+    with pytest.raises(ValueError):
+        make_sink("kafka:foo")
+    with pytest.raises(ValueError):
+        make_sink("sqlite")
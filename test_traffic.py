@@ -0,0 +1,87 @@
+import time
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from meshtastic import mqtt_pb2  # type: ignore
+
+from meshtastic_tools import mqtt_parser, traffic
+from meshtastic_tools.batch import decode_batch, read_length_prefixed
+from meshtastic_tools.keyring import Keyring
+from meshtastic_tools.traffic import TrafficGenerator
+
+
+def test_same_seed_same_stream(monkeypatch: pytest.MonkeyPatch) -> None:
+    """ the whole envelopes match, not just the topics, even as the clock moves """
+    first = list(TrafficGenerator(seed=1).stream(50))
+    monkeypatch.setattr(time, "time", lambda: 4000000000.0)
+    second = list(TrafficGenerator(seed=1).stream(50))
+    assert first == second
+    assert list(TrafficGenerator(seed=2).stream(50)) != first
+    assert list(TrafficGenerator(seed=1, start_time=1800000000).stream(50)) != first
+
+
+def test_generated_packets_decode() -> None:
+    """ everything decrypts with the keyring, except the undecryptable ones """
+    keyring = Keyring.default()
+    keyring.add("Private", "AQ==")
+    generator = TrafficGenerator(
+        seed=3,
+        mix={"POSITION_APP": 1, "TEXT_MESSAGE_APP": 1},
+        keyring=keyring,
+        undecryptable_rate=0.2,
+    )
+    envelopes = [payload for _, payload in generator.stream(500)]
+    batch = decode_batch(envelopes, keyring)
+    assert batch.parse_errors == 0
+    assert batch.unhandled == 0
+    assert 0 < batch.undecryptable < 250
+    assert set(batch.portnum_names()) == {"POSITION_APP", "TEXT_MESSAGE_APP"}
+
+
+def test_duplicate_rate() -> None:
+    generator = TrafficGenerator(seed=4, duplicate_rate=0.5)
+    keys = set()
+    for topic, payload in generator.stream(1000):
+        assert topic.startswith("msh/2/e/LongFast/!")
+        se = mqtt_pb2.ServiceEnvelope()
+        se.ParseFromString(payload)
+        keys.add((getattr(se.packet, "from"), se.packet.id))
+    assert 400 < len(keys) < 600
+
+
+def test_parse_message_output() -> None:
+    _, payload = TrafficGenerator(seed=5, duplicate_rate=0).envelope()
+    output = mqtt_parser.format_message(payload, None)
+    assert output is not None
+    assert '"portnum": ' in output
+
+
+def test_cli_mix_and_text_size(tmp_path: Path) -> None:
+    """ --mix and --text-size are passed through to the generator """
+    output = tmp_path / "traffic.bin"
+    arguments = ["--count", "50", "--output", str(output), "--duplicate-rate", "0"]
+    arguments += ["--mix", "TEXT_MESSAGE_APP=1", "--text-size", "20", "30"]
+    result = CliRunner().invoke(traffic.main, arguments)
+    assert result.exit_code == 0, result.output
+    with output.open("rb") as fh:
+        envelopes = list(read_length_prefixed(fh))
+    batch = decode_batch(envelopes, Keyring.default())
+    assert set(batch.portnum_names()) == {"TEXT_MESSAGE_APP"}
+    for message in batch.messages():
+        assert 20 <= len(message["payload"]) <= 30
+
+
+@pytest.mark.parametrize(
+    "arguments",
+    [
+        ["--mix", "POSITION_APP"],
+        ["--mix", "NOT_A_PORTNUM=1"],
+        ["--mix", "POSITION_APP=x"],
+        ["--text-size", "9", "3"],
+    ],
+)
+def test_cli_bad_options(arguments: list[str]) -> None:
+    result = CliRunner().invoke(traffic.main, arguments)
+    assert result.exit_code == 2
+    assert "Invalid value for" in result.output
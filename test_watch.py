@@ -0,0 +1,53 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from meshtastic_tools.watch import InotifyWatcher, PollingWatcher, wait_for_changes
+
+
+def test_polling(tmp_path: Path) -> None:
+    now = 0.0
+
+    def sleep(seconds: float) -> None:
+        nonlocal now
+        now += seconds
+
+    watcher = PollingWatcher(interval=1, clock=lambda: now, sleep=sleep)
+    existing = tmp_path / "existing.yml"
+    existing.write_text("a")
+    watcher.add(tmp_path)
+    assert watcher.changes(5) == set()
+    assert now == 5
+
+    new = tmp_path / "new.yml"
+    new.write_text("b")
+    existing.write_text("longer")
+    assert watcher.changes(5) == {new, existing}
+    new.unlink()
+    assert watcher.changes(0) == {new}
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is linux only"
+)
+def test_inotify(tmp_path: Path) -> None:
+    watcher = InotifyWatcher()
+    try:
+        watcher.add(tmp_path)
+        assert watcher.changes(0) == set()
+        layer = tmp_path / "layer.yml"
+        layer.write_text("a")
+        # editors often write a new file and rename it over the old one
+        temporary = tmp_path / ".layer.yml.swp"
+        temporary.write_text("b")
+        temporary.rename(layer)
+        assert wait_for_changes(watcher, 0.05, timeout=1) == {layer, temporary}
+        layer.unlink()
+        assert watcher.changes(1) == {layer}
+        start = time.monotonic()
+        assert watcher.changes(0.05) == set()
+        assert time.monotonic() - start >= 0.04
+    finally:
+        watcher.close()
@@ -0,0 +1,41 @@
+import json
+
+from meshtastic import mqtt_pb2  # type: ignore
+
+from conftest import envelope
+from meshtastic_tools.metrics import METRICS
+from meshtastic_tools.workers import DecodePool
+
+
+def test_pool_ordered() -> None:
+    """ output comes back in the order it went in, failures are counted """
+    output: list[str] = []
+    before = METRICS.snapshot()
+    with DecodePool(2, queue_size=500, output=output.append) as pool:
+        for from_id in range(1, 201):
+            assert pool.submit("msh/2/e/LongFast/!050c2e68", envelope(from_id=from_id))
+        pool.submit("msh/2/e/LongFast/!050c2e68", b"\xff")
+        # no key for its channel, which isn't a failure
+        se = mqtt_pb2.ServiceEnvelope(channel_id="Private", gateway_id="!050c2e68")
+        setattr(se.packet, "from", 1)
+        se.packet.id = 1
+        se.packet.channel = 1
+        se.packet.encrypted = b"secret"
+        pool.submit("msh/2/e/Private/!050c2e68", se.SerializeToString())
+    assert [json.loads(line)["from_id"] for line in output] == [
+        f"{from_id:08x}" for from_id in range(1, 201)
+    ]
+    assert pool.stats()["decoded"] == 200
+    assert pool.stats()["skipped"] == 1
+    assert pool.stats()["failed"] == 1
+    assert pool.stats()["dropped"] == 0
+
+    # what the workers recorded ends up in this process's metrics
+    after = METRICS.snapshot()
+    received = "meshtastic_messages_received"
+    assert after[received] - before[received] == 202
+    assert after["meshtastic_no_key"] - before["meshtastic_no_key"] == 1
+    packets = after["meshtastic_packets"].get("TEXT_MESSAGE_APP", 0)
+    assert packets - before["meshtastic_packets"].get("TEXT_MESSAGE_APP", 0) == 200
+    latency = after["meshtastic_decode_latency_seconds"]["count"]
+    assert latency - before["meshtastic_decode_latency_seconds"]["count"] == 202